@@ -0,0 +1,6 @@
+"""
+Benchmarks for JSON2SQLGenerator.
+
+`synthetic` builds knowledge bases and rule trees at configurable scale and `run` measures
+knowledge base load and SQL generation against them. See README.md for usage.
+"""
@@ -0,0 +1,90 @@
+"""
+Compare resident memory of the knowledge base representation for several tenants.
+
+Every tenant loads its own copy of the knowledge base (as it would from the database or a JSON file),
+builds the field and path mapping and drops the raw data. The legacy representation stores a dict per
+entry with string keys, the current one stores shared records with interned strings.
+
+Usage:
+    python -m benchmarks.memory --fields 10000 --tenants 10
+"""
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+
+from collections import defaultdict
+
+from benchmarks.synthetic import generate_knowledge_base
+from json2sql.engine import JSON2SQLGenerator
+
+
+def legacy_representation(data):
+    """
+    Build field and path mapping the way it was stored before records were introduced
+    """
+    field_mapping = {
+        field[0]: {'field_name': field[1], 'table_name': field[2], 'data_type': field[3]}
+        for field in data['field_mapping']
+    }
+    path_mapping = defaultdict(dict)
+    for join_tbl, join_fld, parent_tbl, parent_fld, join_tbl_active_fld in data['paths']:
+        path_mapping[join_tbl][parent_tbl] = {
+            'parent_column': parent_fld, 'join_column': join_fld, 'join_table_active_field': join_tbl_active_fld,
+        }
+    return field_mapping, path_mapping
+
+
+def record_representation(data):
+    """
+    Build field and path mapping the way JSON2SQLGenerator stores them
+    """
+    generator = JSON2SQLGenerator(dict(data, custom_methods=(), subqueries=(), variable_templates=()))
+    return generator.field_mapping, generator.path_mapping
+
+
+def measure(builder, serialized_data, tenants):
+    """
+    Measure memory retained by the structures built for every tenant.
+
+    :param builder: (callable) function building the structures from knowledge base data
+    :param serialized_data: (str) JSON knowledge base, decoded separately for every tenant
+    :param tenants: (int) number of tenants
+    :return: (float) retained memory in KB
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        retained = []
+        for _ in range(tenants):
+            data = json.loads(serialized_data)
+            retained.append(builder(data))
+            del data
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return current / 1024.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure knowledge base memory usage')
+    parser.add_argument('--fields', type=int, default=10000)
+    parser.add_argument('--tenants', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    data = generate_knowledge_base(num_fields=args.fields, depth=4, branching=6)
+    serialized_data = json.dumps({'field_mapping': data['field_mapping'], 'paths': data['paths']})
+
+    legacy = measure(legacy_representation, serialized_data, args.tenants)
+    records = measure(record_representation, serialized_data, args.tenants)
+    print('fields={fields} tenants={tenants}'.format(fields=args.fields, tenants=args.tenants))
+    print('legacy dict-of-dicts: {0:.1f} KB'.format(legacy))
+    print('shared records:       {0:.1f} KB'.format(records))
+    print('reduction:            {0:.1f}%'.format((1 - records / legacy) * 100 if legacy else 0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
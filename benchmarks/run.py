@@ -0,0 +1,247 @@
+"""
+Measure JSON2SQLGenerator performance against synthetic knowledge bases.
+
+Usage:
+    python -m benchmarks.run                         # run every scenario and print the results
+    python -m benchmarks.run --scenario small --record   # store results as the new baseline
+    python -m benchmarks.run --compare               # fail if results regressed against the baseline
+
+Baselines are stored with the machine and Python version they were recorded on, --compare warns when they
+differ from the current ones as the results are only comparable on the same machine.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.synthetic import BASE_TABLE, RuleGenerator, generate_knowledge_base
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.snapshot import load_snapshot, save_snapshot
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+# Key of the baseline file holding the environment the baselines were recorded in, not a scenario
+ENVIRONMENT_KEY = 'environment'
+
+# Scenario name -> (knowledge base params, rule params)
+SCENARIOS = {
+    'small': (
+        {'num_fields': 200, 'depth': 3, 'branching': 3, 'num_custom_methods': 20, 'num_subqueries': 10},
+        {'count': 200, 'depth': 3, 'width': 3},
+    ),
+    'wide': (
+        {'num_fields': 5000, 'depth': 4, 'branching': 6, 'num_custom_methods': 200, 'num_subqueries': 50},
+        {'count': 200, 'depth': 3, 'width': 8},
+    ),
+    'deep': (
+        {'num_fields': 5000, 'depth': 10, 'branching': 2, 'num_custom_methods': 200, 'num_subqueries': 50},
+        {'count': 200, 'depth': 6, 'width': 2},
+    ),
+}
+
+# Metrics where a higher value is a regression, as opposed to throughput metrics
+LATENCY_METRICS = (
+    'init_p50_ms', 'init_p99_ms', 'init_peak_kb', 'snapshot_load_p50_ms',
+    'generate_p50_ms', 'generate_p90_ms', 'generate_p99_ms', 'generate_peak_kb', 'generate_warm_p50_ms',
+)
+THROUGHPUT_METRICS = ('generate_rules_per_sec', )
+
+
+def percentile(samples, pct):
+    """
+    Nearest rank percentile.
+
+    :param samples: (list) sorted list of numbers
+    :param pct: (int|float) percentile between 0 and 100
+    :return: (float) value at the percentile
+    """
+    if not samples:
+        return 0.0
+    index = max(int(round(pct / 100.0 * len(samples))) - 1, 0)
+    return samples[min(index, len(samples) - 1)]
+
+
+def measure_peak_memory(func):
+    """
+    Run func under tracemalloc and return the peak memory allocated in KB.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024.0
+
+
+def run_scenario(kb_params, rule_params, init_repeat=10, seed=0):
+    """
+    Run a single benchmark scenario.
+
+    :param kb_params: (dict) keyword arguments for generate_knowledge_base
+    :param rule_params: (dict) count, depth and width of the generated rules
+    :param init_repeat: (int) number of times JSON2SQLGenerator is initialised
+    :param seed: (int) seed used for the knowledge base and the rules
+    :return: (dict) metrics
+    """
+    data = generate_knowledge_base(seed=seed, **kb_params)
+    rule_generator = RuleGenerator(data, seed=seed)
+    rules = [
+        rule_generator.generate(depth=rule_params['depth'], width=rule_params['width'])
+        for _ in range(rule_params['count'])
+    ]
+
+    init_samples = []
+    for _ in range(init_repeat):
+        start = time.perf_counter()
+        generator = JSON2SQLGenerator(data)
+        init_samples.append((time.perf_counter() - start) * 1000)
+    init_samples.sort()
+    init_peak = measure_peak_memory(lambda: JSON2SQLGenerator(data))
+
+    snapshot_samples = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_path = os.path.join(tmp_dir, 'knowledge_base.snapshot')
+        save_snapshot(generator, snapshot_path)
+        for _ in range(init_repeat):
+            start = time.perf_counter()
+            load_snapshot(snapshot_path)
+            snapshot_samples.append((time.perf_counter() - start) * 1000)
+    snapshot_samples.sort()
+
+    generate_samples = []
+    total_start = time.perf_counter()
+    for rule in rules:
+        start = time.perf_counter()
+        generator.generate_sql(rule, BASE_TABLE)
+        generate_samples.append((time.perf_counter() - start) * 1000)
+    total_elapsed = time.perf_counter() - total_start
+    generate_samples.sort()
+
+    # Same rules again, served from the compiled rules cache
+    warm_samples = []
+    for rule in rules:
+        start = time.perf_counter()
+        generator.generate_sql(rule, BASE_TABLE)
+        warm_samples.append((time.perf_counter() - start) * 1000)
+    warm_samples.sort()
+
+    def generate_all():
+        generator.clear_caches()
+        for rule in rules:
+            generator.generate_sql(rule, BASE_TABLE)
+    generate_peak = measure_peak_memory(generate_all)
+
+    return {
+        'init_p50_ms': percentile(init_samples, 50),
+        'init_p99_ms': percentile(init_samples, 99),
+        'init_peak_kb': init_peak,
+        'snapshot_load_p50_ms': percentile(snapshot_samples, 50),
+        'generate_p50_ms': percentile(generate_samples, 50),
+        'generate_p90_ms': percentile(generate_samples, 90),
+        'generate_p99_ms': percentile(generate_samples, 99),
+        'generate_rules_per_sec': len(rules) / total_elapsed if total_elapsed else 0.0,
+        'generate_peak_kb': generate_peak,
+        'generate_warm_p50_ms': percentile(warm_samples, 50),
+    }
+
+
+def compare_results(results, baselines, tolerance):
+    """
+    Compare results with the recorded baselines.
+
+    :param results: (dict) scenario -> metrics
+    :param baselines: (dict) scenario -> metrics
+    :param tolerance: (float) allowed relative regression, e.g. 0.2 for 20%
+    :return: (list) human readable regression messages
+    """
+    regressions = []
+    for scenario, metrics in results.items():
+        baseline = baselines.get(scenario)
+        if not baseline:
+            continue
+        for metric in LATENCY_METRICS:
+            if metric in baseline and metrics[metric] > baseline[metric] * (1 + tolerance):
+                regressions.append('{scenario}.{metric}: {value:.3f} > baseline {baseline:.3f}'.format(
+                    scenario=scenario, metric=metric, value=metrics[metric], baseline=baseline[metric]
+                ))
+        for metric in THROUGHPUT_METRICS:
+            if metric in baseline and metrics[metric] < baseline[metric] * (1 - tolerance):
+                regressions.append('{scenario}.{metric}: {value:.3f} < baseline {baseline:.3f}'.format(
+                    scenario=scenario, metric=metric, value=metrics[metric], baseline=baseline[metric]
+                ))
+    return regressions
+
+
+def get_environment():
+    """
+    :return: (dict) machine and Python version the benchmarks run on
+    """
+    return {
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': '{implementation} {version}'.format(
+            implementation=platform.python_implementation(), version=platform.python_version()
+        ),
+    }
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark JSON2SQLGenerator')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run, can be repeated. Runs every scenario by default.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--init-repeat', type=int, default=10)
+    parser.add_argument('--baseline-file', default=BASELINE_FILE)
+    parser.add_argument('--record', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='Exit with an error if results regressed')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for scenario in args.scenario or sorted(SCENARIOS):
+        kb_params, rule_params = SCENARIOS[scenario]
+        results[scenario] = run_scenario(kb_params, rule_params, init_repeat=args.init_repeat, seed=args.seed)
+        print('{scenario}: {metrics}'.format(
+            scenario=scenario,
+            metrics=', '.join('{0}={1:.3f}'.format(key, value) for key, value in sorted(results[scenario].items()))
+        ))
+
+    baselines = load_baselines(args.baseline_file)
+    environment = get_environment()
+    if args.compare:
+        if baselines.get(ENVIRONMENT_KEY) != environment:
+            print('WARNING baselines were recorded on {recorded}, not on {current}'.format(
+                recorded=baselines.get(ENVIRONMENT_KEY), current=environment
+            ))
+        regressions = compare_results(results, baselines, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {0}'.format(regression))
+        if regressions:
+            return 1
+
+    if args.record:
+        baselines.update(results)
+        baselines[ENVIRONMENT_KEY] = environment
+        with open(args.baseline_file, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""
+Synthetic knowledge bases and rule trees used by the benchmarks.
+
+Everything here is deterministic for a given seed so that numbers recorded in baselines
+are comparable between runs.
+"""
+import json
+import random
+
+BASE_TABLE = 'patients_member'
+
+# Data types used for generated fields along with the operators that make sense for them
+OPERATORS_BY_DATA_TYPE = {
+    'integer': ('equals', 'not_equals', 'greater_than', 'less_than_equals', 'between'),
+    'string': ('equals', 'starts_with', 'ends_with', 'has_substring'),
+    'date': ('less_than', 'greater_than_equals', 'between'),
+    'datetime': ('greater_than', 'less_than'),
+    'boolean': ('equals', ),
+}
+DATA_TYPES = tuple(sorted(OPERATORS_BY_DATA_TYPE))
+
+CUSTOM_METHOD_TEMPLATES = (
+    (
+        '{field} >= {threshold}',
+        {'field': {'data_type': 'field'}, 'threshold': {'data_type': 'integer'}},
+    ),
+    (
+        'EXISTS (SELECT 1 FROM {table} WHERE {table}.member_id = patients_member.id '
+        'AND {table}.value {operator} {value})',
+        {'operator': {'data_type': 'operator'}, 'value': {'data_type': 'integer'}},
+    ),
+    (
+        '{field} = {keyword}',
+        {'field': {'data_type': 'field'}, 'keyword': {'data_type': 'variable_template'}},
+    ),
+)
+
+SQL_SUBQUERY_TEMPLATE = 'SELECT member_id, COUNT(*) AS total FROM {table} WHERE value > {minimum} GROUP BY member_id'
+
+
+def generate_tables(depth, branching):
+    """
+    Generate a tree of tables rooted at the base table.
+
+    :param depth: (int) Number of levels below the base table
+    :param branching: (int) Number of child tables of every table
+    :return: (list) list of tuples (table_name, parent_table_name) in breadth first order
+    """
+    tables = []
+    current_level = [BASE_TABLE]
+    for level in range(1, depth + 1):
+        next_level = []
+        for parent_index, parent in enumerate(current_level):
+            for child_index in range(branching):
+                table = 't_{level}_{index}'.format(level=level, index=parent_index * branching + child_index)
+                tables.append((table, parent))
+                next_level.append(table)
+        current_level = next_level
+    return tables
+
+
+def generate_knowledge_base(num_fields=1000, depth=3, branching=3, num_custom_methods=50, num_subqueries=20,
+                            num_variable_templates=20, seed=0):
+    """
+    Generate the `data` dict accepted by JSON2SQLGenerator.
+
+    :param num_fields: (int) Number of entries in field_mapping
+    :param depth: (int) Depth of the path graph below the base table
+    :param branching: (int) Number of child tables of every table in the path graph
+    :param num_custom_methods: (int) Number of custom methods
+    :param num_subqueries: (int) Number of subqueries, half of them plain SQL templates
+    :param num_variable_templates: (int) Number of variable templates
+    :param seed: (int) Seed for the random generator
+    :return: (dict) knowledge base data
+    """
+    rng = random.Random(seed)
+    tables = generate_tables(depth, branching)
+    table_names = [BASE_TABLE] + [table for table, _ in tables]
+
+    paths = [
+        (table, 'id', parent, '{table}_id'.format(table=table), 'is_active' if index % 4 == 0 else None)
+        for index, (table, parent) in enumerate(tables)
+    ]
+
+    field_mapping = [
+        (
+            field_id,
+            'field_{field_id}'.format(field_id=field_id),
+            rng.choice(table_names),
+            DATA_TYPES[field_id % len(DATA_TYPES)],
+        )
+        for field_id in range(1, num_fields + 1)
+    ]
+
+    custom_methods = []
+    for template_id in range(1, num_custom_methods + 1):
+        template_str, parameters = CUSTOM_METHOD_TEMPLATES[template_id % len(CUSTOM_METHOD_TEMPLATES)]
+        template_str = template_str.replace('{table}', rng.choice(table_names))
+        custom_methods.append((template_id, template_str, json.dumps(parameters)))
+
+    integer_fields = [field for field in field_mapping if field[3] == 'integer']
+    subqueries = []
+    for subquery_id in range(1, num_subqueries + 1):
+        if subquery_id % 2:
+            fields = {'member_id': {'alias': 'member_id', 'is_member_id': True},
+                      'total': {'alias': 'total', 'data_type': 'integer'}}
+            parameters = {'minimum': {'data_type': 'integer'}}
+            template_str = SQL_SUBQUERY_TEMPLATE.replace('{table}', rng.choice(table_names))
+            subqueries.append((subquery_id, True, template_str, json.dumps(fields), json.dumps(parameters)))
+        else:
+            field = rng.choice(integer_fields)
+            fields = {
+                'member_id': {'field': 'id', 'category': BASE_TABLE, 'alias': 'member_id', 'is_member_id': True},
+                'value': {'field': field[0], 'alias': 'value', 'data_type': 'integer'},
+            }
+            template = {
+                'fields': [field[0]],
+                'where_data': {'where': {'field': field[0], 'operator': 'greater_than', 'value': '10'}},
+            }
+            subqueries.append((subquery_id, False, json.dumps(template), json.dumps(fields), '{}'))
+
+    variable_templates = [
+        (template_id, 'keyword_{template_id}'.format(template_id=template_id), DATA_TYPES[template_id % len(DATA_TYPES)])
+        for template_id in range(1, num_variable_templates + 1)
+    ]
+
+    return {
+        'field_mapping': tuple(field_mapping),
+        'paths': tuple(paths),
+        'custom_methods': tuple(custom_methods),
+        'subqueries': tuple(subqueries),
+        'variable_templates': tuple(variable_templates),
+    }
+
+
+class RuleGenerator(object):
+    """
+    Generates random rule trees against a knowledge base produced by generate_knowledge_base
+    """
+
+    def __init__(self, data, seed=0):
+        self.rng = random.Random(seed)
+        self.fields = list(data['field_mapping'])
+        self.custom_methods = [
+            (template_id, json.loads(parameters)) for template_id, _, parameters in data['custom_methods']
+        ]
+        self.sql_subqueries = [subquery[0] for subquery in data['subqueries'] if subquery[1]]
+        self.variable_templates = {}
+        for template_id, _, return_type in data['variable_templates']:
+            self.variable_templates.setdefault(return_type, []).append(str(template_id))
+
+    def generate(self, depth=3, width=3, subquery_probability=0.2):
+        """
+        Generate a rule in the format accepted by JSON2SQLGenerator.generate_sql
+
+        :param depth: (int) Depth of the condition tree
+        :param width: (int) Number of children of every AND/OR node
+        :param subquery_probability: (float) Probability of the rule joining a subquery
+        :return: (dict) rule data
+        """
+        used_fields = set()
+        sub_queries = []
+        if self.sql_subqueries and self.rng.random() < subquery_probability:
+            sub_queries.append({
+                'unique_id': self.rng.choice(self.sql_subqueries),
+                'alias': 'sq_0',
+                'parameters': {'minimum': {'value': str(self.rng.randint(1, 10))}},
+            })
+        where_data = self._generate_node(depth, width, used_fields, sub_queries)
+        return {
+            'fields': sorted(used_fields),
+            'where_data': where_data,
+            'sub_queries': sub_queries,
+        }
+
+    def _generate_node(self, depth, width, used_fields, sub_queries):
+        if depth <= 0:
+            return self._generate_leaf(used_fields, sub_queries)
+
+        condition = self.rng.choice(('and', 'or', 'and', 'not'))
+        if condition == 'not':
+            return {'not': [self._generate_node(depth - 1, width, used_fields, sub_queries)]}
+        return {condition: [self._generate_node(depth - 1, width, used_fields, sub_queries) for _ in range(width)]}
+
+    def _generate_leaf(self, used_fields, sub_queries):
+        choice = self.rng.random()
+        if choice < 0.1 and self.custom_methods:
+            return self._generate_custom_method(used_fields)
+        if choice < 0.15 and sub_queries:
+            return {'where': {
+                'field': 'total', 'subquery': sub_queries[0]['unique_id'], 'alias': sub_queries[0]['alias'],
+                'operator': 'greater_than', 'value': str(self.rng.randint(1, 5)),
+            }}
+
+        field_id, _, _, data_type = self.rng.choice(self.fields)
+        used_fields.add(field_id)
+        operator = self.rng.choice(OPERATORS_BY_DATA_TYPE[data_type])
+        value, secondary_value = self._generate_values(data_type)
+        where = {'field': field_id, 'operator': operator, 'value': value}
+        if operator == 'between':
+            where['secondary_value'] = secondary_value
+        return {'where': where}
+
+    def _generate_values(self, data_type):
+        if data_type in self.variable_templates and self.rng.random() < 0.1:
+            value = {'type': 'VARIABLE_TEMPLATE', 'variable_template_id': self.rng.choice(self.variable_templates[data_type])}
+            return value, value
+        if data_type == 'integer':
+            low = self.rng.randint(0, 100)
+            return str(low), str(low + self.rng.randint(1, 100))
+        if data_type == 'string':
+            return 'value_{0}'.format(self.rng.randint(0, 1000)), None
+        if data_type == 'date':
+            if self.rng.random() < 0.5:
+                return {'type': 'DYNAMIC_DATE', 'operator': 'date_sub', 'offset': self.rng.randint(1, 10), 'unit': 'YEAR'}, \
+                       {'type': 'DYNAMIC_DATE'}
+            return '2018-0{0}-01'.format(self.rng.randint(1, 9)), '2019-01-01'
+        if data_type == 'datetime':
+            return '2018-01-01T10:00:00', None
+        return self.rng.choice(('TRUE', 'FALSE')), None
+
+    def _generate_custom_method(self, used_fields):
+        template_id, parameters = self.rng.choice(self.custom_methods)
+        values = {}
+        for name, definition in parameters.items():
+            data_type = definition['data_type']
+            if data_type == 'field':
+                field_id = self.rng.choice(self.fields)[0]
+                used_fields.add(field_id)
+                values[name] = {'field': field_id, 'value': str(field_id)}
+            elif data_type == 'operator':
+                values[name] = {'value': self.rng.choice(('equals', 'greater_than', 'less_than'))}
+            elif data_type == 'variable_template':
+                values[name] = {'value': 'keyword_1'}
+            else:
+                values[name] = {'value': str(self.rng.randint(1, 100))}
+        return {'custom_method': {'template_id': template_id, 'parameters': values}}
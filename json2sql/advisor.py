@@ -0,0 +1,287 @@
+"""
+Offline index advisor.
+
+Reads a corpus of rules and resolves them against the knowledge base the same way JSON2SQLGenerator does
+(field mapping for conditions, extract_paths_subset and create_join_path for joins, group by fields), without
+connecting to the database. Columns used in equality, range and LIKE prefix predicates, join conditions and
+GROUP BY are counted, weighted by rule frequency, and turned into ranked composite index recommendations
+per table.
+
+Usage:
+    python -m json2sql.advisor knowledge_base.json rules.jsonl --base-table patients_member
+
+The knowledge base is a JSON object with the keys accepted by JSON2SQLGenerator, or a snapshot file
+(see json2sql.snapshot). Every line of the rules file is a rule JSON, or an object {"rule": <rule JSON>,
+"weight": <number of times the rule is run>}. Use `-` to read the rules from stdin.
+"""
+import argparse
+import json
+import logging
+import sys
+
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+
+from json2sql.snapshot import load_generator
+
+logger = logging.getLogger(u'JSON2SQLGenerator.advisor')
+
+IndexRecommendation = namedtuple('IndexRecommendation', ['table', 'columns', 'weight'])
+
+
+class IndexAdvisor(object):
+    """
+    Collects column usage of rules and recommends composite indexes.
+
+        advisor = IndexAdvisor(generator)
+        for rule in rules:
+            advisor.add_rule(rule, 'patients_member')
+        for table, recommendations in advisor.recommend().items():
+            ...
+    """
+    # Kinds of column usage
+    EQUALITY = 'equality'
+    RANGE = 'range'
+    JOIN = 'join'
+    GROUP_BY = 'group_by'
+    USAGE_KINDS = (EQUALITY, RANGE, JOIN, GROUP_BY)
+
+    # Operators an index can serve, LIKE prefix (starts_with) is a range scan on the index
+    EQUALITY_OPERATORS = ('equals', 'in_op', 'is_op')
+    RANGE_OPERATORS = (
+        'greater_than', 'less_than', 'greater_than_equals', 'less_than_equals', 'between', 'starts_with',
+    )
+
+    # Longer indexes cost more on writes than they save on reads
+    MAX_INDEX_COLUMNS = 5
+
+    def __init__(self, generator):
+        """
+        :param generator: (JSON2SQLGenerator) generator holding the knowledge base the rules are written against
+        """
+        self.generator = generator
+        # (table, column, kind) -> weight
+        self.column_usage = Counter()
+        # (table, join column, equality columns, range columns) -> weight, columns a single rule can
+        # look up together through one index
+        self._signatures = Counter()
+        # (table, group by columns) -> weight
+        self._group_by_signatures = Counter()
+        self.rules = 0
+        self.skipped_rules = 0
+
+    def add_rule(self, data, base_table, weight=1):
+        """
+        Record the column usage of a rule. Rules which can't be resolved against the knowledge base are
+        counted in skipped_rules and logged.
+        :param data: (dict) rule JSON, see JSON2SQLGenerator.generate_sql
+        :param base_table: (string) Exact table name as in DB to be used with FROM clause in SQL.
+        :param weight: (int|float) how often the rule is run
+        :return: (bool) True if the rule was recorded
+        """
+        usage = defaultdict(lambda: defaultdict(list))  # table -> kind -> [(column, sargable)]
+        try:
+            self._collect_rule(data, base_table, usage)
+        except Exception:
+            logger.warning('Skipping rule that could not be resolved', exc_info=True)
+            self.skipped_rules += 1
+            return False
+
+        self.rules += 1
+        for table, kinds in usage.items():
+            sargable_columns = {}
+            for kind, columns in kinds.items():
+                for column in set(column for column, _ in columns):
+                    self.column_usage[(table, column, kind)] += weight
+                sargable_columns[kind] = [column for column, sargable in columns if sargable]
+            join_columns = sargable_columns.get(self.JOIN) or [None]
+            signature = (
+                table, join_columns[0],
+                frozenset(sargable_columns.get(self.EQUALITY, ())), frozenset(sargable_columns.get(self.RANGE, ()))
+            )
+            if any(signature[1:]):
+                self._signatures[signature] += weight
+            if sargable_columns.get(self.GROUP_BY):
+                self._group_by_signatures[(table, tuple(sargable_columns[self.GROUP_BY]))] += weight
+        return True
+
+    def _collect_rule(self, data, base_table, usage):
+        """
+        Resolve joins, conditions, group by fields and JSON subqueries of a rule into usage
+        """
+        generator = self.generator
+        generator.base_table = base_table
+
+        path_subset = generator.extract_paths_subset(
+            [generator._get_field(field_id).table_name for field_id in data.get('fields', [])],
+            data.get('path_hints', {})
+        )
+        for join_table, parent_table in generator.create_join_path(path_subset, base_table):
+            path = generator.path_mapping[join_table][parent_table]
+            usage[join_table][self.JOIN].append((path.join_column, True))
+            if path.join_table_active_field:
+                usage[join_table][self.EQUALITY].append((path.join_table_active_field, True))
+
+        self._collect_condition(data.get('where_data', {}), usage, sargable=True)
+
+        for group_by_field in data.get('group_by_fields', []):
+            field_id = group_by_field['field'] if isinstance(group_by_field, dict) else group_by_field
+            field_data = generator._get_field(field_id)
+            usage[field_data.table_name][self.GROUP_BY].append((field_data.field_name, True))
+
+        # Rules used as subqueries are compiled against the same base table
+        for subquery_dict in data.get('sub_queries', []):
+            subquery = generator.subquery_mapping[subquery_dict['unique_id']]
+            if not subquery.is_sql:
+                self._collect_rule(subquery.template_str, base_table, usage)
+
+    def _collect_condition(self, data, usage, sargable):
+        """
+        Walk a condition tree.
+        :param data: (dict) condition, e.g. {'and': [...]} or {'where': {...}}
+        :param usage: (dict) table -> kind -> [(column, sargable)]
+        :param sargable: (bool) False below OR and NOT, where a single composite index can't serve the predicate.
+                         Such columns only count in column_usage.
+        :return: None
+        """
+        generator = self.generator
+        for condition, condition_data in data.items():
+            if condition == generator.WHERE_CONDITION:
+                self._collect_where(condition_data, usage, sargable)
+            elif condition in (generator.AND_CONDITION, generator.OR_CONDITION, generator.NOT_CONDITION,
+                               generator.EXISTS_CONDITION):
+                for element in condition_data:
+                    self._collect_condition(
+                        element, usage, sargable and condition == generator.AND_CONDITION
+                    )
+
+    def _collect_where(self, where, usage, sargable):
+        """
+        Record the column of a single condition, see JSON2SQLGenerator._generate_where_phrase
+        """
+        operator, _, field, _ = self.generator._get_validated_data(where)
+        # Columns of derived tables and aggregates can't use an index
+        if 'subquery' in where or where.get('aggregate_lhs'):
+            return
+        if operator in self.EQUALITY_OPERATORS:
+            kind = self.EQUALITY
+        elif operator in self.RANGE_OPERATORS:
+            kind = self.RANGE
+        else:
+            return
+
+        field_data = self.generator._get_field(field)
+        usage[field_data.table_name][kind].append((field_data.field_name, sargable))
+
+    def recommend(self, limit_per_table=3):
+        """
+        Rank composite indexes per table.
+
+        Columns of an index are ordered join column first, then equality columns by frequency, then the most
+        frequent range column, as a B-tree index can't use columns after a range. An index also serves every
+        query using a prefix of its columns, so candidates that are a prefix of a recommended index are merged
+        into it.
+        :param limit_per_table: (int) Maximum number of recommendations per table
+        :return: (OrderedDict) table -> list of IndexRecommendation, highest weight first. Tables are ordered
+                 by the weight of their best recommendation.
+        """
+        candidates = Counter()
+        for (table, join_column, equality_columns, range_columns), weight in self._signatures.items():
+            columns = [join_column] if join_column else []
+            columns.extend(sorted(
+                (column for column in equality_columns if column not in columns),
+                key=lambda column: (-self.column_usage[(table, column, self.EQUALITY)], column)
+            ))
+            range_columns = sorted(
+                (column for column in range_columns if column not in columns),
+                key=lambda column: (-self.column_usage[(table, column, self.RANGE)], column)
+            )
+            columns.extend(range_columns[:1])
+            candidates[(table, tuple(columns[:self.MAX_INDEX_COLUMNS]))] += weight
+        for (table, columns), weight in self._group_by_signatures.items():
+            candidates[(table, columns[:self.MAX_INDEX_COLUMNS])] += weight
+
+        per_table = defaultdict(list)
+        # Longest first, so prefixes find the index covering them
+        for (table, columns), weight in sorted(candidates.items(), key=lambda item: -len(item[0][1])):
+            recommendations = per_table[table]
+            covering = [
+                index for index, recommendation in enumerate(recommendations)
+                if recommendation.columns[:len(columns)] == columns
+            ]
+            if covering:
+                index = max(covering, key=lambda position: recommendations[position].weight)
+                recommendations[index] = recommendations[index]._replace(
+                    weight=recommendations[index].weight + weight
+                )
+            else:
+                recommendations.append(IndexRecommendation(table, columns, weight))
+
+        ranked = {
+            table: sorted(recommendations, key=lambda recommendation: (-recommendation.weight,
+                                                                       recommendation.columns))[:limit_per_table]
+            for table, recommendations in per_table.items()
+        }
+        return OrderedDict(sorted(ranked.items(), key=lambda item: (-item[1][0].weight, item[0])))
+
+
+def format_create_index(recommendation):
+    """
+    Format a recommendation as a CREATE INDEX statement
+    :param recommendation: (IndexRecommendation) recommendation
+    :return: (str) SQL statement
+    """
+    # MySQL limits identifiers to 64 characters
+    name = 'idx_{table}_{columns}'.format(
+        table=recommendation.table, columns='_'.join(recommendation.columns)
+    )[:64]
+    return 'CREATE INDEX `{name}` ON `{table}` ({columns});'.format(
+        name=name, table=recommendation.table,
+        columns=', '.join('`{column}`'.format(column=column) for column in recommendation.columns)
+    )
+
+
+def iter_rules(lines):
+    """
+    Parse the rules JSONL
+    :param lines: (iterable) lines of the file
+    :return: (generator) tuples (rule JSON, weight)
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        entry = json.loads(line)
+        if 'rule' in entry:
+            yield entry['rule'], entry.get('weight', 1)
+        else:
+            yield entry, 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recommend MySQL indexes for a corpus of rules')
+    parser.add_argument('knowledge_base', help='Knowledge base JSON or snapshot file')
+    parser.add_argument('rules', help='Rules JSONL file, - for stdin')
+    parser.add_argument('--base-table', required=True)
+    parser.add_argument('--limit', type=int, default=3, help='Maximum number of indexes per table')
+    args = parser.parse_args(argv)
+
+    advisor = IndexAdvisor(load_generator(args.knowledge_base))
+    rules_file = sys.stdin if args.rules == '-' else open(args.rules)
+    try:
+        for rule, weight in iter_rules(rules_file):
+            advisor.add_rule(rule, args.base_table, weight)
+    finally:
+        if rules_file is not sys.stdin:
+            rules_file.close()
+
+    print('-- {rules} rules analysed, {skipped} skipped'.format(rules=advisor.rules, skipped=advisor.skipped_rules))
+    for table, recommendations in advisor.recommend(args.limit).items():
+        print('-- {table}'.format(table=table))
+        for recommendation in recommendations:
+            print('{sql}  -- weight {weight}'.format(sql=format_create_index(recommendation),
+                                                     weight=recommendation.weight))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+Caches used by JSON2SQLGenerator to keep compiled artifacts warm between calls.
+"""
+from collections import OrderedDict, defaultdict
+
+
+class DependencyCache(object):
+    """
+    LRU cache where every entry records the knowledge base entries it was built from.
+    When a knowledge base entry changes only the entries depending on it are dropped.
+
+    Dependencies are hashable tuples, e.g. ('field', 12) or ('table', 'patients_member').
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        :param maxsize: (int) Maximum number of entries. Caching is disabled when it is 0.
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (value, dependencies)
+        self._dependents = defaultdict(set)  # dependency -> keys
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def lookup(self, key):
+        """
+        Get the entry for key and mark it as recently used
+        :param key: (hashable) cache key
+        :return: (tuple|None) (value, dependencies) or None when the key is not cached
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def store(self, key, value, dependencies):
+        """
+        Add an entry to the cache, evicting the least recently used entry when the cache is full
+        :param key: (hashable) cache key
+        :param value: cached value
+        :param dependencies: (set) dependencies of the value
+        :return: None
+        """
+        if self.maxsize <= 0:
+            return
+        if key in self._entries:
+            self._discard(key)
+        dependencies = frozenset(dependencies)
+        self._entries[key] = (value, dependencies)
+        for dependency in dependencies:
+            self._dependents[dependency].add(key)
+        while len(self._entries) > self.maxsize:
+            self._discard(next(iter(self._entries)))
+
+    def invalidate(self, dependencies):
+        """
+        Drop every entry that depends on any of the given dependencies
+        :param dependencies: (iterable) dependencies that changed
+        :return: (int) number of dropped entries
+        """
+        dropped = 0
+        for dependency in dependencies:
+            for key in list(self._dependents.get(dependency, ())):
+                self._discard(key)
+                dropped += 1
+        return dropped
+
+    def clear(self):
+        self._entries.clear()
+        self._dependents.clear()
+
+    def _discard(self, key):
+        _, dependencies = self._entries.pop(key)
+        for dependency in dependencies:
+            keys = self._dependents[dependency]
+            keys.discard(key)
+            if not keys:
+                del self._dependents[dependency]
@@ -0,0 +1,143 @@
+"""
+Batch compiler for rule files.
+
+Compiles a JSONL file of rules against a knowledge base across a pool of worker processes and streams one
+JSONL record per rule, in input order:
+
+    json2sql knowledge_base.json rules.jsonl --base-table patients_member --stats > compiled.jsonl
+
+The knowledge base is a JSON object with the keys accepted by JSON2SQLGenerator, or a snapshot file
+(see json2sql.snapshot). It is loaded in the parent, forked workers inherit the generator and workers
+started with spawn or forkserver (the default on macOS and Windows) load it again from the file.
+Every line of the rules file is a rule JSON, or an object {"id": <rule id>, "rule": <rule JSON>,
+"base_table": <base table of the rule>}. The id defaults to the line number. Use `-` to read the rules
+from stdin.
+
+Output records are {"id": ..., "sql": ..., "elapsed_ms": ...} for compiled rules and
+{"id": ..., "error": ..., "error_type": ..., "elapsed_ms": ...} for rules which failed. With
+--validate-only the rules are checked with JSON2SQLGenerator.validate_rule and "valid": true replaces "sql".
+The exit status is 1 when any rule failed.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from json2sql.snapshot import load_generator
+
+# Generator and options of the current worker process, set by _initialize_worker
+_worker = {}
+
+
+def _initialize_worker(knowledge_base_path, base_table, validate_only):
+    # Generators hold locks and can't be pickled, so only the path is sent to the workers
+    if 'generator' not in _worker:
+        _worker['generator'] = load_generator(knowledge_base_path)
+    _worker['base_table'] = base_table
+    _worker['validate_only'] = validate_only
+
+
+def _compile_line(task):
+    """
+    Compile a single line of the rules file in the worker process
+    :param task: (tuple) (line number, line)
+    :return: (dict) output record
+    """
+    line_number, line = task
+    record = {'id': line_number}
+    start = time.perf_counter()
+    try:
+        entry = json.loads(line)
+        base_table = _worker['base_table']
+        if 'rule' in entry:
+            record['id'] = entry.get('id', line_number)
+            base_table = entry.get('base_table') or base_table
+            entry = entry['rule']
+        assert base_table, 'Base table is required, use --base-table or set base_table on the line'
+
+        if _worker['validate_only']:
+            record['valid'] = _worker['generator'].validate_rule(entry, base_table)
+        else:
+            record['sql'] = _worker['generator'].generate_sql(entry, base_table)
+    except Exception as e:
+        record['error'] = str(e)
+        record['error_type'] = type(e).__name__
+    record['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return record
+
+
+def _iter_tasks(lines):
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line:
+            yield line_number, line
+
+
+def _percentile(values, percent):
+    """
+    Nearest rank percentile of sorted values
+    """
+    if not values:
+        return 0
+    rank = max(int(round(percent / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def _format_stats(elapsed, errors, wall_time):
+    elapsed = sorted(elapsed)
+    return '{rules} rules, {errors} errors in {wall:.2f}s ({rate:.0f} rules/s), compile ms p50 {p50} p99 {p99}' \
+           ' max {max}'.format(
+               rules=len(elapsed), errors=errors, wall=wall_time,
+               rate=len(elapsed) / wall_time if wall_time else 0,
+               p50=_percentile(elapsed, 50), p99=_percentile(elapsed, 99), max=elapsed[-1] if elapsed else 0
+           )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compile a JSONL file of rules to SQL')
+    parser.add_argument('knowledge_base', help='Knowledge base JSON or snapshot file')
+    parser.add_argument('rules', nargs='?', default='-', help='Rules JSONL file, - for stdin (default)')
+    parser.add_argument('--base-table', help='Base table of rules that do not set one')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes, 1 compiles in this process (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=16, help='Number of rules sent to a worker at once')
+    parser.add_argument('--validate-only', action='store_true',
+                        help='Only check that the rules compile, without building the SQL')
+    parser.add_argument('--stats', action='store_true', help='Print a timing summary to stderr')
+    args = parser.parse_args(argv)
+    assert args.workers > 0, 'Number of workers must be positive'
+
+    # Loaded before the workers start, so a broken knowledge base fails once here and forked workers inherit it
+    _worker['generator'] = load_generator(args.knowledge_base)
+    initargs = (args.knowledge_base, args.base_table, args.validate_only)
+    rules_file = sys.stdin if args.rules == '-' else open(args.rules)
+    pool = None
+    elapsed = []
+    errors = 0
+    start = time.perf_counter()
+    try:
+        if args.workers == 1:
+            _initialize_worker(*initargs)
+            records = map(_compile_line, _iter_tasks(rules_file))
+        else:
+            pool = multiprocessing.Pool(args.workers, initializer=_initialize_worker, initargs=initargs)
+            records = pool.imap(_compile_line, _iter_tasks(rules_file), chunksize=args.chunk_size)
+        for record in records:
+            elapsed.append(record['elapsed_ms'])
+            errors += 'error' in record
+            sys.stdout.write(json.dumps(record) + '\n')
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if rules_file is not sys.stdin:
+            rules_file.close()
+
+    if args.stats:
+        sys.stderr.write(_format_stats(elapsed, errors, time.perf_counter() - start) + '\n')
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""
+Per data type codecs used by JSON2SQLGenerator to validate values of rules and format them as SQL literals.
+
+A codec is resolved once per field when the knowledge base is loaded, so compiling a condition costs a
+single call on the codec instead of branching on the data type for every value:
+
+    codec = get_codec('date')
+    codec.to_sql('2020-1-5')            # "'2020-1-5'"
+
+Compiled SQL is %-formatted before it is run (see json2sql.prepared.format_sql), so to_sql doubles every `%`
+of the literal.
+
+Custom data types can be added with register_codec before the generators using them are created:
+
+    class ZipCodeCodec(StringCodec):
+        data_type = 'zipcode'
+        pattern = re.compile(r'^\\d{5}$')
+
+        def clean(self, value):
+            if not self.pattern.match(value):
+                raise ValueError('Invalid value -[{value}] for data_type - [zipcode]'.format(value=value))
+            return value
+
+    register_codec(ZipCodeCodec())
+
+Data types without a codec use a passthrough codec which neither validates nor quotes the values.
+"""
+import datetime
+import re
+
+import MySQLdb
+
+
+def escape_percent(sql):
+    """
+    Escape `%` in SQL put in compiled SQL, which is %-formatted before it is run
+    :param sql: (str) SQL literal
+    :return: (str) SQL literal with every `%` doubled
+    """
+    return sql.replace('%', '%%')
+
+
+class Codec(object):
+    """
+    Base codec. Values are not validated and are formatted as they are.
+    """
+    data_type = None
+
+    def clean(self, value):
+        """
+        Validate a value and make it safe to put in a SQL query
+        :param value: value of the rule, never empty
+        :return: cleaned value
+        :raises ValueError: when the value is invalid for the data type
+        """
+        return value
+
+    def format(self, value):
+        """
+        Format a cleaned value (or a variable template keyword) as a SQL literal
+        :param value: cleaned value
+        :return: (str) SQL literal
+        """
+        return '{value}'.format(value=value)
+
+    def to_sql(self, value):
+        """
+        Validate and format a value in a single call. Empty values are formatted without validation.
+        :param value: value of the rule
+        :return: (str) SQL literal with `%` doubled
+        """
+        if value:
+            value = self.clean(value)
+        return escape_percent(self.format(value))
+
+    def invalid(self, value):
+        return ValueError('Invalid value -[{value}] for data_type - [{data_type}]'.format(
+            value=value, data_type=self.data_type
+        ))
+
+
+class QuotedCodec(Codec):
+    """
+    Codec for values put in quotes
+    """
+
+    def format(self, value):
+        return '\'{value}\''.format(value=value)
+
+
+class IntegerCodec(Codec):
+    data_type = 'integer'
+
+    def clean(self, value):
+        try:
+            int(value)
+        except (TypeError, ValueError):
+            raise self.invalid(value)
+        return value
+
+
+class StringCodec(QuotedCodec):
+    data_type = 'string'
+
+    def clean(self, value):
+        return MySQLdb.escape_string(value).decode('utf8')
+
+
+class DateCodec(QuotedCodec):
+    """
+    Dates in the format YYYY-MM-DD, month and day can have a single digit
+    """
+    data_type = 'date'
+    pattern = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$')
+
+    def clean(self, value):
+        match = self.pattern.match(value) if isinstance(value, str) else None
+        if not match:
+            raise self.invalid(value)
+        self._check(match.groups(), value)
+        return value
+
+    def _check(self, parts, value):
+        """
+        Check the ranges of the matched date parts, e.g. reject 2020-02-30
+        """
+        try:
+            datetime.datetime(*[int(part) for part in parts])
+        except ValueError:
+            raise self.invalid(value)
+
+
+class DateTimeCodec(DateCodec):
+    """
+    Datetimes in the format YYYY-MM-DDTHH:MM:SS or dates in the format YYYY-MM-DD
+    """
+    data_type = 'datetime'
+    pattern = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})(?:T(\d{1,2}):(\d{1,2}):(\d{1,2}))?$')
+
+    def _check(self, parts, value):
+        super(DateTimeCodec, self)._check([part for part in parts if part is not None], value)
+
+
+class BooleanCodec(Codec):
+    """
+    Accepts the boolean literals of MySQL: TRUE and FALSE in any case, and integers, where 0 is false and any
+    other integer is true. Python bools are accepted as TRUE and FALSE.
+    """
+    data_type = 'boolean'
+    values = frozenset(['TRUE', 'FALSE'])
+    pattern = re.compile(r'^\s*[+-]?\d+\s*$')
+
+    def clean(self, value):
+        if str(value).upper() not in self.values and not self.pattern.match(str(value)):
+            raise self.invalid(value)
+        return value
+
+
+class NullBooleanCodec(BooleanCodec):
+    """
+    Accepts NULL in any case as well as the values of BooleanCodec
+    """
+    data_type = 'nullboolean'
+    values = BooleanCodec.values | frozenset(['NULL'])
+
+
+class ChoiceCodec(Codec):
+    """
+    Integer choices are formatted as they are, other choices are escaped and put in quotes
+    """
+    data_type = 'choice'
+
+    @staticmethod
+    def _is_integer(value):
+        try:
+            int(value)
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    def clean(self, value):
+        if isinstance(value, str) and not self._is_integer(value):
+            return MySQLdb.escape_string(value).decode('utf8')
+        return value
+
+    def format(self, value):
+        if self._is_integer(value):
+            return '{value}'.format(value=value)
+        return '\'{value}\''.format(value=value)
+
+    def to_sql(self, value):
+        if self._is_integer(value):
+            return '{value}'.format(value=value)
+        if isinstance(value, str):
+            value = MySQLdb.escape_string(value).decode('utf8')
+        return escape_percent('\'{value}\''.format(value=value))
+
+
+class MultiChoiceCodec(ChoiceCodec):
+    data_type = 'multichoice'
+
+
+PASSTHROUGH_CODEC = Codec()
+
+# data type -> codec
+_CODECS = {}
+
+
+def register_codec(codec, data_type=None):
+    """
+    Register the codec used for a data type, replacing the codec registered before.
+    Generators resolve the codecs of their fields when they are created, register codecs before that.
+    :param codec: (Codec) codec instance
+    :param data_type: (str|None) data type, defaults to codec.data_type
+    :return: None
+    """
+    data_type = data_type or codec.data_type
+    assert data_type, 'Data type is required to register a codec'
+    _CODECS[data_type] = codec
+
+
+def get_codec(data_type):
+    """
+    Get the codec of a data type
+    :param data_type: (str) data type
+    :return: (Codec) registered codec or a passthrough codec when the data type has no codec
+    """
+    return _CODECS.get(data_type, PASSTHROUGH_CODEC)
+
+
+for _codec in (IntegerCodec(), StringCodec(), DateCodec(), DateTimeCodec(), BooleanCodec(), NullBooleanCodec(),
+               ChoiceCodec(), MultiChoiceCodec()):
+    register_codec(_codec)
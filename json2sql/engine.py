@@ -1,11 +1,24 @@
-import datetime
+import heapq
 import json
 import logging
 import re
+import sys
 
 import MySQLdb
 
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
+from contextlib import contextmanager
+
+from json2sql.cache import DependencyCache
+from json2sql.codecs import escape_percent, get_codec
+from json2sql.materialization import FRAGMENT_CUSTOM_METHOD, FRAGMENT_SUBQUERY, MATERIALIZED_FRAGMENT_DEPENDENCY
+from json2sql.prepared import NOW_SLOT, PreparedRule, slot
+from json2sql.records import (
+    ChallengeCheckRecord, CustomMethodRecord, FieldRecord, FieldStatisticsRecord, PathRecord, SubqueryRecord, VariableTemplateRecord,
+    DEFAULT_RECORD_POOL, intern_value
+)
+from json2sql.sampling import SAMPLING_MODULO, get_sample_filter
+from json2sql.tracing import KB_VERSION_TAG, SUBQUERY_TAG, tag_sql
 
 logger = logging.getLogger(u'JSON2SQLGenerator')
 
@@ -65,6 +78,13 @@ class JSON2SQLGenerator(object):
     ENDS_WITH = 'ends_with'
     HAS_SUBSTRING = 'has_substring'
     LIKE_OPERATORS = (STARTS_WITH, ENDS_WITH, HAS_SUBSTRING, )
+    # Characters with a special meaning in LIKE patterns, escaped so they match literally.
+    # The codec doubles `%` afterwards, as the generated SQL is always %-formatted.
+    LIKE_ESCAPES = (('\\', '\\\\'), ('%', '\\%'), ('_', '\\_'))
+
+    # Shortest term searched with MATCH ... AGAINST on fulltext fields, shorter terms are not indexed by
+    # MySQL (innodb_ft_min_token_size) so they fall back to LIKE
+    FULLTEXT_MIN_TOKEN_SIZE = 3
 
     # Supported dynamic values
     DYNAMIC_DATE = 'DYNAMIC_DATE'
@@ -135,8 +155,15 @@ class JSON2SQLGenerator(object):
     PARENT_TABLE = 'parent_table'
     PARENT_COLUMN = 'parent_column'
 
-    CHALLENGE_CHECK_QUERY = 'EXISTS (SELECT 1 FROM journeys_memberstagechallenge WHERE challenge_id = {value} AND ' \
-                            'completed_date IS NOT NULL AND member_id = patients_member.id) '
+    CHALLENGE_CHECK_QUERY = 'EXISTS (SELECT 1 FROM {table} WHERE {challenge_condition} AND ' \
+                            '{completed_column} IS NOT NULL AND {member_column} = {correlated_table}.{correlated_column}' \
+                            '{group_by_phrase}) '
+    # Table and columns used by challenge checks unless the knowledge base configures them
+    DEFAULT_CHALLENGE_CHECK = ChallengeCheckRecord(
+        table='journeys_memberstagechallenge', challenge_column='challenge_id', completed_column='completed_date',
+        member_column='member_id', correlated_table='patients_member', correlated_column='id',
+    )
+    CHALLENGE_OPERATORS = ('is_challenge_completed', 'is_challenge_not_completed')
 
     # - Used in custom method mapping -
     TEMPLATE_STR_KEY = 'template_str'
@@ -153,15 +180,79 @@ class JSON2SQLGenerator(object):
     VARIABLE_TEMPLATE_KEYWORD = 'variable_template_keyword'
     VARIABLE_TEMPLATE_RETURN_TYPE = 'variable_template_return_type'
 
-    def __init__(self, data):
+    # Select modes of generate_sql
+    SELECT_MODE_COUNT = 'count'
+    SELECT_MODE_MEMBER_IDS = 'member_ids'
+    SELECT_MODES = (SELECT_MODE_COUNT, SELECT_MODE_MEMBER_IDS)
+    # Name of the keyset pagination parameter in member ids mode, used as %(last_id)s in the SQL
+    LAST_ID_PARAM = 'last_id'
+    DEFAULT_PAGE_SIZE = 10000
+
+    # Cardinality of a path: how many join table rows match a single parent table row
+    ONE_TO_ONE = 'one_to_one'
+    MANY_TO_ONE = 'many_to_one'
+    ONE_TO_MANY = 'one_to_many'
+    CARDINALITIES = (ONE_TO_ONE, MANY_TO_ONE, ONE_TO_MANY)
+    # Joins which never match more than one join table row per parent table row
+    NON_FANNING_CARDINALITIES = (ONE_TO_ONE, MANY_TO_ONE)
+    # Weight of paths without a weight, so unweighted join trees are compared by their number of joins
+    DEFAULT_PATH_WEIGHT = 1
+
+    # Attributes holding the parsed and validated knowledge base
+    KNOWLEDGE_BASE_ATTRIBUTES = (
+        'field_mapping', 'path_mapping', 'custom_methods', 'subquery_mapping', 'variable_templates',
+        'field_statistics', 'challenge_check',
+    )
+
+    # Kinds of knowledge base entries cached artifacts can depend on
+    FIELD_DEPENDENCY = 'field'
+    TABLE_DEPENDENCY = 'table'
+    CUSTOM_METHOD_DEPENDENCY = 'custom_method'
+    SUBQUERY_DEPENDENCY = 'subquery'
+    VARIABLE_TEMPLATE_DEPENDENCY = 'variable_template'
+    CHALLENGE_CHECK_DEPENDENCY = 'challenge_check'
+    MATERIALIZED_FRAGMENT_DEPENDENCY = MATERIALIZED_FRAGMENT_DEPENDENCY
+
+    # Default maximum number of entries in each of the caches
+    DEFAULT_CACHE_SIZE = 1024
+    # A rule has many condition fragments, so the fragment cache holds this many entries per cached rule
+    FRAGMENTS_PER_RULE = 8
+    # Structural ids are dropped once there are this many of them per fragment cache entry
+    FRAGMENT_IDS_PER_CACHE_ENTRY = 16
+
+    # Conditions whose data is a list of nested conditions
+    COMBINATION_CONDITIONS = (AND_CONDITION, OR_CONDITION, NOT_CONDITION, EXISTS_CONDITION)
+
+    # Estimated cost of evaluating a predicate per row, cheapest first
+    COST_CHEAP = 'cheap'
+    COST_NORMAL = 'normal'
+    COST_EXPENSIVE = 'expensive'
+    COST_SUBQUERY = 'subquery'
+    COST_CLASSES = (COST_CHEAP, COST_NORMAL, COST_EXPENSIVE, COST_SUBQUERY)
+    # Operators scanning the whole value of every row instead of comparing it
+    EXPENSIVE_OPERATORS = (ENDS_WITH, HAS_SUBSTRING, 'verifies_regex')
+    # Fraction of rows matched by predicates without field statistics
+    DEFAULT_EQUALITY_SELECTIVITY = 0.1
+    DEFAULT_SELECTIVITY = 1 / 3.0
+
+    def __init__(self, data, cache_size=DEFAULT_CACHE_SIZE, record_pool=None):
         """
         Initialise basic params.
         : param data: (dict) dict containing following keys:
                         custom_methods: (tuple) tuple of tuples containing (id, sql_template, variables)
+                        field_statistics: (tuple) optional, tuple of tuples containing
+                                (field_identifier, distinct_count, null_fraction, cost_class).
+                                Used to order the conditions of AND and OR, see _order_conditions.
+                        challenge_check: (dict) optional, table and columns used by challenge checks,
+                                any of the fields of ChallengeCheckRecord. DEFAULT_CHALLENGE_CHECK by default.
                         field_mapping: (tuple) tuple of tuples containing (field_identifier, field_name, table_name).
                         paths: (tuple) tuple of tuples containing (join_table, join_field, parent_table, parent_field).
                                 Information about paths from a model to reach to a specific model and when to stop.
                         subqueries: (tuple) tuple of tuples containing (id, is_sql, template, fields, parameters).
+        :param cache_size: (int) Maximum number of compiled rules, condition fragments and join path resolutions
+                           to keep. 0 disables caching.
+        :param record_pool: (RecordPool) pool sharing field and path records with other generators,
+                            DEFAULT_RECORD_POOL by default (see json2sql.records)
         :return: None
         """
         assert 'field_mapping' in data, 'Field mapping key is required in data when initializing params'
@@ -170,12 +261,336 @@ class JSON2SQLGenerator(object):
         assert 'subqueries' in data, 'Subqueries key is required in data when initializing params'
         assert 'variable_templates' in data, 'Variable Templates key is required in data when initializing params'
 
+        self.record_pool = record_pool if record_pool is not None else DEFAULT_RECORD_POOL
+        self._initialize_state({
+            'field_mapping': self._parse_field_mapping(data.get('field_mapping')),
+            'path_mapping': self._parse_multi_path_mapping(data.get('paths')),
+            'custom_methods': self._validate_custom_methods(data.get('custom_methods')),
+            'subquery_mapping': self._parse_subquery_mapping(data.get('subqueries')),
+            'variable_templates': self._parse_variable_templates(data.get('variable_templates')),
+            'field_statistics': self._parse_field_statistics(data.get('field_statistics', ())),
+            'challenge_check': self._parse_challenge_check(data.get('challenge_check', {})),
+        }, cache_size)
+
+    @classmethod
+    def from_knowledge_base(cls, knowledge_base, cache_size=DEFAULT_CACHE_SIZE, record_pool=None):
+        """
+        Create generator from a knowledge base that is already parsed and validated, skipping all the validation.
+        :param knowledge_base: (dict) dict returned by export_knowledge_base
+        :param cache_size: (int) Maximum number of compiled rules and join path resolutions to keep
+        :param record_pool: (RecordPool) pool the records of the knowledge base were shared through, used for
+                            fields and paths added later. DEFAULT_RECORD_POOL by default.
+        :return: (JSON2SQLGenerator) generator instance
+        """
+        generator = cls.__new__(cls)
+        generator.record_pool = record_pool if record_pool is not None else DEFAULT_RECORD_POOL
+        generator._initialize_state(knowledge_base, cache_size)
+        return generator
+
+    def export_knowledge_base(self):
+        """
+        Export the parsed and validated knowledge base. Used to create snapshots (see json2sql.snapshot)
+        :return: (dict) dict containing every attribute in KNOWLEDGE_BASE_ATTRIBUTES
+        """
+        return {attribute: getattr(self, attribute) for attribute in self.KNOWLEDGE_BASE_ATTRIBUTES}
+
+    def iter_records(self):
+        """
+        Iterate over the field and path records of the knowledge base, the records shared through record_pool
+        :return: (generator) FieldRecord and PathRecord instances
+        """
+        for record in self.field_mapping.values():
+            yield record
+        for parents in self.path_mapping.values():
+            for record in parents.values():
+                yield record
+
+    def add_field(self, field_identifier, field_name, table_name, data_type, fulltext=False):
+        """
+        Add a field to field mapping
+        :param field_identifier: (int|str) Identifier used in the JSON rules
+        :param field_name: (str) Column name in the DB
+        :param table_name: (str) Table name in the DB
+        :param data_type: (str) Data type of the field
+        :param fulltext: (bool) True if the column has a FULLTEXT index
+        :return: None
+        """
+        assert field_identifier not in self.field_mapping, 'Field identifier must be unique'
+        self.update_field(field_identifier, field_name, table_name, data_type, fulltext)
+
+    def update_field(self, field_identifier, field_name, table_name, data_type, fulltext=False):
+        """
+        Add or replace a field in field mapping and drop compiled rules using it
+        """
+        field_identifier = intern_value(field_identifier)
+        self.field_mapping[field_identifier] = self._parse_field(field_name, table_name, data_type, fulltext)
+        self.field_codecs[field_identifier] = get_codec(data_type)
+        self.invalidate_caches((self.FIELD_DEPENDENCY, field_identifier))
+
+    def remove_field(self, field_identifier):
+        """
+        Remove a field from field mapping and drop compiled rules using it
+        """
+        assert field_identifier in self.field_mapping, 'Unknown field identifier'
+        del self.field_mapping[field_identifier]
+        del self.field_codecs[field_identifier]
+        self.invalidate_caches((self.FIELD_DEPENDENCY, field_identifier))
+
+    def add_path(self, join_table, join_field, parent_table, parent_field, join_table_active_field=None,
+                 cardinality=None, weight=None):
+        """
+        Add a path from join table to parent table
+        :param join_table: (str) Table that has to reach the base table
+        :param join_field: (str) Column of the join table used in the join condition
+        :param parent_table: (str) Next table on the way to the base table
+        :param parent_field: (str) Column of the parent table used in the join condition
+        :param join_table_active_field: (str|None) Column of the join table marking the row as active
+        :param cardinality: (str|None) One of CARDINALITIES, None when unknown
+        :param weight: (int|float|None) Cost of the join, e.g. estimated rows, see _extract_cheapest_paths_subset
+        :return: None
+        """
+        assert parent_table not in self.path_mapping.get(join_table, {}), 'Joins with multiple fields is not supported'
+        self.update_path(
+            join_table, join_field, parent_table, parent_field, join_table_active_field, cardinality, weight
+        )
+
+    def update_path(self, join_table, join_field, parent_table, parent_field, join_table_active_field=None,
+                    cardinality=None, weight=None):
+        """
+        Add or replace a path and drop join path resolutions and compiled rules using either of the tables
+        """
+        join_table, parent_table = sys.intern(join_table), sys.intern(parent_table)
+        self.path_mapping[join_table][parent_table] = self._parse_path(
+            join_field, parent_field, join_table_active_field, cardinality, weight
+        )
+        self.invalidate_caches((self.TABLE_DEPENDENCY, join_table), (self.TABLE_DEPENDENCY, parent_table))
+
+    def remove_path(self, join_table, parent_table):
+        """
+        Remove a path and drop join path resolutions and compiled rules using either of the tables
+        """
+        assert parent_table in self.path_mapping.get(join_table, {}), 'Unknown path'
+        del self.path_mapping[join_table][parent_table]
+        if not self.path_mapping[join_table]:
+            del self.path_mapping[join_table]
+        self.invalidate_caches((self.TABLE_DEPENDENCY, join_table), (self.TABLE_DEPENDENCY, parent_table))
+
+    def add_custom_method(self, template_id, template_str, parameters):
+        """
+        Add a custom method
+        :param template_id: (int|str) Identifier of the custom method
+        :param template_str: (str) SQL template
+        :param parameters: (str|dict) JSON of parameters used in the template
+        :return: None
+        """
+        assert template_id not in self.custom_methods, 'Template id must be unique'
+        self.update_custom_method(template_id, template_str, parameters)
+
+    def update_custom_method(self, template_id, template_str, parameters):
+        """
+        Add or replace a custom method and drop compiled rules using it
+        """
+        self.custom_methods[template_id] = self._validate_custom_method(template_str, parameters)
+        self.invalidate_caches((self.CUSTOM_METHOD_DEPENDENCY, template_id))
+
+    def remove_custom_method(self, template_id):
+        """
+        Remove a custom method and drop compiled rules using it
+        """
+        assert template_id in self.custom_methods, 'Unknown template id'
+        del self.custom_methods[template_id]
+        self.invalidate_caches((self.CUSTOM_METHOD_DEPENDENCY, template_id))
+
+    def add_subquery(self, subquery_id, is_sql, template_str, fields, parameters):
+        """
+        Add a subquery
+        :param subquery_id: (int|str) Identifier of the subquery
+        :param is_sql: (bool) True if template is a SQL string, False if it is a JSON rule
+        :param template_str: (str|dict) SQL template or JSON of the rule
+        :param fields: (str|dict) JSON of the select fields
+        :param parameters: (str|dict) JSON of parameters used in the SQL template
+        :return: None
+        """
+        assert subquery_id not in self.subquery_mapping, 'Subquery id must be unique'
+        self.update_subquery(subquery_id, is_sql, template_str, fields, parameters)
+
+    def update_subquery(self, subquery_id, is_sql, template_str, fields, parameters):
+        """
+        Add or replace a subquery and drop compiled rules using it
+        """
+        subquery = self._parse_subquery(is_sql, template_str, fields, parameters)
+        self._validate_subquery(subquery)
+        self.subquery_mapping[subquery_id] = subquery
+        self.invalidate_caches((self.SUBQUERY_DEPENDENCY, subquery_id))
+
+    def remove_subquery(self, subquery_id):
+        """
+        Remove a subquery and drop compiled rules using it
+        """
+        assert subquery_id in self.subquery_mapping, 'Unknown subquery id'
+        del self.subquery_mapping[subquery_id]
+        self.invalidate_caches((self.SUBQUERY_DEPENDENCY, subquery_id))
+
+    def add_variable_template(self, unique_id, keyword, return_type):
+        """
+        Add a variable template
+        :param unique_id: (int|str) Identifier of the variable template
+        :param keyword: (str) Keyword placed in the SQL
+        :param return_type: (str) Data type of the value of the keyword
+        :return: None
+        """
+        assert str(unique_id) not in self.variable_templates, 'Variable template id must be unique'
+        self.update_variable_template(unique_id, keyword, return_type)
+
+    def update_variable_template(self, unique_id, keyword, return_type):
+        """
+        Add or replace a variable template and drop compiled rules using it
+        """
+        unique_id = sys.intern(str(unique_id))
+        self.variable_templates[unique_id] = self._parse_variable_template(keyword, return_type)
+        self.invalidate_caches((self.VARIABLE_TEMPLATE_DEPENDENCY, unique_id))
+
+    def remove_variable_template(self, unique_id):
+        """
+        Remove a variable template and drop compiled rules using it
+        """
+        unique_id = str(unique_id)
+        assert unique_id in self.variable_templates, 'Unknown variable template id'
+        del self.variable_templates[unique_id]
+        self.invalidate_caches((self.VARIABLE_TEMPLATE_DEPENDENCY, unique_id))
+
+    def update_field_statistics(self, field_identifier, distinct_count=None, null_fraction=0.0, cost_class=None):
+        """
+        Add or replace the statistics of a field and drop compiled rules using the field
+        :param field_identifier: (int|str) Identifier used in the JSON rules
+        :param distinct_count: (int|None) Number of distinct values of the column
+        :param null_fraction: (float) Fraction of rows where the column is NULL
+        :param cost_class: (str|None) One of COST_CLASSES, cost of comparing the column
+        :return: None
+        """
+        field_identifier = intern_value(field_identifier)
+        self.field_statistics[field_identifier] = self._parse_single_field_statistics(
+            distinct_count, null_fraction, cost_class
+        )
+        self._field_statistics_version += 1
+        self.invalidate_caches((self.FIELD_DEPENDENCY, field_identifier))
+
+    def remove_field_statistics(self, field_identifier):
+        """
+        Remove the statistics of a field and drop compiled rules using the field
+        """
+        assert field_identifier in self.field_statistics, 'Unknown field identifier'
+        del self.field_statistics[field_identifier]
+        self._field_statistics_version += 1
+        self.invalidate_caches((self.FIELD_DEPENDENCY, field_identifier))
+
+    def update_challenge_check(self, **config):
+        """
+        Change the table or columns used by challenge checks and drop compiled rules using challenge checks
+        :param config: fields of ChallengeCheckRecord to change, e.g. table='journeys_challengecompletion'
+        :return: None
+        """
+        self.challenge_check = self._parse_challenge_check(dict(self.challenge_check._asdict(), **config))
+        self.invalidate_caches((self.CHALLENGE_CHECK_DEPENDENCY, None))
+
+    def invalidate_caches(self, *dependencies):
+        """
+        Drop cached artifacts built from any of the given knowledge base entries
+        :param dependencies: (tuple) tuples of (dependency kind, identifier), e.g. (FIELD_DEPENDENCY, 12)
+        :return: None
+        """
+        self._rule_cache.invalidate(dependencies)
+        self._fragment_cache.invalidate(dependencies)
+        self._path_cache.invalidate(dependencies)
+        self._materialized_subquery_cache.invalidate(dependencies)
+
+    def clear_caches(self):
+        """
+        Drop every cached artifact
+        """
+        self._rule_cache.clear()
+        self._fragment_cache.clear()
+        self._path_cache.clear()
+        self._materialized_subquery_cache.clear()
+        self._fragment_ids.clear()
+        self._reused_fragment_ids.clear()
+
+    @contextmanager
+    def _collect_dependencies(self):
+        """
+        Collect the knowledge base entries used inside the block.
+        Collected dependencies are added to the enclosing block as well, so a compiled rule depends on
+        everything used by its subqueries and join path resolution.
+        """
+        dependencies = set()
+        self._dependency_stack.append(dependencies)
+        try:
+            yield dependencies
+        finally:
+            self._dependency_stack.pop()
+            self._track_dependencies(dependencies)
+
+    def _track_dependencies(self, dependencies):
+        """
+        Record knowledge base entries used by the artifact being compiled
+        :param dependencies: (iterable) tuples of (dependency kind, identifier)
+        """
+        if self._dependency_stack:
+            self._dependency_stack[-1].update(dependencies)
+
+    def _get_field(self, field):
+        """
+        Get the record of a field from self.field_mapping and record the dependency on it
+        :param field: (int|string) Field identifier that is used as key in self.field_mapping
+        :return: (FieldRecord) field record
+        """
+        field_data = self.field_mapping[field]
+        # Called for every field in a rule, so add to the collected set directly
+        if self._dependency_stack:
+            self._dependency_stack[-1].add((self.FIELD_DEPENDENCY, field))
+        return field_data
+
+    def _initialize_state(self, knowledge_base, cache_size):
+        """
+        Set the knowledge base attributes and the mappings used while generating SQL.
+        :param knowledge_base: (dict) dict containing every attribute in KNOWLEDGE_BASE_ATTRIBUTES
+        :param cache_size: (int) Maximum number of entries in each of the caches
+        :return: None
+        """
         self.base_table = ''
-        self.field_mapping = self._parse_field_mapping(data.get('field_mapping'))
-        self.path_mapping = self._parse_multi_path_mapping(data.get('paths'))
-        self.custom_methods = self._validate_custom_methods(data.get('custom_methods'))
-        self.subquery_mapping = self._parse_subquery_mapping(data.get('subqueries'))
-        self.variable_templates = self._parse_variable_templates(data.get('variable_templates'))
+        for attribute in self.KNOWLEDGE_BASE_ATTRIBUTES:
+            setattr(self, attribute, knowledge_base[attribute])
+        # Codecs are process local (see json2sql.codecs.register_codec), so they are resolved
+        # here instead of being stored with the knowledge base
+        self.field_codecs = {
+            field_id: get_codec(field_data.data_type) for field_id, field_data in self.field_mapping.items()
+        }
+
+        # Compiled rules, condition fragments and join path resolutions
+        # along with the knowledge base entries they were built from
+        self._rule_cache = DependencyCache(cache_size)
+        self._fragment_cache = DependencyCache(cache_size * self.FRAGMENTS_PER_RULE)
+        self._path_cache = DependencyCache(cache_size)
+        # JSON subquery and parameters -> key of its materialized fragment, see _get_materialized_subquery
+        self._materialized_subquery_cache = DependencyCache(cache_size)
+        # Hash consing table: structural key of a condition subtree -> small integer id, see _get_fragment_id
+        self._fragment_ids = {}
+        # Ids of the subtrees that were seen more than once
+        self._reused_fragment_ids = set()
+        # id(condition data) -> (condition data, fragment id) for the condition tree being compiled
+        self._fragment_id_memo = None
+        # Stack of dependency sets being collected, see _collect_dependencies
+        self._dependency_stack = []
+        # True while compiling a PreparedRule, late bound values are written as slots instead of placeholders
+        self._prepared = False
+        # Optional MaterializationManager, see json2sql.materialization
+        self.materializer = None
+        # Number of NOT conditions around the condition being compiled
+        self._negation_depth = 0
+        # Bumped on every change of field_statistics, see _get_fragment_context
+        self._field_statistics_version = 0
+        # Version of the knowledge base put in the tags of traced SQL, see json2sql.tracing
+        self.knowledge_base_version = None
 
         # Mapping to be used to parse various combination keywords data
         self.WHERE_CONDITION_MAPPING = {
@@ -200,46 +615,52 @@ class JSON2SQLGenerator(object):
         Validate the template data and pre process the data.
 
         :param sql_templates: (tuple) tuple of tuples containing (id, sql_template, variables)
-        :return: (dict) { template_id: { template_str:, template_parameters: }
+        :return: (dict) { template_id: CustomMethodRecord(template_str, parameters) }
         """
         template_mapping = {}
 
         for template_id, template_str, parameters in sql_templates:
-            parameters = json.loads(parameters)
-            template_str = template_str.strip()
-
-            assert template_str, 'Not a valid template string'
             assert template_id not in template_mapping, 'Template id must be unique'
-            template_defined_variables = set(re.findall(self.TEMPLATE_KEY_REGEX, template_str, re.MULTILINE))
-            # Checks if variable defined in template string and variables declared are exactly same
-            assert not set(parameters.keys()) ^ template_defined_variables, 'Extra variable defined'
-            # Checks parameter types are permitted
-            assert not {
-                l['data_type'] for l in parameters.values()
-            } - self.ALLOWED_CUSTOM_METHOD_PARAM_TYPES, 'Invalid data type defined'
-
-            template_mapping[template_id] = {
-                self.TEMPLATE_STR_KEY: template_str,
-                self.TEMPLATE_PARAMS_KEY: parameters
-            }
+            template_mapping[template_id] = self._validate_custom_method(template_str, parameters)
 
         return template_mapping
 
+    def _validate_custom_method(self, template_str, parameters):
+        """
+        Validate a single custom method.
+
+        :param template_str: (str) SQL template
+        :param parameters: (str|dict) JSON of parameters used in the template
+        :return: (CustomMethodRecord) validated custom method
+        """
+        if not isinstance(parameters, dict):
+            parameters = json.loads(parameters)
+        template_str = template_str.strip()
+
+        assert template_str, 'Not a valid template string'
+        template_defined_variables = set(re.findall(self.TEMPLATE_KEY_REGEX, template_str, re.MULTILINE))
+        # Checks if variable defined in template string and variables declared are exactly same
+        assert not set(parameters.keys()) ^ template_defined_variables, 'Extra variable defined'
+        # Checks parameter types are permitted
+        assert not {
+            l['data_type'] for l in parameters.values()
+        } - self.ALLOWED_CUSTOM_METHOD_PARAM_TYPES, 'Invalid data type defined'
+
+        return CustomMethodRecord(template_str, parameters)
+
     def _validate_subquery(self, subquery):
         """
         Validate the sub-query data.
-        :param subquery: (dict) Sub-Query dict containing (id, template, fields, parameters, is_sql)
+        :param subquery: (SubqueryRecord) Sub-Query record containing (template, parameters, fields, is_sql)
         :return:
         """
-        assert isinstance(
-            subquery[self.SUBQUERY_FIELDS_KEY], dict
-        ), 'Sub-Query fields is not a valid json data'
-        if subquery[self.SUBQUERY_IS_SQL]:
+        assert isinstance(subquery.fields, dict), 'Sub-Query fields is not a valid json data'
+        if subquery.is_sql:
             template_variables = set(
-                re.findall(self.TEMPLATE_KEY_REGEX, subquery[self.SUBQUERY_STR_KEY], re.MULTILINE)
+                re.findall(self.TEMPLATE_KEY_REGEX, subquery.template_str, re.MULTILINE)
             )
             if template_variables:
-                parameters = subquery[self.SUBQUERY_PARAMS_KEY]
+                parameters = subquery.parameters
                 assert isinstance(parameters, dict), 'Sub-Query parameters is not a valid json data'
                 # Checks if variable defined in template string and variables declared are exactly same
                 assert not set(parameters.keys()) ^ template_variables, 'Extra variable defined'
@@ -248,47 +669,99 @@ class JSON2SQLGenerator(object):
                     l['data_type'] for l in parameters.values()
                 } - self.ALLOWED_CUSTOM_METHOD_PARAM_TYPES, 'Invalid data type defined'
         else:
-            assert isinstance(
-                subquery[self.SUBQUERY_STR_KEY], dict
-            ), 'Sub-Query template is not a valid json data'
+            assert isinstance(subquery.template_str, dict), 'Sub-Query template is not a valid json data'
 
     def _parse_subquery_mapping(self, subqueries):
         """
         Validate the template data and pre process the data.
 
-        :param subqueries: (tuple) tuple of tuples containing (id, sql_template, variables)
-        :return: (dict) { template_id: { template_str:, template_parameters: }
+        :param subqueries: (tuple) tuple of tuples containing (id, is_sql, sql_template, fields, variables)
+        :return: (dict) { subquery_id: SubqueryRecord(template_str, parameters, fields, is_sql) }
         """
         subquery_mapping = {}
         for subquery_id, is_sql, template_str, fields, parameters in subqueries:
-            parameters = json.loads(parameters)
-            fields = json.loads(fields)
-
-            if not is_sql:
-                template_str = json.loads(template_str)
             assert subquery_id not in subquery_mapping, 'Subquery id must be unique'
-
-            subquery_mapping[subquery_id] = {
-                self.SUBQUERY_STR_KEY: template_str,
-                self.SUBQUERY_PARAMS_KEY: parameters,
-                self.SUBQUERY_FIELDS_KEY: fields,
-                self.SUBQUERY_IS_SQL: is_sql
-            }
+            subquery_mapping[subquery_id] = self._parse_subquery(is_sql, template_str, fields, parameters)
         return subquery_mapping
 
+    def _parse_subquery(self, is_sql, template_str, fields, parameters):
+        """
+        Decode a single subquery.
+
+        :param is_sql: (bool) True if template is a SQL string, False if it is a JSON rule
+        :param template_str: (str|dict) SQL template or JSON of the rule
+        :param fields: (str|dict) JSON of the select fields
+        :param parameters: (str|dict) JSON of parameters used in the SQL template
+        :return: (SubqueryRecord) subquery record
+        """
+        if not isinstance(parameters, dict):
+            parameters = json.loads(parameters)
+        if not isinstance(fields, dict):
+            fields = json.loads(fields)
+        if not is_sql and not isinstance(template_str, dict):
+            template_str = json.loads(template_str)
+        return SubqueryRecord(template_str, parameters, fields, is_sql)
+
     def _parse_variable_templates(self, variable_templates):
         """
         Converts tuple of tuples to dict.
         :param variable_templates: (tuple) tuple of tuples containing (unique_id, keyword, return_type)
-        :return: (dict) { unique_id: { variable_template_keyword:<value>, variable_template_return_type:<value> }
+        :return: (dict) { unique_id: VariableTemplateRecord(keyword, return_type) }
         """
         return {
-            str(unique_id): {
-                self.VARIABLE_TEMPLATE_KEYWORD: keyword,
-                self.VARIABLE_TEMPLATE_RETURN_TYPE: return_type,
-            } for unique_id, keyword, return_type in variable_templates
+            sys.intern(str(unique_id)): self._parse_variable_template(keyword, return_type)
+            for unique_id, keyword, return_type in variable_templates
         }
 
+    def _parse_variable_template(self, keyword, return_type):
+        """
+        Create the record for a single variable template.
+        :return: (VariableTemplateRecord) variable template record
+        """
+        return VariableTemplateRecord(intern_value(keyword), intern_value(return_type))
+
+    def _parse_field_statistics(self, field_statistics):
+        """
+        Converts tuple of tuples to dict.
+        :param field_statistics: (tuple) tuple of tuples containing
+                                 (field_identifier, distinct_count, null_fraction, cost_class)
+        :return: (dict) { field_identifier: FieldStatisticsRecord(distinct_count, null_fraction, cost_class) }
+        """
+        result = {}
+        for field_identifier, distinct_count, null_fraction, cost_class in field_statistics:
+            field_identifier = intern_value(field_identifier)
+            assert field_identifier not in result, 'Field statistics must be unique'
+            result[field_identifier] = self._parse_single_field_statistics(distinct_count, null_fraction, cost_class)
+        return result
+
+    def _parse_single_field_statistics(self, distinct_count, null_fraction, cost_class):
+        """
+        Create the record for the statistics of a single field.
+        :return: (FieldStatisticsRecord) field statistics record
+        """
+        assert distinct_count is None or int(distinct_count) > 0, 'Distinct count must be positive'
+        null_fraction = float(null_fraction or 0.0)
+        assert 0.0 <= null_fraction <= 1.0, 'Null fraction must be between 0 and 1'
+        assert cost_class is None or cost_class in self.COST_CLASSES, 'Invalid cost class: {cost_class}'.format(
+            cost_class=cost_class
+        )
+        return FieldStatisticsRecord(
+            None if distinct_count is None else int(distinct_count), null_fraction, intern_value(cost_class)
+        )
+
+    def _parse_challenge_check(self, config):
+        """
+        Create the challenge check configuration, missing values are taken from DEFAULT_CHALLENGE_CHECK
+        :param config: (dict) fields of ChallengeCheckRecord
+        :return: (ChallengeCheckRecord) challenge check record
+        """
+        assert not set(config) - set(ChallengeCheckRecord._fields), 'Invalid challenge check keys: {keys}'.format(
+            keys=', '.join(sorted(set(config) - set(ChallengeCheckRecord._fields)))
+        )
+        for name in config.values():
+            assert re.match(r'^\w+$', name), 'Invalid challenge check table or column: {name}'.format(name=name)
+        return self.DEFAULT_CHALLENGE_CHECK._replace(**{key: sys.intern(value) for key, value in config.items()})
+
     def _parse_custom_method_condition(self, data):
         """
         Process the custom method condition to render SQL template using the arguments given.
@@ -300,21 +773,32 @@ class JSON2SQLGenerator(object):
         assert 'template_id' in data, 'No template_id is provided'
         template_id = data['template_id']
         template_data = self.custom_methods[template_id]
+        self._track_dependencies(((self.CUSTOM_METHOD_DEPENDENCY, template_id), ))
 
         # Process parameters
         validated_parameters = {}
         for param_id, param_data in data.get('parameters', {}).items():
-            assert param_id in template_data[self.TEMPLATE_PARAMS_KEY], 'Invalid parameter name.'
-            param_type = template_data[self.TEMPLATE_PARAMS_KEY][param_id]['data_type']
+            assert param_id in template_data.parameters, 'Invalid parameter name.'
+            param_type = template_data.parameters[param_id]['data_type']
 
             validated_parameters[param_id] = self._process_parameter(param_type, param_data)
 
         # Check that we have collected all the required keys
-        template_params = template_data[self.TEMPLATE_PARAMS_KEY].keys()
+        template_params = template_data.parameters.keys()
         assert len(set(template_params) ^ set(validated_parameters.keys())) == 0, \
             'Missing or extra template variable'
 
-        return template_data[self.TEMPLATE_STR_KEY].format(**validated_parameters)
+        sql = template_data.template_str.format(**validated_parameters)
+        # The materialized table only holds the members matching the custom method, members where it is NULL
+        # would match NOT (id IN table) but not NOT (custom method)
+        if self._negation_depth:
+            return sql
+        table = self._get_materialized_table(FRAGMENT_CUSTOM_METHOD, sql)
+        if table is not None:
+            return u'`{base_table}`.`id` IN (SELECT `member_id` FROM `{table}`)'.format(
+                base_table=self.base_table, table=table
+            )
+        return sql
 
     def _process_parameter(self, data_type, parameter_data):
         assert len(data_type) > 0, 'Invalid data type'
@@ -323,17 +807,16 @@ class JSON2SQLGenerator(object):
         value = parameter_data.get('value')
         if value:
             data_type_upper = data_type.upper()
-            if data_type_upper != 'DATE':
+            # Boolean parameters take IS_OPERATOR_VALUE, e.g. NOT NULL, which the boolean codec doesn't accept
+            if data_type_upper not in ('DATE', 'BOOLEAN'):
                 self._sanitize_value(value, data_type.lower())
             if data_type_upper == 'FIELD':
-                field_data = self.field_mapping[parameter_data['field']]
-                return "`{table}`.`{field}`".format(
-                    table=field_data[self.TABLE_NAME], field=field_data[self.FIELD_NAME]
-                )
+                field_data = self._get_field(parameter_data['field'])
+                return "`{table}`.`{field}`".format(table=field_data.table_name, field=field_data.field_name)
             elif data_type_upper == 'INTEGER':
                 return int(value)
             elif data_type_upper == 'STRING':
-                return "'{value}'".format(value=self._sql_injection_proof(value))
+                return "'{value}'".format(value=escape_percent(self._sql_injection_proof(value)))
             elif data_type_upper == 'DATE':
                 return self._get_sql_value(value, data_type)
             elif data_type_upper == 'OPERATOR':
@@ -343,6 +826,8 @@ class JSON2SQLGenerator(object):
                 assert value in self.IS_OPERATOR_VALUE, 'Invalid value for boolean type'
                 return value
             elif data_type_upper == 'VARIABLE_TEMPLATE':
+                if self._prepared:
+                    return slot(self._sql_injection_proof(value))
                 return '{{{value}}}'.format(value=self._sql_injection_proof(value))
             else:
                 raise AttributeError(
@@ -369,25 +854,117 @@ class JSON2SQLGenerator(object):
                      Must contain two keys - fields(contains list of fields involved in SQL) and where_data(JSON data)
         :param base_table: (string) Exact table name as in DB to be used with FROM clause in SQL.
         :param select_fields: (dict) JSON containing select fields
-        :return: (unicode) Finalized SQL query unicode
-        """
+        :param select_mode: (str) SELECT_MODE_COUNT (default) to count the members or SELECT_MODE_MEMBER_IDS
+                            to select a page of member ids. Member ids are selected with keyset pagination:
+                            `base_table`.`id` > %(last_id)s ORDER BY `base_table`.`id` LIMIT <page_size>
+        :param page_size: (int) Number of member ids in a page, DEFAULT_PAGE_SIZE by default
+        :param base_table_filters: (list) SQL conditions on columns of the base table, e.g. an id range.
+                                   They are ANDed with the rule and pushed down into the subqueries, see
+                                   generate_subquery. The SQL is used as it is, never pass user input.
+        :param sample_rate: (float) Only evaluate the rule for a deterministic sample of this fraction of the base
+                            table ids, pushed down into the subqueries like base_table_filters. Scale the count
+                            up with json2sql.sampling.estimate_count.
+        :param sampling_method: (str) json2sql.sampling.SAMPLING_MODULO (default) or SAMPLING_HASH
+        :param trace_tags: (dict) Tags, e.g. {'rule_id': 42}, put in a comment at the start of the query and of
+                           the derived tables of the subqueries along with knowledge_base_version and the
+                           fingerprint of the SQL, see json2sql.tracing
+        :param prepared: (bool) Return a PreparedRule instead of SQL with `{keyword}` placeholders for
+                         variable templates, see json2sql.prepared. Raises ValueError when the rule uses a
+                         keyword which is not a variable template, its data type is unknown.
+        :return: (unicode|PreparedRule) Finalized SQL query unicode
+        """
+        if kwargs.pop('prepared', False):
+            return self._generate_prepared_rule(data, base_table, **kwargs)
 
         self.base_table = base_table
+        return self._compile_cached(self._generate_sql, data, base_table, **kwargs)
+
+    def _compile_cached(self, compile_rules, data, base_table, **kwargs):
+        """
+        Compile through the compiled rules cache. Rules of generate_sql are dicts and rule lists of
+        generate_multi_rule_sql are lists, so they never share a key.
+        :param compile_rules: (callable) compile_rules(data, base_table, **kwargs) -> SQL, e.g. _generate_sql
+        :return: (unicode) SQL
+        """
+        # Usage of materializable fragments is counted once per rule, not for the subqueries compiled inside it
+        materializer = None if self._dependency_stack else self.materializer
+        if not self._rule_cache.maxsize and materializer is None:
+            return compile_rules(data, base_table, **kwargs)
+
+        cache_key = repr((self._get_fragment_context(), data, sorted(kwargs.items())))
+        entry = self._rule_cache.lookup(cache_key)
+        if entry is not None:
+            sql, dependencies = entry
+            if materializer is None or materializer.record_usage(dependencies):
+                self._track_dependencies(dependencies)
+                return sql
+            # A materialized table used by the SQL expired, compile against the new materialization version
+            cache_key = repr((self._get_fragment_context(), data, sorted(kwargs.items())))
+
+        with self._collect_dependencies() as dependencies:
+            sql = compile_rules(data, base_table, **kwargs)
+        self._rule_cache.store(cache_key, sql, dependencies)
+        if materializer is not None and entry is None:
+            materializer.record_usage(dependencies)
+        return sql
+
+    def _generate_prepared_rule(self, data, base_table, **kwargs):
+        """
+        Compile the rule with slots for the late bound values. See generate_sql for the parameters.
+        :return: (PreparedRule) prepared rule
+        """
+        prepared = self._prepared
+        self._prepared = True
+        try:
+            sql = self.generate_sql(data, base_table, **kwargs)
+        finally:
+            self._prepared = prepared
+
+        slot_types = {template.keyword: template.return_type for template in self.variable_templates.values()}
+        slot_types[NOW_SLOT] = self.DATE_TIME
+        return PreparedRule(sql, slot_types)
+
+    def _generate_sql(self, data, base_table, **kwargs):
+        """
+        Create SQL query from provided json without looking into the compiled rules cache.
+        See generate_sql for the parameters.
+        """
         assert self.validate_where_data(data.get('where_data', {})), 'Invalid where data'
         where_phrase = self._generate_sql_condition(data['where_data'])
 
         if 'additional_where_clause' in kwargs:
             where_phrase = where_phrase + kwargs['additional_where_clause']
 
+        base_table_filters = self._get_base_table_filters(base_table, kwargs)
+        if base_table_filters:
+            where_phrase = u'({where_phrase}) AND {filters}'.format(
+                where_phrase=where_phrase, filters=self._join_filters(base_table_filters)
+            )
+
+        select_mode = kwargs.get('select_mode', self.SELECT_MODE_COUNT)
+        assert select_mode in self.SELECT_MODES, 'Unsupported select mode: {mode}'.format(mode=select_mode)
+        pagination_phrase = ''
+        if select_mode == self.SELECT_MODE_MEMBER_IDS:
+            assert not kwargs.get('select_fields'), 'Select fields can not be used with member ids select mode'
+            page_size = int(kwargs.get('page_size', self.DEFAULT_PAGE_SIZE))
+            assert page_size > 0, 'Page size must be positive'
+            id_filter = u'`{base_table}`.`id` > %({param})s'.format(base_table=base_table, param=self.LAST_ID_PARAM)
+            where_phrase = u'({where_phrase}) AND {id_filter}'.format(where_phrase=where_phrase, id_filter=id_filter)
+            # Subqueries only need the members of the page as well
+            base_table_filters.append(id_filter)
+            pagination_phrase = u' ORDER BY `{base_table}`.`id` LIMIT {page_size}'.format(
+                base_table=base_table, page_size=page_size
+            )
+
         if 'group_by_fields' in data:
             assert isinstance(data['group_by_fields'], list), 'Group by fields need to list of dict'
             data['group_by_fields'] = [x['field'] for x in data['group_by_fields']]
 
         path_subset = self.extract_paths_subset(
-            [self.field_mapping[field_id][self.TABLE_NAME] for field_id in data['fields']],
+            [self._get_field(field_id).table_name for field_id in data['fields']],
             data.get('path_hints', {})
         )
-        join_tables = self.create_join_path(path_subset, self.base_table)
+        join_tables = list(self.create_join_path(path_subset, self.base_table))
         join_phrase = self.generate_left_join(join_tables)
         group_by_phrase = self.generate_group_by(
             data.get('group_by_fields', []), data.get('having', {})
@@ -395,42 +972,183 @@ class JSON2SQLGenerator(object):
         alias_params = None
         if 'alias_params' not in kwargs:
             alias_params = self._generate_alias_params(data.get('sub_queries', []))
+        if data.get('sub_queries'):
+            base_table_filters.extend(self._get_pushdown_filters(data['where_data']))
+        trace_tags = self._get_trace_tags(kwargs.get('trace_tags'))
+        sub_query_phrase = self.generate_subquery(
+            data.get('sub_queries', []), kwargs.get('alias_params', alias_params), base_table_filters, trace_tags
+        )
+        select_phrase = self.generate_select_phrase(
+            kwargs.get('select_fields'), select_mode,
+            distinct=bool(data.get('sub_queries')) or not self.is_fan_out_free(join_tables)
+        )
+
+        sql = u'SELECT {select_phrase} FROM {base_table} {sub_query_phrase} {join_phrase}' \
+              u' WHERE {where_phrase} {group_by_fragment}{pagination_phrase}'.format(
+                  join_phrase=join_phrase,
+                  base_table=base_table,
+                  where_phrase=where_phrase,
+                  group_by_fragment=group_by_phrase,
+                  select_phrase=select_phrase,
+                  sub_query_phrase=sub_query_phrase,
+                  pagination_phrase=pagination_phrase
+              )
+        if trace_tags is not None:
+            return tag_sql(sql, trace_tags)
+        return sql
+
+    @staticmethod
+    def _get_base_table_filters(base_table, kwargs):
+        """
+        :param kwargs: (dict) keyword arguments of generate_sql
+        :return: (list) base_table_filters with the filter of sample_rate
+        """
+        base_table_filters = list(kwargs.get('base_table_filters') or ())
+        assert all(isinstance(sql_filter, str) for sql_filter in base_table_filters), \
+            'Base table filters must be SQL strings'
+        if kwargs.get('sample_rate') is not None:
+            sample_filter = get_sample_filter(
+                base_table, kwargs['sample_rate'], kwargs.get('sampling_method', SAMPLING_MODULO)
+            )
+            if sample_filter:
+                base_table_filters.append(sample_filter)
+        return base_table_filters
+
+    def _get_trace_tags(self, tags):
+        """
+        :param tags: (dict|None) trace_tags passed to generate_sql
+        :return: (list|None) tuples (tag name, value) to tag the SQL with, None when the SQL is not traced
+        """
+        if tags is None:
+            return None
+        return sorted(tags.items()) + [(KB_VERSION_TAG, self.knowledge_base_version)]
+
+    def generate_multi_rule_sql(self, rules, base_table, **kwargs):
+        """
+        Create a single SQL query counting the members matching each of the rules.
+        The query joins the union of the tables and subqueries required by the rules, so the database
+        scans and joins once for the whole set. Every rule becomes a column:
+            COUNT(DISTINCT CASE WHEN (<rule where phrase>) THEN `base_table`.`id` END) AS `<alias>`
+        DISTINCT is dropped when none of the joins can fan out, see is_fan_out_free.
+        The SQL is cached in the compiled rules cache like the SQL of generate_sql.
+
+        :param rules: (list) list of tuples (alias, data) where data has the same format as in generate_sql.
+                      Rules with group by fields or having clause are not supported.
+        :param base_table: (string) Exact table name as in DB to be used with FROM clause in SQL.
+        :param base_table_filters: (list) SQL conditions on columns of the base table, see generate_sql. They are
+                                   pushed down into the subqueries, the conditions of the rules are not as every
+                                   rule needs other rows of the subqueries.
+        :param sample_rate: (float) Only count a sample of the members, see generate_sql. Scale every count up
+                            with json2sql.sampling.estimate_count.
+        :param sampling_method: (str) json2sql.sampling.SAMPLING_MODULO (default) or SAMPLING_HASH
+        :param trace_tags: (dict) Tags put in a comment at the start of the query and of the derived tables of the
+                           subqueries, see generate_sql
+        :return: (unicode) Finalized SQL query unicode
+        """
+        assert rules, 'At least one rule is required'
+        self.base_table = base_table
+        return self._compile_cached(self._generate_multi_rule_sql, rules, base_table, **kwargs)
+
+    def _generate_multi_rule_sql(self, rules, base_table, **kwargs):
+        """
+        Create the SQL query of generate_multi_rule_sql without looking into the compiled rules cache
+        """
+        unsupported = set(kwargs) - {'base_table_filters', 'sample_rate', 'sampling_method', 'trace_tags'}
+        assert not unsupported, 'Unsupported arguments for multiple rules: {arguments}'.format(
+            arguments=', '.join(sorted(unsupported))
+        )
+
+        fields = set()
+        path_hints = {}
+        sub_queries = OrderedDict()
+        where_phrases = []
+        for alias, data in rules:
+            alias = str(alias)
+            assert re.match(r'^\w+$', alias), 'Invalid alias for rule: {alias}'.format(alias=alias)
+            assert not data.get('group_by_fields') and not data.get('having'), \
+                'Group by is not supported when compiling multiple rules: {alias}'.format(alias=alias)
+            assert self.validate_where_data(data.get('where_data', {})), 'Invalid where data'
+
+            fields.update(data['fields'])
+            for table, parent_table in data.get('path_hints', {}).items():
+                assert path_hints.setdefault(table, parent_table) == parent_table, \
+                    'Rules use different paths from node {table}'.format(table=table)
+            for subquery in data.get('sub_queries', []):
+                assert 'alias' in subquery, 'Alias is not present'
+                assert sub_queries.setdefault(subquery['alias'], subquery) == subquery, \
+                    'Rules use different subqueries with alias {alias}'.format(alias=subquery['alias'])
+
+            where_phrases.append((alias, self._generate_sql_condition(data['where_data'])))
+
+        path_subset = self.extract_paths_subset(
+            [self._get_field(field_id).table_name for field_id in fields], path_hints
+        )
+        join_tables = list(self.create_join_path(path_subset, self.base_table))
+        join_phrase = self.generate_left_join(join_tables)
+        base_table_filters = self._get_base_table_filters(base_table, kwargs)
+        trace_tags = self._get_trace_tags(kwargs.get('trace_tags'))
+        sub_queries = list(sub_queries.values())
         sub_query_phrase = self.generate_subquery(
-            data.get('sub_queries', []), kwargs.get('alias_params', alias_params)
+            sub_queries, self._generate_alias_params(sub_queries), list(base_table_filters), trace_tags
+        )
+
+        distinct = bool(sub_queries) or not self.is_fan_out_free(join_tables)
+        select_phrases = [
+            'COUNT({distinct}CASE WHEN ({where_phrase}) THEN `{base_table}`.`id` END) AS `{alias}`'.format(
+                distinct='DISTINCT ' if distinct else '', where_phrase=where_phrase, base_table=base_table, alias=alias
+            )
+            for alias, where_phrase in where_phrases
+        ]
+
+        sql = u'SELECT {select_phrase} FROM {base_table} {sub_query_phrase} {join_phrase}'.format(
+            select_phrase=', '.join(select_phrases),
+            base_table=base_table,
+            sub_query_phrase=sub_query_phrase,
+            join_phrase=join_phrase,
         )
-        select_phrase = self.generate_select_phrase(kwargs.get('select_fields'))
-
-        return u'SELECT {select_phrase} FROM {base_table} {sub_query_phrase} {join_phrase}' \
-               u' WHERE {where_phrase} {group_by_fragment}'.format(
-                   join_phrase=join_phrase,
-                   base_table=base_table,
-                   where_phrase=where_phrase,
-                   group_by_fragment=group_by_phrase,
-                   select_phrase=select_phrase,
-                   sub_query_phrase=sub_query_phrase
-               )
+        if base_table_filters:
+            sql = u'{sql} WHERE {filters}'.format(sql=sql, filters=self._join_filters(base_table_filters))
+        if trace_tags is not None:
+            return tag_sql(sql, trace_tags)
+        return sql
 
     def _parse_multi_path_mapping(self, paths):
         """
         Create mapping of what nodes can be reached from any given node.
         This method also support the case when you can jump to multiple node from any given node
 
-        :param paths: (tuple) tuple of tuples in the format ((join_table, join_field, parent_table, parent_field),)
-        :return: (dict) dict in the format {'join_table': {'parent_table': {'parent_field': , 'join_field':} }}
+        :param paths: (tuple) tuple of tuples in the format
+                      ((join_table, join_field, parent_table, parent_field, join_table_active_field[, cardinality
+                        [, weight]]),)
+                      cardinality is optional and is one of CARDINALITIES
+                      weight is optional, the cost of the join used to pick between several parents of a table
+        :return: (dict) dict in the format {'join_table': {'parent_table': PathRecord(join_column, parent_column,
+                                                                                     join_table_active_field,
+                                                                                     cardinality, weight) }}
         """
         path_map = defaultdict(dict)
-        for join_tbl, join_fld, parent_tbl, parent_fld, join_tbl_active_fld in paths:
+        for path in paths:
+            join_tbl, join_fld, parent_tbl, parent_fld, join_tbl_active_fld = path[:5]
+            join_tbl, parent_tbl = sys.intern(join_tbl), sys.intern(parent_tbl)
             # We can support if there are multiple ways to join a table
             # We don't support if there are multiple fields on join table path
             assert parent_tbl not in path_map[join_tbl], 'Joins with multiple fields is not supported'
-            path_map[join_tbl][parent_tbl] = {
-                self.PARENT_COLUMN: parent_fld,
-                self.JOIN_COLUMN: join_fld,
-                self.JOIN_TABLE_ACTIVE_FIELD: join_tbl_active_fld,
-            }
+            path_map[join_tbl][parent_tbl] = self._parse_path(join_fld, parent_fld, join_tbl_active_fld, *path[5:7])
 
         return path_map
 
+    def _parse_path(self, join_field, parent_field, join_table_active_field, cardinality=None, weight=None):
+        """
+        Create the record for a single path entry.
+        :return: (PathRecord) path record
+        """
+        assert cardinality is None or cardinality in self.CARDINALITIES, \
+            'Invalid cardinality: {cardinality}'.format(cardinality=cardinality)
+        assert weight is None or weight >= 0, 'Path weight can not be negative'
+        return self.record_pool.share(
+            PathRecord, join_field, parent_field, join_table_active_field, cardinality, weight
+        )
+
     def extract_paths_subset(self, start_nodes, path_hints):
         """
         Extract a subset of paths which only contains paths which are possible from starting nodes
@@ -449,10 +1167,37 @@ class JSON2SQLGenerator(object):
         As our current implementation base is always on left side
 
         Left side is always base_table
+        When a table has several parents and no hint, the cheapest join tree is picked, see
+        _extract_cheapest_paths_subset. Resolutions are cached per set of tables and hints.
+
         :param start_nodes: Array of table names
         :param path_hints:
         :return:
         """
+        cache_key = (self.base_table, frozenset(start_nodes), tuple(sorted(path_hints.items())))
+        entry = self._path_cache.lookup(cache_key)
+        if entry is not None:
+            path_subset, dependencies = entry
+            self._track_dependencies(dependencies)
+            return path_subset
+
+        # Picking the cheapest join tree depends on the tables it explored as well
+        with self._collect_dependencies() as dependencies:
+            path_subset = self._extract_paths_subset(start_nodes, path_hints)
+        dependencies.add((self.TABLE_DEPENDENCY, self.base_table))
+        dependencies.update((self.TABLE_DEPENDENCY, table) for table in start_nodes)
+        for parent_table, join_tables in path_subset.items():
+            dependencies.add((self.TABLE_DEPENDENCY, parent_table))
+            dependencies.update((self.TABLE_DEPENDENCY, table) for table in join_tables)
+        self._path_cache.store(cache_key, path_subset, dependencies)
+        self._track_dependencies(dependencies)
+        return path_subset
+
+    def _extract_paths_subset(self, start_nodes, path_hints):
+        """
+        Extract a subset of paths without looking into the join path resolution cache.
+        See extract_paths_subset for the parameters.
+        """
         path_subset = defaultdict(set)
         # Convert start nodes to set as we would need this for lookups
         start_nodes = set(start_nodes)
@@ -479,6 +1224,9 @@ class JSON2SQLGenerator(object):
             elif len(next_nodes) == 1:
                 parent_node = list(next_nodes.keys())[0]
                 traversal_nodes.append(parent_node)
+            elif next_nodes:
+                # No hint for a table with several parents, pick the cheapest join tree for all the tables
+                return self._extract_cheapest_paths_subset(start_nodes, path_hints)
             else:
                 raise Exception("No path hint provided for `{curr_node}`".format(curr_node=curr_node))
 
@@ -486,6 +1234,85 @@ class JSON2SQLGenerator(object):
 
         return path_subset
 
+    def _extract_cheapest_paths_subset(self, start_nodes, path_hints):
+        """
+        Pick the cheapest join tree connecting the start nodes to the base table, using the weights of the
+        paths (DEFAULT_PATH_WEIGHT when a path has no weight). Path hints still decide the parent of the
+        hinted tables.
+
+        Finding the cheapest tree is the Steiner tree problem, so this uses the shortest path heuristic:
+        starting from the base table, repeatedly attach the start node that has the cheapest path
+        (Dijkstra) to any table already in the tree, until every start node is in the tree.
+        :param start_nodes: (set) table names
+        :param path_hints: (dict) join table -> parent table
+        :return: (dict) parent table -> set of join tables, same as _extract_paths_subset
+        """
+        tree = {self.base_table}
+        remaining = set(start_nodes) - tree
+        path_subset = defaultdict(set)
+        while remaining:
+            cheapest = None
+            for table in sorted(remaining):
+                connection = self._find_cheapest_connection(table, tree, path_hints)
+                if connection is None:
+                    raise Exception("No path from `{table}` to `{base_table}`".format(
+                        table=table, base_table=self.base_table
+                    ))
+                if cheapest is None or connection[0] < cheapest[0]:
+                    cheapest = connection
+            for join_table, parent_table in cheapest[1]:
+                path_subset[parent_table].add(join_table)
+                tree.add(join_table)
+            remaining -= tree
+        return path_subset
+
+    def _find_cheapest_connection(self, source, targets, path_hints):
+        """
+        Dijkstra from a table towards its parents until any of the target tables is reached
+        :param source: (str) table name
+        :param targets: (set) table names
+        :param path_hints: (dict) join table -> parent table
+        :return: (tuple|None) (cost, list of tuples (join table, parent table)) or None if no target is reachable
+        """
+        costs = {source: 0}
+        previous = {}
+        heap = [(0, source)]
+        while heap:
+            cost, table = heapq.heappop(heap)
+            if cost > costs[table]:
+                continue
+            if table in targets:
+                route = []
+                while table != source:
+                    route.append((previous[table], table))
+                    table = previous[table]
+                return cost, route
+
+            self._track_dependencies(((self.TABLE_DEPENDENCY, table), ))
+            parents = self.path_mapping.get(table, {})
+            if table in path_hints:
+                assert path_hints[table] in parents, 'Node provided in hint is not a valid option.'
+                parents = {path_hints[table]: parents[path_hints[table]]}
+            for parent_table, path in parents.items():
+                weight = self.DEFAULT_PATH_WEIGHT if path.weight is None else path.weight
+                if cost + weight < costs.get(parent_table, float('inf')):
+                    costs[parent_table] = cost + weight
+                    previous[parent_table] = table
+                    heapq.heappush(heap, (cost + weight, parent_table))
+        return None
+
+    def is_fan_out_free(self, join_path):
+        """
+        Check if joining the tables keeps a single row per base table row, i.e. every join on the path
+        is declared one-to-one or many-to-one. Paths without a declared cardinality are assumed to fan out.
+        :param join_path: (list) list of tuples (join table, parent table), see create_join_path
+        :return: (bool) True if no join can multiply the base table rows
+        """
+        return all(
+            self.path_mapping[join_table][parent_table].cardinality in self.NON_FANNING_CARDINALITIES
+            for join_table, parent_table in join_path
+        )
+
     def create_join_path(self, path_map, curr_table):
         """
         Convert the path subset into a join table
@@ -507,13 +1334,14 @@ class JSON2SQLGenerator(object):
     def generate_left_join(self, join_path):
         join_phrases = []
         for join_table, parent_table in join_path:
+            path = self.path_mapping[join_table][parent_table]
             join_condition = '{join_tbl}.{join_fld} = {parent_tbl}.{parent_fld}'.format(
                 join_tbl=join_table,
                 parent_tbl=parent_table,
-                join_fld=self.path_mapping[join_table][parent_table][self.JOIN_COLUMN],
-                parent_fld=self.path_mapping[join_table][parent_table][self.PARENT_COLUMN]
+                join_fld=path.join_column,
+                parent_fld=path.parent_column
             )
-            join_table_active_field = self.path_mapping[join_table][parent_table][self.JOIN_TABLE_ACTIVE_FIELD]
+            join_table_active_field = path.join_table_active_field
             # If join table has a field which specifies if row is soft deleted or not then add it in join condition
             if join_table_active_field:
                 join_condition = '({join_condition} AND {join_tbl}.{join_table_active_field} = TRUE)'.format(
@@ -544,8 +1372,8 @@ class JSON2SQLGenerator(object):
         result = ''
         fully_qualified_field_names = [
             '`{table_name}`.`{field_name}`'.format(
-                table_name=self.field_mapping[field_id][self.TABLE_NAME],
-                field_name=self.field_mapping[field_id][self.FIELD_NAME]
+                table_name=self._get_field(field_id).table_name,
+                field_name=self._get_field(field_id).field_name
             )
             for field_id in group_by_fields
         ]
@@ -556,11 +1384,24 @@ class JSON2SQLGenerator(object):
 
         return result
 
-    def generate_subquery(self, subqueries, alias_params):
+    def generate_subquery(self, subqueries, alias_params, base_table_filters=(), trace_tags=None):
+        """
+        Create the LEFT JOINs of the derived tables of the subqueries.
+        Conditions of the outer query on the base table are pushed down into the JSON subqueries selecting
+        the base table id as member id, so MySQL materializes only the rows of the members the outer query
+        can match. See _accepts_base_table_filters.
+        :param subqueries: (list) subqueries of the rule, dicts with unique_id, alias and parameters
+        :param alias_params: (dict) alias -> parameters of the subquery
+        :param base_table_filters: (list) SQL conditions on the base table that every matching member satisfies
+        :param trace_tags: (list) tuples (tag name, value) to tag the derived tables with, along with the id
+                           of the subquery. None to leave them untagged.
+        :return: (unicode) SQL
+        """
         result = []
         for subquery_dict in subqueries:
             if 'unique_id' in subquery_dict:
                 subquery = self.subquery_mapping[subquery_dict['unique_id']]
+                self._track_dependencies(((self.SUBQUERY_DEPENDENCY, subquery_dict['unique_id']), ))
 
                 # Validate given subquery
                 self._validate_subquery(subquery)
@@ -569,7 +1410,7 @@ class JSON2SQLGenerator(object):
                 assert 'alias' in subquery_dict, 'Alias is not present'
                 alias = subquery_dict.get('alias')
 
-                select_fields = subquery[self.SUBQUERY_FIELDS_KEY]
+                select_fields = subquery.fields
                 join_fld = None
                 for select_field_id, select_field_data in select_fields.items():
                     if select_field_data.get('is_member_id'):
@@ -578,41 +1419,60 @@ class JSON2SQLGenerator(object):
                         )
                         join_fld = select_field_data.get('alias')
 
-                if subquery[self.SUBQUERY_IS_SQL]:
+                if subquery.is_sql:
                     # Process parameters
                     validated_parameters = {}
                     for param_id, param_data in alias_params.get(alias, {}).items():
-                        assert param_id in subquery[self.SUBQUERY_PARAMS_KEY], 'Invalid parameter name.'
-                        param_type = subquery[self.SUBQUERY_PARAMS_KEY][param_id]['data_type']
+                        assert param_id in subquery.parameters, 'Invalid parameter name.'
+                        param_type = subquery.parameters[param_id]['data_type']
 
                         validated_parameters[param_id] = self._process_parameter(param_type, param_data)
-                    sql = subquery[self.SUBQUERY_STR_KEY].format(**validated_parameters)
+                    sql = subquery.template_str.format(**validated_parameters)
                     assert join_fld is not None, 'Member id mapping is required in the subquery'
+                    table = self._get_materialized_table(FRAGMENT_SUBQUERY, sql, join_fld)
                 else:
                     if not join_fld:
                         join_fld = 'member_id'
-                    sql = self.generate_sql(
-                        subquery[self.SUBQUERY_STR_KEY], self.base_table,
-                        **{'select_fields': select_fields, 'alias_params': alias_params}
-                    )
+                    kwargs = {'select_fields': select_fields, 'alias_params': alias_params}
+                    sql = table = None
+                    if self.materializer is not None:
+                        table, sql = self._get_materialized_subquery(
+                            subquery_dict['unique_id'], subquery, kwargs, join_fld
+                        )
+                    if table is None and base_table_filters and self._accepts_base_table_filters(subquery):
+                        kwargs['base_table_filters'] = tuple(base_table_filters)
+                        sql = None
+                    if table is None and sql is None:
+                        sql = self.generate_sql(subquery.template_str, self.base_table, **kwargs)
+                if table is not None:
+                    derived_table = '`{table}`'.format(table=table)
+                else:
+                    if trace_tags is not None:
+                        sql = tag_sql(sql, trace_tags + [(SUBQUERY_TAG, subquery_dict['unique_id'])])
+                    derived_table = '( {sql} )'.format(sql=sql)
                 result.append(
-                    'LEFT JOIN ( {sql} ) AS {alias} ON `{join_tbl}`.`{join_fld}` = `{parent_tbl}`.`id`'.format(
-                        sql=sql, alias=alias, join_tbl=alias, join_fld=join_fld, parent_tbl=self.base_table
+                    'LEFT JOIN {derived_table} AS {alias} ON `{join_tbl}`.`{join_fld}` = `{parent_tbl}`.`id`'.format(
+                        derived_table=derived_table, alias=alias, join_tbl=alias, join_fld=join_fld,
+                        parent_tbl=self.base_table
                     )
                 )
         return ' '.join(result)
 
-    def generate_select_phrase(self, select_fields=None):
+    def generate_select_phrase(self, select_fields=None, select_mode=SELECT_MODE_COUNT, distinct=True):
         """
         Function to create select phrase for a sql
         :param select_fields: (dict) JSON which contains the select fields
+        :param select_mode: (str) Used when there are no select fields. SELECT_MODE_COUNT to count distinct
+                            members or SELECT_MODE_MEMBER_IDS to select distinct member ids.
+        :param distinct: (bool) False when the joins can't repeat a base table row, so counting or selecting
+                         member ids doesn't need DISTINCT. Used when there are no select fields.
         :return: (unicode) select fields for a SQL
         """
         if select_fields:
             select_phrase = []
             for select_field_alias, select_field_data in select_fields.items():
                 if select_field_alias != 'member_id':
-                    field_name = self.field_mapping[select_field_data['field']][self.FIELD_NAME]
+                    field_name = self._get_field(select_field_data['field']).field_name
                     table = self._get_table_name(select_field_data['field'])
                 else:
                     field_name = select_field_data['field']
@@ -636,8 +1496,14 @@ class JSON2SQLGenerator(object):
                     select_field=select_field, alias=alias
                 ))
             return ', '.join(select_phrase)
-        else:
+        elif select_mode == self.SELECT_MODE_MEMBER_IDS:
+            return '{distinct}`{base_table}`.`id`'.format(
+                distinct='DISTINCT ' if distinct else '', base_table=self.base_table
+            )
+        elif distinct:
             return 'COUNT(DISTINCT `{base_table}`.`id`)'.format(base_table=self.base_table)
+        else:
+            return 'COUNT(*)'
 
     def validate_group_by_data(self, group_by_fields, having):
         """
@@ -672,6 +1538,36 @@ class JSON2SQLGenerator(object):
 
         return True
 
+    def validate_rule(self, data, base_table):
+        """
+        Check that a rule compiles against the knowledge base without building the whole query.
+        Fields, join paths, group by data and subqueries are resolved and the conditions are compiled, which
+        validates the operators and values. Subqueries are not compiled and the rules cache is not used.
+        :param data: (dict) rule JSON, see generate_sql
+        :param base_table: (string) Exact table name as in DB to be used with FROM clause in SQL.
+        :return: (bool) True
+        :raises: the same errors as generate_sql for invalid rules
+        """
+        self.base_table = base_table
+        assert self.validate_where_data(data.get('where_data', {})), 'Invalid where data'
+        self._generate_sql_condition(data['where_data'])
+
+        self.extract_paths_subset(
+            [self._get_field(field_id).table_name for field_id in data['fields']],
+            data.get('path_hints', {})
+        )
+        if 'group_by_fields' in data:
+            assert isinstance(data['group_by_fields'], list), 'Group by fields need to list of dict'
+            group_by_fields = [x['field'] for x in data['group_by_fields']]
+            assert self.validate_group_by_data(group_by_fields, data.get('having', {})), 'Invalid group by data'
+            for field_id in group_by_fields:
+                self._get_field(field_id)
+        for subquery in data.get('sub_queries', []):
+            assert 'alias' in subquery, 'Alias is not present'
+            assert subquery['unique_id'] in self.subquery_mapping, \
+                'Invalid subquery id: {unique_id}'.format(unique_id=subquery['unique_id'])
+        return True
+
     def _generate_sql_condition(self, data):
         """
         This function uses recursion to generate sql for nested conditions.
@@ -685,11 +1581,167 @@ class JSON2SQLGenerator(object):
         if data:
             # Get the first key in dict.
             condition = list(data.keys())[0]
-            # Call the function mapped to the condition
-            function = getattr(self, self.WHERE_CONDITION_MAPPING.get(condition))
-            result = function(data[condition])
+            # Structural ids are memoized only while this condition tree is compiled.
+            # Nested calls (e.g. for subqueries) reuse the memo of the outermost call.
+            owns_memo = self._fragment_id_memo is None
+            if owns_memo:
+                if len(self._fragment_ids) > self.FRAGMENT_IDS_PER_CACHE_ENTRY * self._fragment_cache.maxsize:
+                    # Cached fragments are keyed by these ids, so both need to go together
+                    self._fragment_ids.clear()
+                    self._reused_fragment_ids.clear()
+                    self._fragment_cache.clear()
+                self._fragment_id_memo = {}
+            try:
+                result = self._compile_condition(condition, data[condition])
+            finally:
+                if owns_memo:
+                    self._fragment_id_memo = None
         return result
 
+    def _compile_condition(self, condition, data):
+        """
+        Generate SQL for a single condition using the function mapped to it in WHERE_CONDITION_MAPPING.
+        Identical condition subtrees share one entry in the fragment cache, whichever rule they appear in.
+        Leaves are always cached, combinations only once the same subtree shows up again, as caching
+        a combination costs as much as the dependencies of all of its leaves.
+        :param condition: (str) key of the condition, e.g. `where` or `and`
+        :param data: (dict|list) data of the condition
+        :return: (unicode) SQL of the condition
+        """
+        function = getattr(self, self.WHERE_CONDITION_MAPPING.get(condition))
+        if not self._fragment_cache.maxsize:
+            return function(data)
+
+        fragment_id = self._get_fragment_id(condition, data)
+        if condition in self.COMBINATION_CONDITIONS and fragment_id not in self._reused_fragment_ids:
+            return function(data)
+
+        cache_key = (self._get_fragment_context(), fragment_id)
+        entry = self._fragment_cache.lookup(cache_key)
+        if entry is not None:
+            sql, dependencies = entry
+            self._track_dependencies(dependencies)
+            return sql
+
+        # Same as _collect_dependencies, inlined as this runs for every fragment of the condition tree
+        dependencies = set()
+        self._dependency_stack.append(dependencies)
+        try:
+            sql = function(data)
+        finally:
+            self._dependency_stack.pop()
+            self._track_dependencies(dependencies)
+        self._fragment_cache.store(cache_key, sql, dependencies)
+        return sql
+
+    def _get_fragment_context(self):
+        """
+        Everything outside of the condition data that the SQL of a condition depends on.
+        Dynamic dates are rendered relative to NOW() in SQL, so they don't depend on the compile time.
+        Rules compiled for a PreparedRule have slots instead of placeholders, so the mode is part of the context.
+        Materialized tables replace subqueries and custom methods, so the materialization version is as well,
+        along with whether the condition is below NOT, where custom methods are not replaced.
+        Traced subqueries are tagged with the knowledge base version.
+        Conditions of AND and OR are ordered by field statistics (see _order_conditions), so the field
+        statistics version is part of the context as well.
+        :return: (tuple) hashable compile context
+        """
+        materialization = None
+        if self.materializer is not None:
+            materialization = (self.materializer.version, self._negation_depth > 0)
+        return (
+            self.base_table, self._prepared, materialization, self.knowledge_base_version,
+            self._field_statistics_version
+        )
+
+    def _get_materialized_table(self, kind, sql, member_column=None):
+        """
+        Register a compiled subquery or custom method with the materializer and get its table
+        :param kind: (str) FRAGMENT_SUBQUERY or FRAGMENT_CUSTOM_METHOD
+        :param sql: (unicode) SQL of the derived table or the condition
+        :param member_column: (str) column of a subquery holding the member id
+        :return: (str|None) name of the fresh materialized table, None when the SQL has to be used
+        """
+        if self.materializer is None:
+            return None
+        key = self.materializer.register(kind, self.base_table, sql, member_column)
+        if key is None:
+            return None
+        self._track_dependencies(((self.MATERIALIZED_FRAGMENT_DEPENDENCY, key), ))
+        return self.materializer.get_fresh_table(key)
+
+    def _get_materialized_subquery(self, subquery_id, subquery, kwargs, member_column):
+        """
+        Get the materialized table of a JSON subquery.
+        Materialized tables hold the rows of every member, so they are keyed by the SQL without the pushed down
+        filters. The key is cached per subquery and parameters, so that SQL is only compiled to register the
+        subquery and not on every lookup.
+        :param subquery_id: (int|str) unique id of the subquery
+        :param subquery: (SubqueryRecord) subquery record
+        :param kwargs: (dict) keyword arguments for generate_sql, without base table filters
+        :param member_column: (str) column of the subquery holding the member id
+        :return: (tuple) (name of the fresh materialized table or None,
+                          SQL without the pushed down filters or None when it wasn't compiled)
+        """
+        cache_key = (self._get_fragment_context(), subquery_id, repr(kwargs['alias_params']))
+        entry = self._materialized_subquery_cache.lookup(cache_key)
+        # Fragments can be dropped by the materializer, they are registered again
+        if entry is not None and (entry[0] is None or self.materializer.get_fragment(entry[0]) is not None):
+            key, dependencies = entry
+            self._track_dependencies(dependencies)
+            sql = None
+        else:
+            with self._collect_dependencies() as dependencies:
+                sql = self.generate_sql(subquery.template_str, self.base_table, **kwargs)
+            key = self.materializer.register(FRAGMENT_SUBQUERY, self.base_table, sql, member_column)
+            self._materialized_subquery_cache.store(cache_key, key, dependencies)
+        if key is None:
+            return None, sql
+        self._track_dependencies(((self.MATERIALIZED_FRAGMENT_DEPENDENCY, key), ))
+        return self.materializer.get_fresh_table(key), sql
+
+    def _get_fragment_id(self, condition, data):
+        """
+        Hash cons a condition subtree: structurally identical subtrees get the same small integer id.
+        Leaves are keyed by their data, combinations by their condition and the ids of their children,
+        so the key of every node has a constant size no matter how deep the subtree is.
+        :param condition: (str) key of the condition
+        :param data: (dict|list) data of the condition
+        :return: (int) fragment id
+        """
+        memo = self._fragment_id_memo
+        if memo is not None:
+            memoized = memo.get(id(data))
+            # Compare the object as well, as ids of objects that are garbage collected get reused
+            if memoized is not None and memoized[0] is data:
+                return memoized[1]
+
+        if condition in self.COMBINATION_CONDITIONS and isinstance(data, list):
+            children = []
+            for element in data:
+                inner_condition = next(iter(element))
+                children.append(self._get_fragment_id(inner_condition, element[inner_condition]))
+            key = (condition, tuple(children))
+        elif isinstance(data, dict):
+            # Keyed by the type of the values as well, True, 1 and 1.0 are equal but render differently
+            key = (condition, tuple((name, type(value), value) for name, value in data.items()))
+        else:
+            key = (condition, repr(data))
+
+        try:
+            fragment_id = self._fragment_ids.get(key)
+        except TypeError:
+            # Nested values, e.g. dynamic dates or custom method parameters, are not hashable
+            key = (condition, repr(data))
+            fragment_id = self._fragment_ids.get(key)
+        if fragment_id is None:
+            fragment_id = self._fragment_ids[key] = len(self._fragment_ids)
+        else:
+            self._reused_fragment_ids.add(fragment_id)
+        if memo is not None:
+            memo[id(data)] = (data, fragment_id)
+        return fragment_id
+
     def _get_validated_data(self, where):
         try:
             operator = where['operator'].lower()
@@ -732,25 +1784,28 @@ class JSON2SQLGenerator(object):
         sql_operator = getattr(self.VALUE_OPERATORS, operator)
         if 'subquery' in where:
             subquery = self.subquery_mapping[where.get('subquery')]
-            select_fields = subquery.get(self.SUBQUERY_FIELDS_KEY)
+            self._track_dependencies(((self.SUBQUERY_DEPENDENCY, where.get('subquery')), ))
+            select_fields = subquery.fields
             subquery_select_field = select_fields.get(field)
             # Get alias db field name from where data
             field_name = subquery_select_field.get('alias')
             # Get alias table name from where data
             table = where.get('alias')
             data_type = subquery_select_field.get('data_type')
+            codec = get_codec(data_type)
+            fulltext = False
         else:
-            # Get db field name from field_mapping
-            field_name = self.field_mapping[field][self.FIELD_NAME]
-            # Get table name from field_mapping
-            table = self._get_table_name(field)
-            # Get data type from field_mapping
-            data_type = self._get_data_type(field)
+            field_data = self._get_field(field)
+            # Get db field name, table name and data type from field_mapping
+            field_name, table, data_type = field_data.field_name, field_data.table_name, field_data.data_type
+            fulltext = field_data.fulltext
+            codec = self.field_codecs[field]
 
         # `value` contains the R.H.S part of the equation.
         # In case of `IS` operator R.H.S can be `NULL` or `NOT NULL`
         # irrespective of data type of the L.H.S.
         # Hence we want to skip data type check for `IS` operator.
+        fulltext_term = None
         if sql_operator == self.VALUE_OPERATORS.is_op:
             value_in_upper_case = value.upper()
             if data_type == self.STRING:
@@ -766,16 +1821,21 @@ class JSON2SQLGenerator(object):
         else:
             # Update value if operator is in like operators
             if data_type == self.STRING and operator in self.LIKE_OPERATORS:
+                if operator == self.HAS_SUBSTRING and fulltext and not where.get('aggregate_lhs'):
+                    fulltext_term = self._get_fulltext_term(value)
+                if isinstance(value, str):
+                    for character, escaped in self.LIKE_ESCAPES:
+                        value = value.replace(character, escaped)
                 if operator == self.STARTS_WITH:
-                    like_value = '{value}%%'
+                    like_value = '{value}%'
                 elif operator == self.ENDS_WITH:
-                    like_value = '%%{value}'
+                    like_value = '%{value}'
                 else:
-                    like_value = '%%{value}%%'
+                    like_value = '%{value}%'
                 value = like_value.format(value=value)
 
-            sql_value = self._get_sql_value(value, data_type)
-            secondary_sql_value = self._get_sql_value(secondary_value, data_type)
+            sql_value = self._get_sql_value(value, data_type, codec)
+            secondary_sql_value = self._get_sql_value(secondary_value, data_type, codec)
 
         lhs = u'`{table}`.`{field}`'.format(table=table, field=field_name)  # type: unicode
 
@@ -787,16 +1847,16 @@ class JSON2SQLGenerator(object):
             else:
                 logger.info('Unsupported aggregate functions: %s', aggregate_func_name)
 
+        # Search fulltext indexed columns with the index instead of scanning them with LIKE
+        if fulltext_term is not None:
+            return u"MATCH({lhs}) AGAINST('\"{term}\"' IN BOOLEAN MODE)".format(lhs=lhs, term=fulltext_term)
+
         # TODO: Based on the assumption that below operator will only used
         #           with challenge.
         if sql_operator in [self.VALUE_OPERATORS.is_challenge_completed,
                             self.VALUE_OPERATORS.is_challenge_not_completed]:
-            return "{negate} {check}".format(
-                negate=(
-                    'NOT' if sql_operator == self.VALUE_OPERATORS.is_challenge_not_completed
-                    else ''
-                ),
-                check=self.CHALLENGE_CHECK_QUERY.format(value=sql_value)
+            return self._generate_challenge_check(
+                [sql_value], sql_operator == self.VALUE_OPERATORS.is_challenge_not_completed
             )
 
         # Generate SQL phrase for is_present value operator
@@ -825,13 +1885,28 @@ class JSON2SQLGenerator(object):
             )
         return where_phrase
 
+    def _get_fulltext_term(self, value):
+        """
+        Get the phrase used to search a fulltext indexed column.
+        Double quotes are dropped so the value can't close the phrase and boolean mode operators are
+        matched as part of the phrase.
+        :param value: (string) Value of has_substring condition
+        :return: (string|None) escaped phrase, None if the value can't be searched with the fulltext index
+        """
+        if not isinstance(value, str):
+            return None
+        term = ' '.join(value.replace('"', ' ').split())
+        if len(term) < self.FULLTEXT_MIN_TOKEN_SIZE:
+            return None
+        return escape_percent(self._sql_injection_proof(term))
+
     def _get_data_type(self, field):
         """
         Gets data type for the field from self.field_mapping configured in __init__
         :param field: (int|string) field identifier that is used as key in self.field_mapping
         :return: (string) data type of the field
         """
-        return self.field_mapping[field][self.DATA_TYPE]
+        return self._get_field(field).data_type
 
     def _get_table_name(self, field):
         """
@@ -839,7 +1914,7 @@ class JSON2SQLGenerator(object):
         :param field: (int|string) Field identifier that is used as key in self.field_mapping
         :return: (string|unicode) Name of the table of the field
         """
-        return self.field_mapping[field][self.TABLE_NAME]
+        return self._get_field(field).table_name
 
     def _convert_values(self, values, data_type):
         """
@@ -847,19 +1922,8 @@ class JSON2SQLGenerator(object):
         :param values: (iterable) Any instance of iterable values of same data type that need conversion
         :param data_type: (string) Data type of the values provided
         """
-        if data_type in [self.CHOICE, self.MULTICHOICE]:
-            # try converting the value to int
-            try:
-                int(values[0])
-            except ValueError:
-                wrapper = '\'{value}\''
-            else:
-                wrapper = '{value}'
-        elif data_type in self.CONVERSION_REQUIRED:
-            wrapper = '\'{value}\''
-        else:
-            wrapper = '{value}'
-        return (wrapper.format(value=value) for value in values)
+        codec = get_codec(data_type)
+        return (codec.format(value) for value in values)
 
     def _sanitize_value(self, value, data_type):
         """
@@ -868,28 +1932,7 @@ class JSON2SQLGenerator(object):
         :param data_type: (string) Data type against which the value will be compared
         :return: None
         """
-        if data_type == self.INTEGER:
-            try:
-                int(value)
-            except ValueError:
-                raise ValueError(
-                    'Invalid value -[{value}] for data_type - [{data_type}]'.format(
-                        value=value, data_type=data_type
-                    )
-                )
-        elif data_type == self.DATE:
-            try:
-                datetime.datetime.strptime(value, '%Y-%m-%d')
-            except ValueError as e:
-                raise e
-        elif data_type == self.DATE_TIME:
-            try:
-                datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
-            except ValueError as e:
-                try:
-                    datetime.datetime.strptime(value, '%Y-%m-%d')
-                except ValueError as e:
-                    raise e
+        get_codec(data_type).clean(value)
 
     def _validate_sql_values(self, value, data_type):
         """
@@ -899,21 +1942,18 @@ class JSON2SQLGenerator(object):
         :return: Validated value
         """
         if value and not isinstance(value, dict):
-            # Check if the primary value and data_type are in sync
-            self._sanitize_value(value, data_type)
-            # Make string SQL injection proof
-            if data_type == self.STRING:
-                 value = self._sql_injection_proof(value)
+            # Check if the primary value and data_type are in sync and make strings SQL injection proof
+            value = get_codec(data_type).clean(value)
         return value
 
-    def _get_sql_value(self, value, data_type):
+    def _get_sql_value(self, value, data_type, codec=None):
         """
         Get sql value from the given value
         :param value: (dict|string) Value for which sql condition is to be generated
         :param data_type: (string) Data type of the values provided
+        :param codec: (Codec|None) Codec of the data type, resolved from data_type when not given
         :return: (string) sql value to used
         """
-        value = self._validate_sql_values(value, data_type)
         if isinstance(value, dict):
             try:
                 value_type = value['type'].upper()
@@ -925,8 +1965,8 @@ class JSON2SQLGenerator(object):
             function = getattr(self, self.DYNAMIC_VALUE_MAPPING.get(value_type))
             sql_value = function(value, data_type)
         else:
-            # Make value sql proof. For ex: if value is string or data convert it to '<value>'
-            (sql_value,) = self._convert_values([value], data_type)
+            # Validate the value and make it sql proof. For ex: if value is string or data convert it to '<value>'
+            sql_value = (codec or get_codec(data_type)).to_sql(value)
         return sql_value
 
     def _get_dynamic_date_validated_data(self, value):
@@ -964,8 +2004,9 @@ class JSON2SQLGenerator(object):
         :return: sql value for dynamic date
         """
         validated_data = self._get_dynamic_date_validated_data(value)
+        now = slot(NOW_SLOT) if self._prepared else 'NOW()'
         if validated_data.get('use_now_only'):
-            return 'NOW()'
+            return now
         else:
             sql_operator = getattr(self.DYNAMIC_DATE_OPERATORS, validated_data.get('operator'))
             unit = self._sql_injection_proof(validated_data.get('unit')).upper()
@@ -977,8 +2018,9 @@ class JSON2SQLGenerator(object):
                     'Invalid value for offset - [{key}]'.format(key=offset)
                 )
             assert unit in self.DYNAMIC_DATE_UNITS, 'Unsupported dynamic date units'
-            return '{date_operator}(NOW(), INTERVAL {offset} {unit})'.format(
+            return '{date_operator}({now}, INTERVAL {offset} {unit})'.format(
                 date_operator=sql_operator,
+                now=now,
                 offset=offset,
                 unit=unit,
             )
@@ -997,12 +2039,16 @@ class JSON2SQLGenerator(object):
             raise ValueError('Missing key - [variable_template_id]')
 
         template_data = self.variable_templates[variable_template_id]
-        variable_template_keyword = template_data[self.VARIABLE_TEMPLATE_KEYWORD]
+        self._track_dependencies(((self.VARIABLE_TEMPLATE_DEPENDENCY, variable_template_id), ))
+        variable_template_keyword = template_data.keyword
         # Check if data type of field is equal to the return type of variable template
-        assert template_data[self.VARIABLE_TEMPLATE_RETURN_TYPE] == data_type,\
+        assert template_data.return_type == data_type,\
             'Data type of field does not match return type of {template} variable template'.format(
                 template=variable_template_keyword
             )
+        if self._prepared:
+            # Quoted by the codec of the return type when the value is bound
+            return slot(variable_template_keyword)
         (sql_value,) = self._convert_values(['{{{keyword}}}'.format(keyword=variable_template_keyword)], data_type)
         return sql_value
 
@@ -1024,6 +2070,66 @@ class JSON2SQLGenerator(object):
         """
         return self._parse_conditions(self.OR_CONDITION, data)
 
+    def _accepts_base_table_filters(self, subquery):
+        """
+        Check if conditions on the base table can be pushed down into a JSON subquery.
+        The rows of the derived table are joined back on the base table id, so filtering them by the
+        conditions of the outer query only drops rows of members the outer query drops anyway. That holds
+        as long as the member id is the id of the base table and rows of several members are not
+        aggregated together.
+        :param subquery: (SubqueryRecord) subquery record
+        :return: (bool) True if base table filters can be added to the subquery
+        """
+        if subquery.is_sql:
+            return False
+        if subquery.template_str.get('group_by_fields') or subquery.template_str.get('having'):
+            return False
+        member_id_fields = [data for data in subquery.fields.values() if data.get('is_member_id')]
+        if len(member_id_fields) != 1:
+            return False
+        member_id_field = member_id_fields[0]
+        if member_id_field.get('field') != 'id' or member_id_field.get('category') != self.base_table:
+            return False
+        return not any(data.get('aggregate_lhs') for data in subquery.fields.values())
+
+    def _get_pushdown_filters(self, where_data):
+        """
+        Get the SQL of the top level conditions of a rule that only use columns of the base table,
+        so they can be pushed down into subqueries.
+        Challenge checks are left out, they are correlated subqueries and would be evaluated twice.
+        :param where_data: (dict) where data of the rule
+        :return: (list) SQL conditions
+        """
+        if list(where_data) == [self.AND_CONDITION]:
+            conjuncts = where_data[self.AND_CONDITION]
+        else:
+            conjuncts = [where_data]
+
+        filters = []
+        for element in conjuncts:
+            if list(element) != [self.WHERE_CONDITION]:
+                continue
+            where = element[self.WHERE_CONDITION]
+            if not isinstance(where, dict) or 'subquery' in where or where.get('aggregate_lhs'):
+                continue
+            if str(where.get('operator', '')).lower() in (self.VALUE_OPERATORS.is_challenge_completed,
+                                                          self.VALUE_OPERATORS.is_challenge_not_completed):
+                continue
+            field_data = self.field_mapping.get(where.get('field'))
+            if field_data is None or field_data.table_name != self.base_table:
+                continue
+            filters.append(self._compile_condition(self.WHERE_CONDITION, where))
+        return filters
+
+    @staticmethod
+    def _join_filters(filters):
+        """
+        AND the SQL conditions together
+        :param filters: (list) SQL conditions
+        :return: (unicode) SQL
+        """
+        return u' AND '.join(u'({sql_filter})'.format(sql_filter=sql_filter) for sql_filter in filters)
+
     def _parse_exists(self, data):
         """
         To parse the EXISTS check/wrapper for where clause.
@@ -1042,7 +2148,11 @@ class JSON2SQLGenerator(object):
         :return: (unicode) unicode containing SQL condition represeted by data with NOT check.
                  This SQL can be directly placed in a SQL query
         """
-        return self._parse_conditions(self.NOT_CONDITION, data)
+        self._negation_depth += 1
+        try:
+            return self._parse_conditions(self.NOT_CONDITION, data)
+        finally:
+            self._negation_depth -= 1
 
     def _parse_conditions(self, condition, data):
         """
@@ -1056,13 +2166,23 @@ class JSON2SQLGenerator(object):
         :param data: (list) list conditions to be combined or parsed
         :return: (unicode) unicode string that could be placed in the SQL
         """
+        merged_checks = {}
+        if condition in (self.AND_CONDITION, self.OR_CONDITION) and len(data) > 1:
+            if self.field_statistics and any(self._uses_field_statistics(element) for element in data):
+                data = self._order_conditions(condition, data)
+            merged_checks = self._merge_challenge_checks(condition, data)
         sql = bytearray()
-        for element in data:
-            # Get the first key in the dict.
-            inner_condition = list(element.keys())[0]
-            function = getattr(self, self.WHERE_CONDITION_MAPPING.get(inner_condition))
-            # Call the function mapped to it.
-            result = function(element.get(inner_condition))
+        for position, element in enumerate(data):
+            if position in merged_checks:
+                result = merged_checks[position]
+                # Merged into the check of an earlier sibling
+                if result is None:
+                    continue
+            else:
+                # Get the first key in the dict.
+                inner_condition = list(element.keys())[0]
+                # Call the function mapped to it.
+                result = self._compile_condition(inner_condition, element.get(inner_condition))
             # Append the result to the sql.
             if not sql and condition in [self.AND_CONDITION, self.OR_CONDITION]:
                 sql_result = '({result})'.format(result=result)
@@ -1071,19 +2191,198 @@ class JSON2SQLGenerator(object):
             sql.extend(sql_result.encode('utf8'))
         return u'({sql})'.format(sql=sql.decode('utf8'))
 
+    def _merge_challenge_checks(self, condition, data):
+        """
+        Merge sibling challenge checks of the same kind into a single correlated subquery, so MySQL probes the
+        challenge table once per member instead of once per check:
+            completed(a) AND completed(b)          -> EXISTS (... IN (a, b) ... HAVING COUNT(DISTINCT ...) = 2)
+            completed(a) OR completed(b)           -> EXISTS (... IN (a, b) ...)
+            not_completed(a) AND not_completed(b)  -> NOT EXISTS (... IN (a, b) ...)
+            not_completed(a) OR not_completed(b)   -> NOT EXISTS (... IN (a, b) ... HAVING COUNT(DISTINCT ...) = 2)
+        :param condition: (string) AND_CONDITION or OR_CONDITION
+        :param data: (list) list of conditions
+        :return: (dict) position -> SQL of the merged check at the position of the first check of the kind,
+                 None at the positions of the other checks of the kind
+        """
+        positions = defaultdict(list)
+        for position, element in enumerate(data):
+            where = element.get(self.WHERE_CONDITION) if len(element) == 1 else None
+            if isinstance(where, dict) and 'subquery' not in where and \
+                    str(where.get('operator', '')).lower() in self.CHALLENGE_OPERATORS:
+                positions[where['operator'].lower()].append(position)
+
+        merged = {}
+        for operator, operator_positions in positions.items():
+            if len(operator_positions) < 2:
+                continue
+            values = []
+            for position in operator_positions:
+                _, value, field, _ = self._get_validated_data(data[position][self.WHERE_CONDITION])
+                sql_value = self._get_sql_value(value, self._get_field(field).data_type, self.field_codecs[field])
+                if sql_value not in values:
+                    values.append(sql_value)
+            negate = operator == self.VALUE_OPERATORS.is_challenge_not_completed
+            merged[operator_positions[0]] = self._generate_challenge_check(
+                values, negate, require_all=(condition == self.AND_CONDITION) != negate
+            )
+            merged.update((position, None) for position in operator_positions[1:])
+        return merged
+
+    def _generate_challenge_check(self, values, negate, require_all=False):
+        """
+        Generate the correlated subquery checking the challenges of the member, see CHALLENGE_CHECK_QUERY
+        :param values: (list) SQL values of the challenge ids
+        :param negate: (bool) True to check that the challenges are not completed
+        :param require_all: (bool) True if every challenge needs to be completed, otherwise any of them
+        :return: (unicode) SQL condition
+        """
+        self._track_dependencies(((self.CHALLENGE_CHECK_DEPENDENCY, None), ))
+        config = self.challenge_check
+        if len(values) == 1:
+            challenge_condition = '{column} = {value}'.format(column=config.challenge_column, value=values[0])
+        else:
+            challenge_condition = '{column} IN ({values})'.format(
+                column=config.challenge_column, values=', '.join(values)
+            )
+        group_by_phrase = ''
+        if require_all and len(values) > 1:
+            group_by_phrase = ' GROUP BY {member_column} HAVING COUNT(DISTINCT {challenge_column}) = {count}'.format(
+                member_column=config.member_column, challenge_column=config.challenge_column, count=len(values)
+            )
+        return "{negate} {check}".format(
+            negate='NOT' if negate else '',
+            check=self.CHALLENGE_CHECK_QUERY.format(
+                challenge_condition=challenge_condition, group_by_phrase=group_by_phrase, **config._asdict()
+            )
+        )
+
+    def _order_conditions(self, condition, data):
+        """
+        Order the conditions combined by AND or OR so MySQL can stop evaluating a row as early as possible.
+        Cheaper cost classes come first, subqueries last. Within a cost class AND puts the conditions
+        matching the fewest rows first and OR the conditions matching the most rows first.
+        The sort is stable, so conditions with the same estimate keep the order of the JSON.
+        :param condition: (string) AND_CONDITION or OR_CONDITION
+        :param data: (list) list of conditions
+        :return: (list) ordered list of conditions
+        """
+        estimates = {}
+        for position, element in enumerate(data):
+            inner_condition = next(iter(element))
+            cost, selectivity = self._estimate_condition(inner_condition, element[inner_condition])
+            estimates[position] = (cost, selectivity if condition == self.AND_CONDITION else -selectivity)
+        return [data[position] for position in sorted(estimates, key=estimates.get)]
+
+    def _uses_field_statistics(self, element):
+        """
+        Check if a condition compares any field with statistics, so the SQL of a rule only changes with the
+        statistics of the fields it uses
+        :param element: (dict) condition, e.g. {'where': {...}}
+        :return: (bool) True if ordering the condition can use field statistics
+        """
+        condition = next(iter(element))
+        data = element[condition]
+        if condition == self.WHERE_CONDITION:
+            return 'subquery' not in data and data.get('field') in self.field_statistics
+        if condition in (self.AND_CONDITION, self.OR_CONDITION, self.NOT_CONDITION):
+            return any(self._uses_field_statistics(child) for child in data)
+        return False
+
+    def _estimate_condition(self, condition, data):
+        """
+        Estimate the cost and selectivity of a condition from the field statistics
+        :param condition: (string) key of the condition, e.g. `where` or `and`
+        :param data: (dict|list) data of the condition
+        :return: (tuple) (index of the cost class in COST_CLASSES, estimated fraction of rows matching)
+        """
+        if condition == self.WHERE_CONDITION:
+            return self._estimate_where(data)
+        if condition in (self.AND_CONDITION, self.OR_CONDITION, self.NOT_CONDITION):
+            estimates = []
+            for element in data:
+                inner_condition = next(iter(element))
+                estimates.append(self._estimate_condition(inner_condition, element[inner_condition]))
+            cost = max(estimate[0] for estimate in estimates) if estimates else 0
+            if condition == self.OR_CONDITION:
+                no_match = 1.0
+                for _, selectivity in estimates:
+                    no_match *= 1.0 - selectivity
+                return cost, 1.0 - no_match
+            selectivity = 1.0
+            for _, estimate_selectivity in estimates:
+                selectivity *= estimate_selectivity
+            return cost, selectivity if condition == self.AND_CONDITION else 1.0 - selectivity
+        if condition == self.EXISTS_CONDITION:
+            return self.COST_CLASSES.index(self.COST_SUBQUERY), self.DEFAULT_SELECTIVITY
+        # Custom methods and questionnaires, the SQL of the template is unknown
+        template_data = self.custom_methods.get(data.get('template_id')) if isinstance(data, dict) else None
+        if template_data is None or 'SELECT' in template_data.template_str.upper():
+            return self.COST_CLASSES.index(self.COST_SUBQUERY), self.DEFAULT_SELECTIVITY
+        return self.COST_CLASSES.index(self.COST_EXPENSIVE), self.DEFAULT_SELECTIVITY
+
+    def _estimate_where(self, where):
+        """
+        Estimate the cost and selectivity of a single condition, see _estimate_condition
+        """
+        operator = str(where.get('operator', '')).lower()
+        if operator in (self.VALUE_OPERATORS.is_challenge_completed, self.VALUE_OPERATORS.is_challenge_not_completed):
+            return self.COST_CLASSES.index(self.COST_SUBQUERY), self.DEFAULT_SELECTIVITY
+
+        field = where.get('field')
+        statistics = None if 'subquery' in where else self.field_statistics.get(field)
+        cost_class = statistics.cost_class if statistics and statistics.cost_class else self.COST_CHEAP
+        if operator in self.EXPENSIVE_OPERATORS:
+            field_data = None if 'subquery' in where else self.field_mapping.get(field)
+            # Fulltext searches use the index
+            if not (operator == self.HAS_SUBSTRING and field_data and field_data.fulltext):
+                cost_class = max(cost_class, self.COST_EXPENSIVE, key=self.COST_CLASSES.index)
+        cost = self.COST_CLASSES.index(cost_class)
+
+        null_fraction = statistics.null_fraction if statistics else None
+        distinct_count = statistics.distinct_count if statistics else None
+        if distinct_count:
+            equality_selectivity = (1.0 - null_fraction) / distinct_count
+        else:
+            equality_selectivity = self.DEFAULT_EQUALITY_SELECTIVITY
+
+        value = where.get('value')
+        value = value.upper() if isinstance(value, str) else value
+        if operator == 'equals':
+            selectivity = equality_selectivity
+        elif operator == 'not_equals':
+            selectivity = 1.0 - equality_selectivity
+        elif operator == 'is_op' and null_fraction is not None:
+            if value == 'NULL':
+                selectivity = null_fraction
+            elif value == 'NOT NULL':
+                selectivity = 1.0 - null_fraction
+            else:
+                # IS TRUE / IS FALSE
+                selectivity = (1.0 - null_fraction) / 2
+        elif operator == 'is_present' and null_fraction is not None:
+            selectivity = 1.0 - null_fraction if value == self.TRUE else null_fraction
+        else:
+            selectivity = self.DEFAULT_SELECTIVITY
+        return cost, selectivity
+
     def _parse_field_mapping(self, field_mapping):
         """
         Converts tuple of tuples to dict.
-        :param field_mapping: (tuple) tuple of tuples in the format ((field_identifier, field_name, table_name, data_type),)
-        :return: (dict) dict in the format {'<field_identifier>': {'field_name': <>, 'table_name': <>, 'data_type': <>,}}
+        :param field_mapping: (tuple) tuple of tuples in the format
+                              ((field_identifier, field_name, table_name, data_type[, fulltext]),)
+                              fulltext is optional, True marks string columns with a FULLTEXT index
+        :return: (dict) dict in the format {'<field_identifier>': FieldRecord(field_name, table_name, data_type,
+                                                                               fulltext)}
         """
-        return {
-            field[0]: {
-                self.FIELD_NAME: field[1],
-                self.TABLE_NAME: field[2],
-                self.DATA_TYPE: field[3]
-            } for field in field_mapping
-        }
+        return {intern_value(field[0]): self._parse_field(*field[1:]) for field in field_mapping}
+
+    def _parse_field(self, field_name, table_name, data_type, fulltext=False):
+        """
+        Create the record for a single field.
+        :return: (FieldRecord) field record
+        """
+        assert not fulltext or data_type == self.STRING, 'Only string fields can be fulltext indexed'
+        return self.record_pool.share(FieldRecord, field_name, table_name, data_type, bool(fulltext))
 
     def _sql_injection_proof(self, value):
         """
@@ -0,0 +1,329 @@
+"""
+Helpers to run the SQL generated by JSON2SQLGenerator against a DB-API connection.
+
+Large rules can be run in id range shards. The id space of the base table is split into ranges, every
+range is added to the rule as a base table filter (and so pushed down into its JSON subqueries), and the
+shards run concurrently, one connection per worker thread:
+
+    connect = lambda: MySQLdb.connect(**replica_settings)
+    count = count_members_sharded([connect] * 4, generator, data, 'patients_member', shards=16)
+
+Connection factories can point at different replicas. Any DB-API driver works, e.g. sqlite3 with
+cursor_class=None.
+"""
+import math
+import queue
+import threading
+
+import MySQLdb.cursors
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.prepared import format_sql
+
+# Server side cursor, rows are streamed instead of being buffered in the client
+DEFAULT_CURSOR_CLASS = MySQLdb.cursors.SSCursor
+
+# Pages of ids a shard fetches ahead of the consumer of iter_member_ids_sharded
+SHARD_BUFFER_PAGES = 2
+
+# Seconds between checks for errors and stop requests while waiting on a page queue
+_POLL_INTERVAL = 0.1
+
+
+def iter_member_ids(connection, generator, data, base_table, page_size=JSON2SQLGenerator.DEFAULT_PAGE_SIZE,
+                    start_after=0, cursor_class=DEFAULT_CURSOR_CLASS, **kwargs):
+    """
+    Iterate over ids of the members matching the rule, in ascending order, with constant memory.
+    The rule is compiled once in member ids select mode and every page continues after the last id of the
+    previous page (keyset pagination), so no page scans rows of the previous pages.
+
+    :param connection: DB-API connection
+    :param generator: (JSON2SQLGenerator) generator used to compile the rule
+    :param data: (dict) rule data, see JSON2SQLGenerator.generate_sql
+    :param base_table: (string) Exact table name as in DB to be used with FROM clause in SQL.
+    :param page_size: (int) Number of ids fetched by a single query
+    :param start_after: (int) Only ids greater than this are returned, used to resume an export
+    :param cursor_class: Cursor class passed to connection.cursor(). None uses the default cursor of the connection.
+    :param kwargs: Extra keyword arguments for generate_sql
+    :return: (generator) member ids
+    """
+    sql = generator.generate_sql(
+        data, base_table, select_mode=JSON2SQLGenerator.SELECT_MODE_MEMBER_IDS, page_size=page_size, **kwargs
+    )
+    return _iter_pages(connection, sql, page_size, start_after, cursor_class)
+
+
+def _iter_pages(connection, sql, page_size, start_after, cursor_class):
+    """
+    Run a query compiled in member ids select mode page by page, see iter_member_ids
+    """
+    last_id = start_after
+    while True:
+        cursor = connection.cursor(cursor_class) if cursor_class else connection.cursor()
+        rows = 0
+        try:
+            # Interpolate here instead of passing parameters, the same way MySQLdb does it on the client,
+            # so the query works with drivers using other parameter styles as well
+            cursor.execute(format_sql(sql, {JSON2SQLGenerator.LAST_ID_PARAM: int(last_id)}))
+            for row in cursor:
+                rows += 1
+                last_id = row[0]
+                yield last_id
+        finally:
+            cursor.close()
+
+        if rows < page_size:
+            return
+
+
+def _get_cursor(connection, cursor_class):
+    return connection.cursor(cursor_class) if cursor_class else connection.cursor()
+
+
+def get_id_bounds(connection, base_table, cursor_class=None):
+    """
+    Get the smallest and the largest id of the base table
+    :param connection: DB-API connection
+    :param base_table: (string) Exact table name as in DB
+    :param cursor_class: Cursor class passed to connection.cursor(). None uses the default cursor of the connection.
+    :return: (tuple) (min id, max id), (None, None) when the table is empty
+    """
+    cursor = _get_cursor(connection, cursor_class)
+    try:
+        cursor.execute('SELECT MIN(`{table}`.`id`), MAX(`{table}`.`id`) FROM `{table}`'.format(table=base_table))
+        return tuple(cursor.fetchone())
+    finally:
+        cursor.close()
+
+
+def split_id_range(min_id, max_id, shards):
+    """
+    Split the ids from min_id to max_id into ranges of about the same size
+    :param min_id: (int) smallest id
+    :param max_id: (int) largest id
+    :param shards: (int) number of ranges
+    :return: (list) tuples (low, high) where low is inclusive and high is exclusive, in ascending order.
+             Less than `shards` ranges are returned when there are less ids.
+    """
+    assert shards > 0, 'Number of shards must be positive'
+    if min_id is None or max_id is None:
+        return []
+    min_id, max_id = int(min_id), int(max_id)
+    step = max(int(math.ceil((max_id - min_id + 1) / float(shards))), 1)
+    return [(low, min(low + step, max_id + 1)) for low in range(min_id, max_id + 1, step)]
+
+
+def get_shard_filters(base_table, low, high):
+    """
+    Base table filters limiting a rule to an id range
+    :param base_table: (string) Exact table name as in DB
+    :param low: (int) smallest id of the range
+    :param high: (int) id after the range
+    :return: (list) SQL conditions, see base_table_filters of JSON2SQLGenerator.generate_sql
+    """
+    return [
+        u'`{table}`.`id` >= {low}'.format(table=base_table, low=int(low)),
+        u'`{table}`.`id` < {high}'.format(table=base_table, high=int(high)),
+    ]
+
+
+def _compile_shards(generator, data, base_table, connection_factories, shards, id_bounds, cursor_class, **kwargs):
+    """
+    Compile the rule for every id range
+    :return: (tuple) (id ranges, SQL of every shard), both in ascending id order, see split_id_range
+    """
+    assert connection_factories, 'At least one connection factory is required'
+    assert not data.get('group_by_fields') and not data.get('having'), \
+        'Group by is not supported when running a rule in shards'
+    if id_bounds is None:
+        connection = connection_factories[0]()
+        try:
+            id_bounds = get_id_bounds(connection, base_table, cursor_class)
+        finally:
+            connection.close()
+
+    base_table_filters = list(kwargs.pop('base_table_filters', None) or ())
+    id_ranges = split_id_range(id_bounds[0], id_bounds[1], shards or len(connection_factories))
+    # The generator is not thread safe, so every shard is compiled here before the workers start
+    return id_ranges, [
+        generator.generate_sql(
+            data, base_table, base_table_filters=base_table_filters + get_shard_filters(base_table, low, high),
+            **kwargs
+        )
+        for low, high in id_ranges
+    ]
+
+
+def run_sharded(connection_factories, shard_queries, run_shard):
+    """
+    Run the queries of the shards concurrently. Every connection factory gets a worker thread which opens
+    one connection and runs shards on it until none are left, so pass a factory several times to run
+    several shards on the same server at once.
+    :param connection_factories: (list) callables returning a new DB-API connection
+    :param shard_queries: (list) SQL of every shard
+    :param run_shard: (callable) run_shard(connection, sql) -> result of the shard
+    :return: (list) results of the shards in the order of shard_queries
+    :raises: the first error raised by a shard, after every worker has stopped
+    """
+    results = [None] * len(shard_queries)
+    errors = []
+
+    def store_result(connection, index, sql):
+        results[index] = run_shard(connection, sql)
+
+    workers = _start_workers(connection_factories, shard_queries, store_result, errors, threading.Event())
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def _start_workers(connection_factories, shard_queries, run_shard, errors, stop):
+    """
+    Start a worker thread per connection factory, see run_sharded. Shards are picked up in the order of
+    shard_queries until none are left, one of them failed or stop is set.
+    :param run_shard: (callable) run_shard(connection, index of the shard, sql) -> None
+    :param errors: (list) errors raised by the workers are appended to it
+    :param stop: (threading.Event) set to stop picking up shards
+    :return: (list) started threads
+    """
+    pending = queue.Queue()
+    for index, sql in enumerate(shard_queries):
+        pending.put((index, sql))
+
+    def work(connection_factory):
+        try:
+            connection = connection_factory()
+        except Exception as e:
+            errors.append(e)
+            return
+        try:
+            # Stop picking up shards once one of them failed
+            while not errors and not stop.is_set():
+                try:
+                    index, sql = pending.get_nowait()
+                except queue.Empty:
+                    return
+                run_shard(connection, index, sql)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    workers = [
+        threading.Thread(target=work, args=(connection_factory, ), name='json2sql-shard-{index}'.format(index=index))
+        for index, connection_factory in enumerate(connection_factories[:len(shard_queries)])
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def count_members_sharded(connection_factories, generator, data, base_table, shards=None, id_bounds=None,
+                          cursor_class=None, **kwargs):
+    """
+    Count the members matching the rule by counting every id range concurrently and summing the counts.
+    The ranges don't overlap, so the sum is the exact count of the whole rule.
+
+    :param connection_factories: (list) callables returning a new DB-API connection, see run_sharded
+    :param generator: (JSON2SQLGenerator) generator used to compile the rule
+    :param data: (dict) rule data, see JSON2SQLGenerator.generate_sql. Group by is not supported.
+    :param base_table: (string) Exact table name as in DB to be used with FROM clause in SQL.
+    :param shards: (int) Number of id ranges, one per connection factory by default
+    :param id_bounds: (tuple) (min id, max id) of the base table, queried with get_id_bounds when not given
+    :param cursor_class: Cursor class passed to connection.cursor(). None uses the default cursor of the connection.
+    :param kwargs: Extra keyword arguments for generate_sql
+    :return: (int) number of matching members
+    """
+    _, shard_queries = _compile_shards(
+        generator, data, base_table, connection_factories, shards, id_bounds, cursor_class,
+        select_mode=JSON2SQLGenerator.SELECT_MODE_COUNT, **kwargs
+    )
+
+    def run_shard(connection, sql):
+        cursor = _get_cursor(connection, cursor_class)
+        try:
+            cursor.execute(format_sql(sql))
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    return sum(run_sharded(connection_factories, shard_queries, run_shard))
+
+
+def iter_member_ids_sharded(connection_factories, generator, data, base_table, shards=None, id_bounds=None,
+                            page_size=JSON2SQLGenerator.DEFAULT_PAGE_SIZE, cursor_class=DEFAULT_CURSOR_CLASS,
+                            **kwargs):
+    """
+    Fetch the ids of the members matching the rule by fetching every id range concurrently, see iter_member_ids.
+    Every shard fetches at most SHARD_BUFFER_PAGES pages ahead of the consumer, so the memory used is bounded
+    by the number of connection factories and page_size. Closing the generator stops the workers.
+
+    :param connection_factories: (list) callables returning a new DB-API connection, see run_sharded
+    :param generator: (JSON2SQLGenerator) generator used to compile the rule
+    :param data: (dict) rule data, see JSON2SQLGenerator.generate_sql. Group by is not supported.
+    :param base_table: (string) Exact table name as in DB to be used with FROM clause in SQL.
+    :param shards: (int) Number of id ranges, one per connection factory by default
+    :param id_bounds: (tuple) (min id, max id) of the base table, queried with get_id_bounds when not given
+    :param page_size: (int) Number of ids fetched by a single query
+    :param cursor_class: Cursor class passed to connection.cursor(). None uses the default cursor of the connection.
+    :param kwargs: Extra keyword arguments for generate_sql
+    :return: (generator) member ids in ascending order
+    """
+    id_ranges, shard_queries = _compile_shards(
+        generator, data, base_table, connection_factories, shards, id_bounds, None,
+        select_mode=JSON2SQLGenerator.SELECT_MODE_MEMBER_IDS, page_size=page_size, **kwargs
+    )
+
+    # Pages of ids of every shard, ended by None
+    shard_pages = [queue.Queue(SHARD_BUFFER_PAGES) for _ in shard_queries]
+    errors = []
+    stop = threading.Event()
+
+    def put(pages, page):
+        # Wait for the consumer, unless it is gone
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run_shard(connection, index, sql):
+        # Pages continue after the last id, so the first page starts just before the range of the shard
+        member_ids = _iter_pages(connection, sql, page_size, id_ranges[index][0] - 1, cursor_class)
+        try:
+            page = []
+            for member_id in member_ids:
+                page.append(member_id)
+                if len(page) == page_size:
+                    if not put(shard_pages[index], page):
+                        return
+                    page = []
+            if page and not put(shard_pages[index], page):
+                return
+            put(shard_pages[index], None)
+        finally:
+            member_ids.close()
+
+    workers = _start_workers(connection_factories, shard_queries, run_shard, errors, stop)
+    try:
+        for pages in shard_pages:
+            while True:
+                try:
+                    page = pages.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    # The shard failed or will never be picked up as another one failed
+                    if errors:
+                        raise errors[0]
+                    continue
+                if page is None:
+                    break
+                for member_id in page:
+                    yield member_id
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
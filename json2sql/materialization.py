@@ -0,0 +1,355 @@
+"""
+Opt-in materialization of hot subqueries and custom methods.
+
+Subqueries and custom methods (e.g. aggregates over the claims of a member) are compiled into every rule using
+them and recomputed by every query. A MaterializationManager attached to a generator counts how often each
+compiled fragment is used by the rules being compiled, materializes the hot ones into summary tables keyed by
+member id and makes the generator use the tables while they are fresh:
+
+    manager = MaterializationManager(lambda: MySQLdb.connect(**settings), min_usage=20, ttl=3600)
+    generator.materializer = manager
+    manager.start(interval=600)     # or call manager.refresh() from a scheduled job
+
+- A subquery is materialized with `CREATE TABLE ... AS <derived table SQL>` and joined instead of the derived
+  table. Subqueries with variable templates are left alone, their rows depend on the member being evaluated,
+  and so are fragments holding %-parameters (see json2sql.prepared.format_sql).
+- A custom method is materialized as the ids of the base table rows matching it and replaced by
+  `base_table.id IN (SELECT member_id FROM <table>)`. Custom methods using columns of joined tables fail to
+  materialize and are not tried again. Custom methods below NOT are never replaced, as the table can't tell
+  members where the custom method is NULL from members where it is false.
+
+Tables are fresh for `ttl` seconds after they are built, so rules using NOW() relative dates see data up to
+`ttl` seconds old. Expired tables are not used by newly compiled SQL anymore and the fragment is rebuilt by the
+next refresh. Refresh also evicts the least recently used fragments beyond `max_tables`. Expired and evicted
+tables are kept until the refresh after that, so SQL compiled before keeps working. Every change of the tables
+bumps `version`, which is part of the cache keys of the generator, so newly compiled SQL uses the current tables.
+"""
+import hashlib
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from json2sql.prepared import SLOT_MARKER, format_sql, has_parameters
+
+logger = logging.getLogger(u'JSON2SQLGenerator.materialization')
+
+FRAGMENT_SUBQUERY = 'subquery'
+FRAGMENT_CUSTOM_METHOD = 'custom_method'
+
+# Dependency kind of the fragments in the dependencies of compiled rules, see JSON2SQLGenerator._collect_dependencies
+MATERIALIZED_FRAGMENT_DEPENDENCY = 'materialized_fragment'
+
+# Member id column of materialized custom methods
+MEMBER_COLUMN = 'member_id'
+
+
+class MaterializedFragment(object):
+    """
+    Usage and materialization state of a compiled subquery or custom method
+    """
+    __slots__ = ('key', 'kind', 'base_table', 'sql', 'member_column', 'usage', 'last_used', 'table',
+                 'generation', 'refreshed_at', 'expired_tables', 'failed')
+
+    def __init__(self, key, kind, base_table, sql, member_column):
+        self.key = key
+        self.kind = kind
+        self.base_table = base_table
+        self.sql = sql
+        self.member_column = member_column
+        self.usage = 0
+        self.last_used = None
+        # Table used by the generator, None when the fragment is not materialized or the table expired
+        self.table = None
+        self.generation = 0
+        self.refreshed_at = None
+        # Tables that may still be used by queries in flight, dropped by the next refresh
+        self.expired_tables = []
+        self.failed = False
+
+    def __repr__(self):
+        return '<MaterializedFragment {kind} {key} usage={usage} table={table}>'.format(
+            kind=self.kind, key=self.key, usage=self.usage, table=self.table
+        )
+
+
+class MaterializationManager(object):
+    """
+    Tracks the usage of compiled fragments and maintains the summary tables of the hot ones
+    """
+
+    def __init__(self, connection_factory, min_usage=10, ttl=3600, max_tables=20, max_candidates=1000,
+                 table_prefix='json2sql_mat_', cursor_class=None, clock=time.time):
+        """
+        :param connection_factory: (callable) returns a new DB-API connection used to build and drop the tables
+        :param min_usage: (int) Number of uses after which a fragment is materialized by refresh
+        :param ttl: (int|float) Seconds a table is used after it was built
+        :param max_tables: (int) Maximum number of materialized fragments, the least recently used are dropped
+        :param max_candidates: (int) Maximum number of fragments whose usage is tracked
+        :param table_prefix: (str) Prefix of the names of the tables
+        :param cursor_class: Cursor class passed to connection.cursor(). None uses the default cursor of the connection.
+        :param clock: (callable) returns the current time in seconds
+        """
+        assert min_usage > 0 and ttl > 0 and max_tables > 0, 'Limits must be positive'
+        self.connection_factory = connection_factory
+        self.min_usage = min_usage
+        self.ttl = ttl
+        self.max_tables = max_tables
+        self.max_candidates = max_candidates
+        self.table_prefix = table_prefix
+        self.cursor_class = cursor_class
+        self.clock = clock
+        self.version = 0
+        # key -> MaterializedFragment, least recently registered first
+        self._fragments = OrderedDict()
+        self._lock = threading.RLock()
+        self._stop_event = None
+        self._thread = None
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def get_fragment(self, key):
+        return self._fragments.get(key)
+
+    def register(self, kind, base_table, sql, member_column=None):
+        """
+        Called by the generator for every compiled subquery and custom method
+        :param kind: (str) FRAGMENT_SUBQUERY or FRAGMENT_CUSTOM_METHOD
+        :param base_table: (string) base table the fragment was compiled for
+        :param sql: (unicode) SQL of the derived table or the condition
+        :param member_column: (str) column of a subquery holding the member id
+        :return: (str|None) key of the fragment, None when the fragment can't be materialized
+        """
+        # Late bound values differ for every member, and parameters (e.g. the last id of a page) for every run
+        if SLOT_MARKER in sql or '{' in sql or has_parameters(sql):
+            return None
+        key = hashlib.sha1(repr((kind, base_table, sql)).encode('utf8')).hexdigest()[:16]
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                fragment = MaterializedFragment(
+                    key, kind, base_table, sql, member_column if kind == FRAGMENT_SUBQUERY else MEMBER_COLUMN
+                )
+                self._fragments[key] = fragment
+                self._discard_candidates()
+            else:
+                self._fragments.move_to_end(key)
+        return key
+
+    def _discard_candidates(self):
+        """
+        Forget the least recently registered fragments which are not materialized when there are too many
+        """
+        excess = len(self._fragments) - self.max_candidates
+        if excess <= 0:
+            return
+        for key in [key for key, fragment in self._fragments.items()
+                    if fragment.table is None and not fragment.expired_tables][:excess]:
+            del self._fragments[key]
+
+    def get_fresh_table(self, key):
+        """
+        :param key: (str) key returned by register
+        :return: (str|None) name of the table of the fragment, None when it is not materialized or expired
+        """
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None or fragment.table is None:
+                return None
+            if self._is_expired(fragment):
+                self._expire(fragment)
+                return None
+            return fragment.table
+
+    def record_usage(self, dependencies):
+        """
+        Count a use of every fragment in the dependencies of a compiled rule
+        :param dependencies: (iterable) dependencies of the rule, see JSON2SQLGenerator._collect_dependencies
+        :return: (bool) False when a table used by the rule expired, the rule needs to be compiled again
+        """
+        now = self.clock()
+        current = True
+        with self._lock:
+            for kind, key in dependencies:
+                if kind != MATERIALIZED_FRAGMENT_DEPENDENCY:
+                    continue
+                fragment = self._fragments.get(key)
+                if fragment is None:
+                    continue
+                fragment.usage += 1
+                fragment.last_used = now
+                if fragment.table is not None and self._is_expired(fragment):
+                    self._expire(fragment)
+                    current = False
+        return current
+
+    def _is_expired(self, fragment):
+        return self.clock() - fragment.refreshed_at >= self.ttl
+
+    def _expire(self, fragment):
+        fragment.expired_tables.append(fragment.table)
+        fragment.table = None
+        self.version += 1
+
+    def hot_fragments(self):
+        """
+        :return: (list) fragments used at least min_usage times, most recently used first
+        """
+        with self._lock:
+            fragments = [
+                fragment for fragment in self._fragments.values()
+                if fragment.usage >= self.min_usage and not fragment.failed
+            ]
+        return sorted(fragments, key=lambda fragment: -fragment.last_used)
+
+    def materialize(self, key):
+        """
+        Build or rebuild the table of a fragment. The previous table is kept until the next refresh, so queries
+        compiled before keep working.
+        :param key: (str) key returned by register
+        :return: (str|None) name of the table, None when the fragment could not be materialized
+        """
+        with self._lock:
+            fragment = self._fragments[key]
+            generation = fragment.generation + 1
+        table = '{prefix}{key}_{generation}'.format(prefix=self.table_prefix, key=key, generation=generation)
+        try:
+            self._execute(self._get_build_statements(fragment, table))
+        except Exception:
+            logger.warning('Could not materialize %s %s', fragment.kind, key, exc_info=True)
+            with self._lock:
+                fragment.failed = True
+            self._drop_tables([table])
+            return None
+
+        with self._lock:
+            if fragment.table is not None:
+                fragment.expired_tables.append(fragment.table)
+            fragment.table = table
+            fragment.generation = generation
+            fragment.refreshed_at = self.clock()
+            self.version += 1
+        return table
+
+    def evict(self, key):
+        """
+        Stop using the table of a fragment. Like an expired table, it is dropped by the next refresh.
+        Usage of the fragment is reset.
+        :param key: (str) key returned by register
+        :return: None
+        """
+        with self._lock:
+            fragment = self._fragments[key]
+            if fragment.table is not None:
+                self._expire(fragment)
+            fragment.usage = 0
+
+    def refresh(self):
+        """
+        Drop expired tables, evict the least recently used fragments beyond max_tables and build the tables of
+        hot fragments that are not fresh
+        :return: (list) keys of the fragments that were materialized
+        """
+        with self._lock:
+            # Only tables which expired before this refresh are dropped. SQL compiled before a table expires
+            # now may still be cached or running, so such tables are left for the next refresh.
+            retired = []
+            for fragment in self._fragments.values():
+                retired.extend(fragment.expired_tables)
+                fragment.expired_tables = []
+                if fragment.table is not None and self._is_expired(fragment):
+                    self._expire(fragment)
+        self._drop_tables(retired)
+
+        hot = self.hot_fragments()
+        keep = set(fragment.key for fragment in hot[:self.max_tables])
+        for fragment in list(self._fragments.values()):
+            if fragment.table is not None and fragment.key not in keep:
+                self.evict(fragment.key)
+
+        materialized = []
+        for fragment in hot[:self.max_tables]:
+            if fragment.table is None and self.materialize(fragment.key):
+                materialized.append(fragment.key)
+        return materialized
+
+    def start(self, interval):
+        """
+        Call refresh every `interval` seconds on a daemon thread
+        :param interval: (int|float) seconds between refreshes
+        :return: None
+        """
+        assert self._thread is None, 'Refresh thread is already running'
+        self._stop_event = threading.Event()
+
+        def run():
+            while not self._stop_event.wait(interval):
+                try:
+                    self.refresh()
+                except Exception:
+                    logger.exception('Refreshing materialized fragments failed')
+
+        self._thread = threading.Thread(target=run, name='json2sql-materialization')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the refresh thread
+        """
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def drop_all(self):
+        """
+        Drop every table right away and forget the usage of all fragments.
+        Only call it once no SQL using the tables is run anymore, e.g. when shutting down.
+        """
+        with self._lock:
+            tables = []
+            for fragment in self._fragments.values():
+                tables.extend(fragment.expired_tables + ([fragment.table] if fragment.table else []))
+            self._fragments.clear()
+            self.version += 1
+        self._drop_tables(tables)
+
+    def _get_build_statements(self, fragment, table):
+        """
+        SQL statements creating the table of a fragment
+        """
+        sql = format_sql(fragment.sql)
+        if fragment.kind == FRAGMENT_CUSTOM_METHOD:
+            sql = u'SELECT DISTINCT `{base_table}`.`id` AS `{column}` FROM `{base_table}` WHERE {condition}'.format(
+                base_table=fragment.base_table, column=fragment.member_column, condition=sql
+            )
+        return [
+            u'CREATE TABLE `{table}` AS {sql}'.format(table=table, sql=sql),
+            u'CREATE INDEX `{table}_member` ON `{table}` (`{column}`)'.format(
+                table=table, column=fragment.member_column
+            ),
+        ]
+
+    def _drop_tables(self, tables):
+        if not tables:
+            return
+        try:
+            self._execute([u'DROP TABLE IF EXISTS `{table}`'.format(table=table) for table in tables])
+        except Exception:
+            logger.warning('Could not drop materialized tables %s', tables, exc_info=True)
+
+    def _execute(self, statements):
+        connection = self.connection_factory()
+        try:
+            cursor = connection.cursor(self.cursor_class) if self.cursor_class else connection.cursor()
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+            finally:
+                cursor.close()
+            connection.commit()
+        finally:
+            connection.close()
@@ -0,0 +1,136 @@
+"""
+Compiled rules with late bound values.
+
+`JSON2SQLGenerator.generate_sql(data, base_table, prepared=True)` returns a PreparedRule instead of SQL with
+`{keyword}` placeholders. The SQL is split once at the slots of variable templates, variable template
+parameters of custom methods and subqueries, and the current time used by dynamic dates. bind() then only
+validates the values and joins the segments, so binding a large query for every member is cheap and literal
+braces in the SQL are left alone:
+
+    rule = generator.generate_sql(data, 'patients_member', prepared=True)
+    rule.slots                      # ('member_age', )
+    sql = rule.bind(member_age=42)  # now defaults to NOW()
+    cursor.execute(format_sql(sql))
+"""
+import datetime
+
+from json2sql.codecs import PASSTHROUGH_CODEC, get_codec
+
+# Slots are written in the compiled SQL as SLOT_MARKER + name + SLOT_MARKER.
+# Escaped values never contain NUL bytes (MySQLdb.escape_string turns them into \0), so the marker can't clash.
+SLOT_MARKER = '\x00'
+
+# Slot for the current time used by dynamic dates
+NOW_SLOT = 'now'
+
+
+def format_sql(sql, params=None):
+    """
+    Interpolate the parameters of compiled SQL. Compiled SQL is %-formatted before it is run, the same way
+    MySQLdb does it on the client, so %% stand for % and %(name)s for a parameter, e.g. the last id of the
+    previous page in member ids select mode.
+    :param sql: (unicode) compiled SQL
+    :param params: (dict) parameter name -> value, already escaped
+    :return: (unicode) SQL to run
+    """
+    return sql % (params or {})
+
+
+def has_parameters(sql):
+    """
+    :param sql: (unicode) compiled SQL
+    :return: (bool) whether the SQL holds parameters (or a % which is not escaped) to be filled by format_sql
+    """
+    return '%' in sql.replace('%%', '')
+
+
+def slot(name):
+    """
+    Mark a slot in compiled SQL
+    :param name: (str) name of the slot
+    :return: (str) marker placed in the SQL
+    """
+    return '{marker}{name}{marker}'.format(marker=SLOT_MARKER, name=name)
+
+
+class PreparedRule(object):
+    """
+    SQL of a rule split into segments around the late bound slots.
+    """
+    __slots__ = ('segments', 'slots', '_codecs')
+
+    # Values of slots that don't have to be bound
+    DEFAULTS = {NOW_SLOT: 'NOW()'}
+
+    def __init__(self, sql, slot_types):
+        """
+        :param sql: (str) SQL compiled in prepared mode
+        :param slot_types: (dict) slot name -> data type of the value. Values of data types without a codec are
+                           quoted as strings.
+        :raises ValueError: when a slot has no data type
+        """
+        parts = sql.split(SLOT_MARKER)
+        assert len(parts) % 2, 'Unbalanced slot markers in SQL'
+        self.segments = tuple(parts[0::2])
+        # Slot name for every gap between two segments, a slot can be used several times
+        self.slots = tuple(parts[1::2])
+        untyped = set(self.slots) - set(slot_types)
+        if untyped:
+            raise ValueError('Unknown data type of slots: {names}'.format(names=', '.join(sorted(untyped))))
+        self._codecs = {name: self._get_codec(slot_types[name]) for name in set(self.slots)}
+
+    def __repr__(self):
+        return '<PreparedRule slots={slots}>'.format(slots=sorted(self._codecs))
+
+    @property
+    def slot_names(self):
+        """
+        :return: (set) names of the slots that can be bound
+        """
+        return set(self._codecs)
+
+    def bind(self, **values):
+        """
+        Validate the values against the data types of the slots and build the SQL.
+        Values for names that are not slots of the rule are ignored, so a whole context can be passed.
+        Like any compiled SQL, the result has `%` doubled and must be run through format_sql.
+        :param values: slot name -> value. Dates and datetimes can be passed as date and datetime objects.
+        :return: (str) compiled SQL
+        :raises ValueError: when a value is missing or invalid
+        """
+        formatted = {}
+        missing = []
+        for name, codec in self._codecs.items():
+            if name in values:
+                formatted[name] = codec.to_sql(self._to_literal(values[name]))
+            elif name in self.DEFAULTS:
+                formatted[name] = self.DEFAULTS[name]
+            else:
+                missing.append(name)
+        if missing:
+            raise ValueError('Missing values for slots: {names}'.format(names=', '.join(sorted(missing))))
+
+        pieces = [self.segments[0]]
+        for name, segment in zip(self.slots, self.segments[1:]):
+            pieces.append(formatted[name])
+            pieces.append(segment)
+        return ''.join(pieces)
+
+    @staticmethod
+    def _get_codec(data_type):
+        """
+        Bound values are put in the query, so they are never passed through unescaped
+        """
+        codec = get_codec(data_type)
+        return get_codec('string') if codec is PASSTHROUGH_CODEC else codec
+
+    @staticmethod
+    def _to_literal(value):
+        """
+        Convert date and datetime objects to the strings accepted by the codecs
+        """
+        if isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%dT%H:%M:%S')
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+        return value
@@ -0,0 +1,101 @@
+"""
+Compact records used to store the knowledge base of JSON2SQLGenerator.
+
+Every record is a namedtuple (which has empty `__slots__`), so an entry costs a single tuple
+instead of a dict. Strings are interned and identical field and path records are shared
+through a RecordPool, so generators of different tenants built from the same schema
+reference the same objects. Generators use the process wide DEFAULT_RECORD_POOL unless given
+another one; GeneratorRegistry uses its own pool and drops the records of evicted generators from it.
+"""
+import sys
+import threading
+
+from collections import namedtuple
+
+FieldRecord = namedtuple('FieldRecord', ['field_name', 'table_name', 'data_type', 'fulltext'], defaults=(False, ))
+
+PathRecord = namedtuple(
+    'PathRecord', ['join_column', 'parent_column', 'join_table_active_field', 'cardinality', 'weight'],
+    defaults=(None, None)
+)
+
+CustomMethodRecord = namedtuple('CustomMethodRecord', ['template_str', 'parameters'])
+
+SubqueryRecord = namedtuple('SubqueryRecord', ['template_str', 'parameters', 'fields', 'is_sql'])
+
+VariableTemplateRecord = namedtuple('VariableTemplateRecord', ['keyword', 'return_type'])
+
+FieldStatisticsRecord = namedtuple('FieldStatisticsRecord', ['distinct_count', 'null_fraction', 'cost_class'])
+
+ChallengeCheckRecord = namedtuple('ChallengeCheckRecord', [
+    'table', 'challenge_column', 'completed_column', 'member_column', 'correlated_table', 'correlated_column'
+])
+
+
+def intern_value(value):
+    """
+    Intern the value if it is a string
+    :param value: Any value
+    :return: interned string or the value itself
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+class RecordPool(object):
+    """
+    Records shared by the generators using the pool. Thread safe.
+    Records are tuples, which can't be weakly referenced, so records of generators that are gone stay in the
+    pool until retain or clear is called.
+    """
+
+    def __init__(self):
+        # (record class, record) -> record. Records of different classes with same values compare equal,
+        # so key by class as well
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, record):
+        return (type(record), record) in self._records
+
+    def share(self, record_cls, *values):
+        """
+        Create a record with interned values and return the pooled instance of it.
+        :param record_cls: (type) One of the hashable record classes (FieldRecord, PathRecord)
+        :param values: values of the record fields
+        :return: record instance shared across generators
+        """
+        return self.add(record_cls(*[intern_value(value) for value in values]))
+
+    def add(self, record):
+        """
+        Return the pooled instance of an existing record, adding it to the pool when it is not present.
+        Cheaper than share when the record is already built, e.g. when loaded from a snapshot.
+        :param record: (FieldRecord|PathRecord) record instance
+        :return: record instance shared across generators
+        """
+        with self._lock:
+            return self._records.setdefault((type(record), record), record)
+
+    def retain(self, records):
+        """
+        Drop every record that is not in records from the pool
+        :param records: (iterable) records still in use, see JSON2SQLGenerator.iter_records
+        :return: None
+        """
+        keys = {(type(record), record) for record in records}
+        with self._lock:
+            self._records = {key: record for key, record in self._records.items() if key in keys}
+
+    def clear(self):
+        with self._lock:
+            self._records = {}
+
+
+# Records shared by the generators in the process which are not given a pool.
+# Schema of every tenant is a subset of the same database schema so this stays bounded.
+DEFAULT_RECORD_POOL = RecordPool()
@@ -0,0 +1,249 @@
+"""
+Registry of generators for many tenants.
+
+Every tenant has its own knowledge base. The registry builds the generator of a tenant on first use from a
+loader callback, shares one generator between tenants whose knowledge bases have the same content, and
+drops the least recently used generators when their total size goes over a memory budget:
+
+    registry = GeneratorRegistry(load_tenant_knowledge_base, memory_budget=512 * 1024 * 1024)
+    sql = registry.get(tenant_id).generate_sql(data, 'patients_member')
+
+    # At worker start, build the generators of the busiest tenants in the background
+    registry.start_prewarm(busiest_tenant_ids)
+
+The size of a generator is estimated from the length of its knowledge base JSON, see estimate_size. The
+generators of a registry share their field and path records through the RecordPool of the registry, and the
+records only used by evicted generators are dropped from it.
+Generators can be shared between tenants, so don't change their knowledge base in place; call
+invalidate(tenant_id) when the knowledge base of a tenant changes. Generators are not thread safe, use a
+registry per thread or serialise the calls on a generator.
+"""
+import hashlib
+import json
+import logging
+import threading
+
+from collections import Counter, OrderedDict
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.records import RecordPool
+
+logger = logging.getLogger(u'JSON2SQLGenerator.registry')
+
+# A parsed generator with warm caches takes a few times the size of its knowledge base JSON
+SIZE_PER_JSON_BYTE = 4
+
+
+def estimate_size(encoded_knowledge_base):
+    """
+    Estimate the memory used by a generator
+    :param encoded_knowledge_base: (bytes) canonical JSON of the knowledge base
+    :return: (int) estimated size in bytes
+    """
+    return len(encoded_knowledge_base) * SIZE_PER_JSON_BYTE
+
+
+class _RegistryEntry(object):
+    __slots__ = ('generator', 'size', 'tenants')
+
+    def __init__(self, generator, size):
+        self.generator = generator
+        self.size = size
+        self.tenants = set()
+
+
+class GeneratorRegistry(object):
+    """
+    Lazily built, deduplicated and memory bounded generators of tenants
+    """
+
+    def __init__(self, loader, memory_budget, cache_size=JSON2SQLGenerator.DEFAULT_CACHE_SIZE,
+                 generator_cls=JSON2SQLGenerator, sizeof=estimate_size):
+        """
+        :param loader: (callable) loader(tenant_id) -> knowledge base dict accepted by JSON2SQLGenerator
+        :param memory_budget: (int) Maximum total estimated size of the generators in bytes. The generator
+                              being returned is kept even when it alone is over the budget.
+        :param cache_size: (int) cache_size of the generators
+        :param generator_cls: (type) class of the generators
+        :param sizeof: (callable) sizeof(canonical JSON bytes) -> estimated size of the generator
+        """
+        self.loader = loader
+        self.memory_budget = memory_budget
+        self.cache_size = cache_size
+        self.generator_cls = generator_cls
+        self.sizeof = sizeof
+        # content hash -> _RegistryEntry, least recently used first
+        self._entries = OrderedDict()
+        # tenant id -> content hash
+        self._tenants = {}
+        self.total_size = 0
+        # Number of get calls per tenant, used to pick the tenants to prewarm
+        self.activity = Counter()
+        self.stats = Counter()
+        self.record_pool = RecordPool()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, tenant_id):
+        return tenant_id in self._tenants
+
+    def get(self, tenant_id):
+        """
+        Get the generator of a tenant, building it when it is not in the registry
+        :param tenant_id: (hashable) tenant identifier passed to the loader
+        :return: (JSON2SQLGenerator) generator
+        """
+        with self._lock:
+            self.activity[tenant_id] += 1
+            content_hash = self._tenants.get(tenant_id)
+            if content_hash is not None:
+                self._entries.move_to_end(content_hash)
+                self.stats['hits'] += 1
+                return self._entries[content_hash].generator
+        return self._load(tenant_id)
+
+    def _load(self, tenant_id, fit_only=False):
+        """
+        Load the knowledge base of a tenant and build its generator unless a generator with the same
+        knowledge base is in the registry already
+        :param fit_only: (bool) Return None instead of building a generator that doesn't fit in the budget
+        """
+        knowledge_base = self.loader(tenant_id)
+        encoded = json.dumps(knowledge_base, sort_keys=True, separators=(',', ':'), default=str).encode('utf8')
+        content_hash = hashlib.sha1(encoded).hexdigest()
+
+        with self._lock:
+            shared = content_hash in self._entries
+            if fit_only and not shared and self.total_size + self.sizeof(encoded) > self.memory_budget:
+                return None
+        # Built outside of the lock, parsing a large knowledge base takes a while
+        generator = None if shared else self._build(knowledge_base)
+
+        with self._lock:
+            self.stats['misses'] += 1
+            entry = self._entries.get(content_hash)
+            if entry is None:
+                if generator is None:
+                    # The shared generator was evicted in the meantime
+                    generator = self._build(knowledge_base)
+                # Traced SQL names the knowledge base it was compiled from, see json2sql.tracing
+                generator.knowledge_base_version = content_hash[:12]
+                entry = _RegistryEntry(generator, self.sizeof(encoded))
+                self._entries[content_hash] = entry
+                self.total_size += entry.size
+                self.stats['builds'] += 1
+            else:
+                self.stats['shared'] += 1
+            if self._tenants.get(tenant_id) != content_hash:
+                self._discard_tenant(tenant_id)
+            entry.tenants.add(tenant_id)
+            self._tenants[tenant_id] = content_hash
+            self._entries.move_to_end(content_hash)
+            self._evict()
+        return entry.generator
+
+    def _build(self, knowledge_base):
+        return self.generator_cls(knowledge_base, cache_size=self.cache_size, record_pool=self.record_pool)
+
+    def _evict(self):
+        """
+        Drop the least recently used generators until the total size is within the memory budget.
+        The most recently used generator is the one being returned, so it is always kept.
+        """
+        evicted = False
+        while self.total_size > self.memory_budget and len(self._entries) > 1:
+            content_hash = next(iter(self._entries))
+            entry = self._entries.pop(content_hash)
+            self.total_size -= entry.size
+            for tenant_id in entry.tenants:
+                del self._tenants[tenant_id]
+            self.stats['evictions'] += 1
+            evicted = True
+        if evicted:
+            self._release_records()
+
+    def _release_records(self):
+        """
+        Drop the records which are not used by any generator in the registry from the record pool.
+        A generator being built concurrently loses the sharing of its records with later generators, nothing else.
+        """
+        self.record_pool.retain(
+            record for entry in self._entries.values() for record in entry.generator.iter_records()
+        )
+
+    def _discard_tenant(self, tenant_id):
+        """
+        Remove a tenant from its entry, dropping the entry when no other tenant uses it
+        """
+        content_hash = self._tenants.pop(tenant_id, None)
+        if content_hash is None:
+            return
+        entry = self._entries[content_hash]
+        entry.tenants.discard(tenant_id)
+        if not entry.tenants:
+            del self._entries[content_hash]
+            self.total_size -= entry.size
+            self._release_records()
+
+    def invalidate(self, tenant_id):
+        """
+        Forget the generator of a tenant, the next get loads the knowledge base again
+        :param tenant_id: (hashable) tenant identifier
+        :return: None
+        """
+        with self._lock:
+            self._discard_tenant(tenant_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tenants.clear()
+            self.total_size = 0
+            self.record_pool.clear()
+
+    def most_active(self, limit):
+        """
+        :param limit: (int) number of tenants
+        :return: (list) ids of the tenants with the most get calls, busiest first
+        """
+        with self._lock:
+            return [tenant_id for tenant_id, _ in self.activity.most_common(limit)]
+
+    def prewarm(self, tenant_ids):
+        """
+        Build the generators of the tenants which are not in the registry yet.
+        Stops at the first generator that doesn't fit in the memory budget, so prewarming never evicts a
+        generator and the tenants should be ordered busiest first. Tenants whose knowledge base fails to load
+        are logged and skipped.
+        :param tenant_ids: (iterable) tenant identifiers
+        :return: (int) number of tenants loaded
+        """
+        loaded = 0
+        for tenant_id in tenant_ids:
+            with self._lock:
+                if tenant_id in self._tenants:
+                    continue
+            try:
+                if self._load(tenant_id, fit_only=True) is None:
+                    break
+            except Exception:
+                logger.warning('Could not prewarm tenant %s', tenant_id, exc_info=True)
+                continue
+            loaded += 1
+        return loaded
+
+    def start_prewarm(self, tenant_ids=None, limit=100):
+        """
+        Prewarm on a daemon thread
+        :param tenant_ids: (iterable) tenant identifiers, busiest first. By default the `limit` most active
+                           tenants seen by this registry, see most_active.
+        :param limit: (int) number of most active tenants used when tenant_ids is not given
+        :return: (threading.Thread) the started thread
+        """
+        tenant_ids = list(tenant_ids) if tenant_ids is not None else self.most_active(limit)
+        thread = threading.Thread(target=self.prewarm, args=(tenant_ids, ), name='json2sql-registry-prewarm')
+        thread.daemon = True
+        thread.start()
+        return thread
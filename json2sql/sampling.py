@@ -0,0 +1,122 @@
+"""
+Approximate member counts from a deterministic sample of the base table.
+
+`JSON2SQLGenerator.generate_sql(data, base_table, sample_rate=0.01)` adds a filter keeping about 1% of the base
+table ids. The filter is a base table filter, so it is pushed down into the JSON subqueries as well and the
+database only evaluates the rule for the sampled members. The count of the sample is scaled back up with
+estimate_count, which also reports an error bound:
+
+    estimate = count_members_approximate(connection, generator, data, 'patients_member', sample_rate=0.01)
+    estimate.count, estimate.error      # e.g. (125300, 2170), the count is within 125300 +- 2170 at 95%
+
+The same ids are sampled every time, so previews of a rule that is being edited don't jump around.
+Two sampling methods are supported:
+- SAMPLING_MODULO keeps ids where MOD(id, N) = 0 with N = round(1 / sample_rate). Cheap, and a range scan of
+  the primary key still works, but ids assigned in a pattern (e.g. every N-th id for a kind of member) skew it.
+- SAMPLING_HASH keeps ids whose CRC32 falls in the first sample_rate of HASH_BUCKETS buckets. Independent of
+  how ids are assigned. CRC32 is a MySQL function, register it on other databases, e.g. for sqlite3:
+  connection.create_function('CRC32', 1, lambda value: zlib.crc32(str(value).encode()))
+"""
+import math
+
+from collections import namedtuple
+
+from json2sql.prepared import format_sql
+
+SAMPLING_MODULO = 'modulo'
+SAMPLING_HASH = 'hash'
+SAMPLING_METHODS = (SAMPLING_MODULO, SAMPLING_HASH)
+
+# Resolution of the hash sampling rate
+HASH_BUCKETS = 10000
+
+# z score of the reported error bound, 95% confidence
+DEFAULT_CONFIDENCE_Z = 1.96
+
+CountEstimate = namedtuple('CountEstimate', ['count', 'error', 'sample_count', 'sample_rate'])
+
+
+def _validate_sample_rate(sample_rate, method):
+    assert method in SAMPLING_METHODS, 'Unsupported sampling method: {method}'.format(method=method)
+    assert 0 < sample_rate <= 1, 'Sample rate must be in (0, 1]: {rate}'.format(rate=sample_rate)
+
+
+def get_effective_sample_rate(sample_rate, method=SAMPLING_MODULO):
+    """
+    Get the rate actually sampled by get_sample_filter, the requested rate is rounded to what the method supports
+    :param sample_rate: (float) requested fraction of the ids
+    :param method: (str) one of SAMPLING_METHODS
+    :return: (float) fraction of the ids kept by the filter
+    """
+    _validate_sample_rate(sample_rate, method)
+    if method == SAMPLING_MODULO:
+        return 1.0 / max(int(round(1.0 / sample_rate)), 1)
+    return max(int(round(sample_rate * HASH_BUCKETS)), 1) / float(HASH_BUCKETS)
+
+
+def get_sample_filter(base_table, sample_rate, method=SAMPLING_MODULO):
+    """
+    SQL condition keeping a deterministic sample of the base table ids
+    :param base_table: (string) Exact table name as in DB
+    :param sample_rate: (float) fraction of the ids to keep, in (0, 1]
+    :param method: (str) one of SAMPLING_METHODS
+    :return: (unicode|None) SQL condition, None when every id is kept
+    """
+    sample_rate = get_effective_sample_rate(sample_rate, method)
+    if sample_rate >= 1:
+        return None
+    # MOD instead of the % operator, the SQL is %-formatted in the member ids select mode
+    if method == SAMPLING_MODULO:
+        return u'MOD(`{table}`.`id`, {modulus}) = 0'.format(table=base_table, modulus=int(round(1 / sample_rate)))
+    return u'MOD(CRC32(`{table}`.`id`), {buckets}) < {kept}'.format(
+        table=base_table, buckets=HASH_BUCKETS, kept=int(round(sample_rate * HASH_BUCKETS))
+    )
+
+
+def estimate_count(sample_count, sample_rate, method=SAMPLING_MODULO, z=DEFAULT_CONFIDENCE_Z):
+    """
+    Scale the count of a sample up to the whole base table.
+    Every member is treated as sampled independently with probability sample_rate, so the standard error of
+    the estimate is sqrt(sample_count * (1 - rate)) / rate. An empty sample is treated as one member, so it
+    still reports how many members could have been missed.
+    :param sample_count: (int) number of sampled members matching the rule
+    :param sample_rate: (float) sample rate passed to generate_sql
+    :param method: (str) sampling method passed to generate_sql
+    :param z: (float) z score of the error bound
+    :return: (CountEstimate) estimated count, error bound (the count is within count +- error), the count of
+             the sample and the effective sample rate
+    """
+    rate = get_effective_sample_rate(sample_rate, method)
+    standard_error = math.sqrt(max(sample_count, 1) * (1 - rate)) / rate
+    return CountEstimate(
+        count=int(round(sample_count / rate)),
+        error=int(math.ceil(z * standard_error)),
+        sample_count=sample_count,
+        sample_rate=rate
+    )
+
+
+def count_members_approximate(connection, generator, data, base_table, sample_rate, method=SAMPLING_MODULO,
+                              cursor_class=None, **kwargs):
+    """
+    Estimate the number of members matching the rule from a sample of the base table
+    :param connection: DB-API connection
+    :param generator: (JSON2SQLGenerator) generator used to compile the rule
+    :param data: (dict) rule data, see JSON2SQLGenerator.generate_sql. Group by is not supported.
+    :param base_table: (string) Exact table name as in DB to be used with FROM clause in SQL.
+    :param sample_rate: (float) fraction of the ids to sample, in (0, 1]
+    :param method: (str) one of SAMPLING_METHODS
+    :param cursor_class: Cursor class passed to connection.cursor(). None uses the default cursor of the connection.
+    :param kwargs: Extra keyword arguments for generate_sql
+    :return: (CountEstimate) estimate
+    """
+    assert not data.get('group_by_fields') and not data.get('having'), \
+        'Group by is not supported when estimating the count'
+    sql = generator.generate_sql(data, base_table, sample_rate=sample_rate, sampling_method=method, **kwargs)
+    cursor = connection.cursor(cursor_class) if cursor_class else connection.cursor()
+    try:
+        cursor.execute(format_sql(sql))
+        sample_count = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    return estimate_count(sample_count, sample_rate, method)
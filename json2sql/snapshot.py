@@ -0,0 +1,109 @@
+"""
+Versioned binary snapshots of a validated knowledge base.
+
+A snapshot stores the knowledge base after JSON2SQLGenerator has parsed and validated it, so workers
+can start without decoding JSON, validating templates or rebuilding path maps:
+
+    generator = JSON2SQLGenerator(data)
+    save_snapshot(generator, '/var/lib/json2sql/tenant.kb')
+
+    generator = load_snapshot('/var/lib/json2sql/tenant.kb')
+
+The knowledge base is stored as a pickle and loading runs pickle.load, which can execute arbitrary code.
+Only load snapshots from a trusted path written by save_snapshot. Load the snapshots in the parent
+process before forking the workers, so every worker doesn't load them again.
+"""
+import json
+import os
+import pickle
+import struct
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.records import DEFAULT_RECORD_POOL
+
+SNAPSHOT_MAGIC = b'J2SQLKB\x00'
+# Bump the version whenever records or knowledge base attributes change
+SNAPSHOT_VERSION = 6
+
+_HEADER = struct.Struct('>8sH')
+
+
+def save_snapshot(generator, path):
+    """
+    Write the knowledge base of the generator to a snapshot file.
+    The file is written to a temporary file first and then moved, so readers never see a partial file.
+
+    :param generator: (JSON2SQLGenerator) generator whose knowledge base needs to be stored
+    :param path: (str) path of the snapshot file
+    :return: None
+    """
+    payload = pickle.dumps(generator.export_knowledge_base(), protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path = '{path}.tmp.{pid}'.format(path=path, pid=os.getpid())
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+        snapshot_file.write(payload)
+    os.replace(tmp_path, path)
+
+
+def is_snapshot(path):
+    """
+    Check if the file at path is a snapshot
+    :param path: (str) path of the file
+    :return: (bool) True if the file starts with the snapshot magic bytes
+    """
+    with open(path, 'rb') as snapshot_file:
+        return snapshot_file.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def load_generator(path):
+    """
+    Create a generator from a knowledge base JSON file or a snapshot
+    :param path: (str) path of the file
+    :return: (JSON2SQLGenerator) generator
+    """
+    if is_snapshot(path):
+        return load_snapshot(path)
+    with open(path) as knowledge_base_file:
+        return JSON2SQLGenerator(json.load(knowledge_base_file))
+
+
+def load_snapshot(path, generator_cls=JSON2SQLGenerator, record_pool=DEFAULT_RECORD_POOL):
+    """
+    Load a generator from a snapshot file without validating the knowledge base again.
+    The file is unpickled, so it must come from a trusted path.
+
+    :param path: (str) path of the snapshot file
+    :param generator_cls: (type) JSON2SQLGenerator or a subclass of it
+    :param record_pool: (RecordPool) pool sharing the field and path records with other generators
+    :return: (JSON2SQLGenerator) generator instance
+    """
+    with open(path, 'rb') as snapshot_file:
+        header = snapshot_file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError('Not a valid knowledge base snapshot: {path}'.format(path=path))
+        magic, version = _HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('Not a valid knowledge base snapshot: {path}'.format(path=path))
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version {version}, expected {expected}'.format(
+                version=version, expected=SNAPSHOT_VERSION
+            ))
+        knowledge_base = pickle.load(snapshot_file)
+
+    _share_records(knowledge_base, record_pool)
+    return generator_cls.from_knowledge_base(knowledge_base, record_pool=record_pool)
+
+
+def _share_records(knowledge_base, record_pool):
+    """
+    Unpickled records are new objects, replace them with the records shared by other generators using the pool.
+    :param knowledge_base: (dict) knowledge base loaded from the snapshot
+    :param record_pool: (RecordPool) pool of shared records
+    :return: None
+    """
+    field_mapping = knowledge_base['field_mapping']
+    for field_id, record in field_mapping.items():
+        field_mapping[field_id] = record_pool.add(record)
+    for parents in knowledge_base['path_mapping'].values():
+        for parent_table, record in parents.items():
+            parents[parent_table] = record_pool.add(record)
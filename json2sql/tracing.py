@@ -0,0 +1,180 @@
+"""
+Provenance comments and latency tracking for generated SQL.
+
+`JSON2SQLGenerator.generate_sql(data, base_table, trace_tags={'rule_id': 42, 'tenant': 'acme'})` starts the
+query and every derived table of its subqueries with a comment naming the rule, the knowledge base version
+(generator.knowledge_base_version) and the fingerprint of the SQL, so a query in the MySQL slow log can be
+traced back to the rule and subquery that produced it:
+
+    /* json2sql rule_id=42 tenant=acme kb_version=3f2a9c fingerprint=8d1e4b6a0c2f9e17 */ SELECT ...
+
+The fingerprint is a hash of the SQL with literals replaced by placeholders, so it is the same for every rule
+of the same shape. LatencyRecorder collects compile to execute latency per fingerprint to find the worst
+shapes. Queries raising an error are recorded as well and counted in `errors`:
+
+    recorder = LatencyRecorder()
+    compiled_at = time.time()
+    sql = generator.generate_sql(data, base_table, trace_tags={'rule_id': rule.id})
+    with recorder.track(sql, compiled_at):
+        cursor.execute(format_sql(sql))  # see json2sql.prepared.format_sql
+    recorder.worst(10)
+"""
+import hashlib
+import re
+import threading
+import time
+
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+TAG_PREFIX = 'json2sql'
+FINGERPRINT_TAG = 'fingerprint'
+KB_VERSION_TAG = 'kb_version'
+SUBQUERY_TAG = 'subquery'
+
+# Values of tags end up in a SQL comment, anything but these characters is replaced
+_UNSAFE_TAG_CHARACTERS = re.compile(r'[^\w.:-]')
+_TAG_COMMENT = re.compile(r'^\s*/\* ' + TAG_PREFIX + r' ([^*]*) \*/')
+
+_COMMENTS = re.compile(r'/\*.*?\*/', re.DOTALL)
+_STRINGS = re.compile(r"'(?:[^'\\]|\\.)*'")
+# Numbers which are not part of an identifier, e.g. not the 1 of `table1`
+_NUMBERS = re.compile(r'(?<![\w`])-?\d+(?:\.\d+)?(?![\w`])')
+_VALUE_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+LatencyStats = namedtuple('LatencyStats', ['fingerprint', 'count', 'total', 'max', 'tags', 'errors'])
+
+
+def normalize_sql(sql):
+    """
+    Reduce SQL to its shape: comments are removed, string and number literals become ?, lists of values
+    become (?+) and whitespace is collapsed
+    :param sql: (unicode) SQL
+    :return: (unicode) normalized SQL
+    """
+    sql = _COMMENTS.sub(' ', sql)
+    sql = _STRINGS.sub('?', sql)
+    sql = _NUMBERS.sub('?', sql)
+    sql = _VALUE_LISTS.sub('(?+)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def fingerprint_sql(sql):
+    """
+    :param sql: (unicode) SQL
+    :return: (str) stable hash of the normalized SQL
+    """
+    return hashlib.sha1(normalize_sql(sql).encode('utf8')).hexdigest()[:16]
+
+
+def format_tags(tags):
+    """
+    Format tags as a SQL comment
+    :param tags: (OrderedDict|list) tag name -> value, or list of (name, value). Tags without a value are skipped.
+    :return: (unicode) comment
+    """
+    items = tags.items() if hasattr(tags, 'items') else tags
+    return u'/* {prefix} {tags} */'.format(prefix=TAG_PREFIX, tags=' '.join(
+        u'{name}={value}'.format(
+            name=_UNSAFE_TAG_CHARACTERS.sub('_', str(name)), value=_UNSAFE_TAG_CHARACTERS.sub('_', str(value))
+        )
+        for name, value in items if value is not None
+    ))
+
+
+def tag_sql(sql, tags):
+    """
+    Start the SQL with a comment holding the tags and the fingerprint of the SQL
+    :param sql: (unicode) SQL
+    :param tags: (list) tuples (tag name, value)
+    :return: (unicode) tagged SQL
+    """
+    return u'{comment} {sql}'.format(
+        comment=format_tags(list(tags) + [(FINGERPRINT_TAG, fingerprint_sql(sql))]), sql=sql
+    )
+
+
+def parse_tags(sql):
+    """
+    Read the tags of SQL tagged by tag_sql
+    :param sql: (unicode) SQL
+    :return: (OrderedDict) tag name -> value, empty when the SQL is not tagged
+    """
+    match = _TAG_COMMENT.match(sql)
+    if not match:
+        return OrderedDict()
+    return OrderedDict(tag.split('=', 1) for tag in match.group(1).split(' ') if '=' in tag)
+
+
+class LatencyRecorder(object):
+    """
+    Compile to execute latency per SQL fingerprint. Thread safe.
+    """
+
+    def __init__(self, max_fingerprints=10000, clock=time.time):
+        """
+        :param max_fingerprints: (int) Maximum number of fingerprints kept, the one with the lowest total
+                                 latency is dropped to make room for a new one
+        :param clock: (callable) returns the current time in seconds
+        """
+        self.max_fingerprints = max_fingerprints
+        self.clock = clock
+        # fingerprint -> [count, total, max, tags of the last query, errors]
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._stats)
+
+    def record(self, fingerprint, seconds, tags=None, error=False):
+        """
+        Record the latency of a query
+        :param fingerprint: (str) fingerprint of the SQL
+        :param seconds: (float) latency
+        :param tags: (dict) tags of the query, the tags of the last query are kept per fingerprint
+        :param error: (bool) True if the query raised an error
+        :return: None
+        """
+        with self._lock:
+            stats = self._stats.get(fingerprint)
+            if stats is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    del self._stats[min(self._stats, key=lambda key: self._stats[key][1])]
+                stats = self._stats[fingerprint] = [0, 0.0, 0.0, None, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] = tags
+            stats[4] += bool(error)
+
+    @contextmanager
+    def track(self, sql, compiled_at=None):
+        """
+        Record the time from compiled_at to the end of the block for the fingerprint of the SQL.
+        A block raising an exception is recorded as an error and the exception is propagated.
+        :param sql: (unicode) SQL, tagged or not
+        :param compiled_at: (float) clock time before the SQL was compiled, the start of the block by default
+        """
+        started = self.clock() if compiled_at is None else compiled_at
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            tags = parse_tags(sql)
+            fingerprint = tags.pop(FINGERPRINT_TAG, None) or fingerprint_sql(sql)
+            self.record(fingerprint, self.clock() - started, dict(tags), error=error)
+
+    def worst(self, limit=10):
+        """
+        :param limit: (int) number of fingerprints
+        :return: (list) LatencyStats with the highest total latency first
+        """
+        with self._lock:
+            stats = [LatencyStats(fingerprint, *values) for fingerprint, values in self._stats.items()]
+        return sorted(stats, key=lambda item: -item.total)[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
@@ -0,0 +1,108 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from json2sql.advisor import IndexAdvisor, IndexRecommendation, format_create_index, main
+from json2sql.engine import JSON2SQLGenerator
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [
+        (1, 'age', 'patients_member', 'integer'),
+        (2, 'gender', 'patients_member', 'string'),
+        (3, 'code', 'patients_visit', 'string'),
+        (4, 'visited', 'patients_visit', 'date'),
+    ],
+    'paths': [('patients_visit', 'member_id', 'patients_member', 'id', 'is_active')],
+    'custom_methods': [],
+    'subqueries': [],
+    'variable_templates': [],
+}
+
+
+def where(field, operator, value):
+    return {'where': {'field': field, 'operator': operator, 'value': value}}
+
+
+CODE_AND_DATE_RULE = {'fields': [3, 4], 'where_data': {'and': [
+    where(3, 'equals', 'flu'), where(4, 'greater_than', '2020-01-01'),
+]}}
+CODE_RULE = {'fields': [3], 'where_data': where(3, 'equals', 'cold')}
+AGE_OR_GENDER_RULE = {'fields': [1, 2], 'where_data': {'or': [
+    where(1, 'greater_than', '40'), where(2, 'equals', 'F'),
+]}}
+GROUP_BY_RULE = {'fields': [1, 2], 'where_data': where(1, 'less_than', '20'), 'group_by_fields': [{'field': 2}]}
+
+
+class IndexAdvisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.advisor = IndexAdvisor(JSON2SQLGenerator(KNOWLEDGE_BASE))
+
+    def add_rule(self, rule, weight=1):
+        return self.advisor.add_rule(json.loads(json.dumps(rule)), 'patients_member', weight)
+
+    def test_join_equality_and_range_columns_in_order(self):
+        self.add_rule(CODE_AND_DATE_RULE, weight=3)
+        self.assertEqual(self.advisor.recommend(), {'patients_visit': [
+            IndexRecommendation('patients_visit', ('member_id', 'code', 'is_active', 'visited'), 3),
+        ]})
+
+    def test_prefixes_are_merged(self):
+        self.add_rule(CODE_AND_DATE_RULE, weight=3)
+        self.add_rule({'fields': [3], 'where_data': {'and': [where(3, 'equals', 'x'), where(3, 'equals', 'y')]}})
+        recommendations = self.advisor.recommend()['patients_visit']
+        self.assertEqual(len(recommendations), 1)
+        self.assertEqual(recommendations[0].weight, 4)
+
+    def test_columns_below_or_are_not_indexed_together(self):
+        self.add_rule(AGE_OR_GENDER_RULE)
+        self.assertEqual(self.advisor.recommend(), {})
+        self.assertEqual(self.advisor.column_usage[('patients_member', 'age', IndexAdvisor.RANGE)], 1)
+        self.assertEqual(self.advisor.column_usage[('patients_member', 'gender', IndexAdvisor.EQUALITY)], 1)
+
+    def test_ranking(self):
+        self.add_rule(CODE_RULE, weight=2)
+        self.add_rule(GROUP_BY_RULE, weight=5)
+        recommendations = self.advisor.recommend(limit_per_table=1)
+        self.assertEqual(list(recommendations), ['patients_member', 'patients_visit'])
+        self.assertEqual(len(recommendations['patients_member']), 1)
+        self.assertEqual(recommendations['patients_member'][0].weight, 5)
+        self.assertEqual(recommendations['patients_visit'][0].columns, ('member_id', 'code', 'is_active'))
+
+    def test_unknown_fields_are_skipped(self):
+        with self.assertLogs('JSON2SQLGenerator.advisor', 'WARNING'):
+            self.assertFalse(self.add_rule({'fields': [9], 'where_data': where(9, 'equals', '1')}))
+        self.assertTrue(self.add_rule(CODE_RULE))
+        self.assertEqual((self.advisor.rules, self.advisor.skipped_rules), (1, 1))
+
+    def test_format_create_index(self):
+        self.assertEqual(
+            format_create_index(IndexRecommendation('patients_visit', ('member_id', 'code'), 1)),
+            'CREATE INDEX `idx_patients_visit_member_id_code` ON `patients_visit` (`member_id`, `code`);'
+        )
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            knowledge_base_path = os.path.join(tmp_dir, 'knowledge_base.json')
+            rules_path = os.path.join(tmp_dir, 'rules.jsonl')
+            with open(knowledge_base_path, 'w') as knowledge_base_file:
+                json.dump(KNOWLEDGE_BASE, knowledge_base_file)
+            with open(rules_path, 'w') as rules_file:
+                rules_file.write(json.dumps({'rule': CODE_RULE, 'weight': 4}) + '\n\n' + json.dumps(CODE_RULE) + '\n')
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(main([knowledge_base_path, rules_path, '--base-table', 'patients_member']), 0)
+        self.assertEqual(output.getvalue().splitlines(), [
+            '-- 2 rules analysed, 0 skipped',
+            '-- patients_visit',
+            'CREATE INDEX `idx_patients_visit_member_id_code_is_active` ON `patients_visit` '
+            '(`member_id`, `code`, `is_active`);  -- weight 5',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
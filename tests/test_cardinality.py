@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import unittest
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.prepared import format_sql
+
+
+def knowledge_base(cardinality):
+    return {
+        'field_mapping': [
+            (1, 'age', 'patients_member', 'integer'),
+            (2, 'code', 'patients_visit', 'string'),
+            (3, 'name', 'patients_plan', 'string'),
+        ],
+        'paths': [
+            ('patients_visit', 'member_id', 'patients_member', 'id', None, cardinality),
+            ('patients_plan', 'id', 'patients_member', 'plan_id', None, 'many_to_one'),
+        ],
+        'custom_methods': [],
+        'subqueries': [],
+        'variable_templates': [],
+    }
+
+
+VISIT_RULE = {'fields': [2], 'where_data': {'where': {'field': 2, 'operator': 'starts_with', 'value': 'f'}}}
+PLAN_RULE = {'fields': [3], 'where_data': {'where': {'field': 3, 'operator': 'equals', 'value': 'gold'}}}
+
+
+class CardinalityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.execute('CREATE TABLE patients_member (id INTEGER PRIMARY KEY, age INTEGER, plan_id INTEGER)')
+        self.connection.execute('CREATE TABLE patients_visit (id INTEGER PRIMARY KEY, member_id INTEGER, code TEXT)')
+        self.connection.execute('CREATE TABLE patients_plan (id INTEGER PRIMARY KEY, name TEXT)')
+        self.connection.executemany('INSERT INTO patients_plan VALUES (?, ?)', [(1, 'gold'), (2, 'silver')])
+        self.connection.executemany('INSERT INTO patients_member VALUES (?, ?, ?)', [
+            (i, i, i % 2 + 1) for i in range(1, 11)
+        ])
+        # Every member has two matching visits
+        self.connection.executemany('INSERT INTO patients_visit (member_id, code) VALUES (?, ?)', [
+            (i, code) for i in range(1, 11) for code in ('flu', 'fever', 'cold')
+        ])
+
+    def tearDown(self):
+        self.connection.close()
+
+    def count(self, generator, rule, **kwargs):
+        sql = generator.generate_sql(json.loads(json.dumps(rule)), 'patients_member', **kwargs)
+        return sql, self.connection.execute(format_sql(sql, {JSON2SQLGenerator.LAST_ID_PARAM: 0})).fetchall()
+
+    def test_one_to_many_counts_distinct(self):
+        generator = JSON2SQLGenerator(knowledge_base('one_to_many'))
+        sql, rows = self.count(generator, VISIT_RULE)
+        self.assertIn('COUNT(DISTINCT `patients_member`.`id`)', sql)
+        self.assertEqual(rows, [(10, )])
+
+        sql, rows = self.count(generator, VISIT_RULE, select_mode=JSON2SQLGenerator.SELECT_MODE_MEMBER_IDS)
+        self.assertIn('SELECT DISTINCT', sql)
+        self.assertEqual(rows, [(i, ) for i in range(1, 11)])
+
+    def test_unknown_cardinality_counts_distinct(self):
+        sql, rows = self.count(JSON2SQLGenerator(knowledge_base(None)), VISIT_RULE)
+        self.assertIn('COUNT(DISTINCT `patients_member`.`id`)', sql)
+        self.assertEqual(rows, [(10, )])
+
+    def test_many_to_one_counts_rows(self):
+        generator = JSON2SQLGenerator(knowledge_base('one_to_many'))
+        sql, rows = self.count(generator, PLAN_RULE)
+        self.assertIn('COUNT(*)', sql)
+        self.assertEqual(rows, [(5, )])
+
+        sql, rows = self.count(generator, PLAN_RULE, select_mode=JSON2SQLGenerator.SELECT_MODE_MEMBER_IDS)
+        self.assertNotIn('DISTINCT', sql)
+        self.assertEqual(rows, [(i, ) for i in range(2, 11, 2)])
+
+    def test_fanning_join_in_the_same_rule_counts_distinct(self):
+        rule = {'fields': [2, 3], 'where_data': {'and': [VISIT_RULE['where_data'], PLAN_RULE['where_data']]}}
+        sql, rows = self.count(JSON2SQLGenerator(knowledge_base('one_to_many')), rule)
+        self.assertIn('COUNT(DISTINCT `patients_member`.`id`)', sql)
+        self.assertEqual(rows, [(5, )])
+
+        sql, rows = self.count(JSON2SQLGenerator(knowledge_base('one_to_one')), rule)
+        self.assertIn('COUNT(*)', sql)
+
+    def test_invalid_cardinality(self):
+        with self.assertRaises(AssertionError):
+            JSON2SQLGenerator(knowledge_base('many_to_many'))
+
+
+if __name__ == '__main__':
+    unittest.main()
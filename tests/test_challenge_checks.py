@@ -0,0 +1,99 @@
+import sqlite3
+import unittest
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.prepared import format_sql
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [(1, 'age', 'patients_member', 'integer'), (2, 'challenge', 'patients_member', 'integer')],
+    'paths': [],
+    'custom_methods': [],
+    'subqueries': [],
+    'variable_templates': [],
+    'challenge_check': {'table': 'member_challenge'},
+}
+
+# member id -> (completed challenges, challenges started but not completed)
+CHALLENGES = {
+    1: ((), (5, 6)),
+    2: ((5, ), ()),
+    3: ((6, ), ()),
+    4: ((5, 6), ()),
+    5: ((5, 5), (6, )),
+    6: ((6, ), (5, )),
+}
+
+
+def check(operator, challenge_id):
+    return {'where': {'field': 2, 'operator': operator, 'value': str(challenge_id)}}
+
+
+class ChallengeCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.execute('CREATE TABLE patients_member (id INTEGER PRIMARY KEY, age INTEGER)')
+        self.connection.execute('CREATE TABLE member_challenge (member_id INTEGER, challenge_id INTEGER, '
+                                'completed_date TEXT)')
+        for member_id, (completed, started) in CHALLENGES.items():
+            self.connection.execute('INSERT INTO patients_member VALUES (?, ?)', (member_id, 30))
+            self.connection.executemany('INSERT INTO member_challenge VALUES (?, ?, ?)', [
+                (member_id, challenge_id, '2020-01-01') for challenge_id in completed
+            ] + [(member_id, challenge_id, None) for challenge_id in started])
+        self.generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def member_ids(self, where_data):
+        rule = {'fields': [1], 'where_data': where_data}
+        sql = self.generator.generate_sql(
+            rule, 'patients_member', select_mode=JSON2SQLGenerator.SELECT_MODE_MEMBER_IDS, page_size=100
+        )
+        rows = self.connection.execute(format_sql(sql, {JSON2SQLGenerator.LAST_ID_PARAM: 0})).fetchall()
+        return sql, {row[0] for row in rows}
+
+    def assert_merged(self, condition, operator, expected):
+        sql, member_ids = self.member_ids({condition: [check(operator, 5), check(operator, 6)]})
+        self.assertEqual(sql.count('EXISTS'), 1)
+        self.assertIn('challenge_id IN (5, 6)', sql)
+        self.assertEqual(member_ids, expected)
+
+    def test_all_completed(self):
+        self.assert_merged('and', 'is_challenge_completed', {4})
+
+    def test_any_completed(self):
+        self.assert_merged('or', 'is_challenge_completed', {2, 3, 4, 5, 6})
+
+    def test_none_completed(self):
+        self.assert_merged('and', 'is_challenge_not_completed', {1})
+
+    def test_not_all_completed(self):
+        self.assert_merged('or', 'is_challenge_not_completed', {1, 2, 3, 5, 6})
+
+    def test_kinds_are_merged_separately(self):
+        sql, member_ids = self.member_ids({'and': [
+            check('is_challenge_completed', 5), {'where': {'field': 1, 'operator': 'equals', 'value': '30'}},
+            check('is_challenge_not_completed', 6), check('is_challenge_completed', 5),
+        ]})
+        self.assertEqual(sql.count('EXISTS'), 2)
+        self.assertEqual(member_ids, {2, 5})
+
+    def test_single_check(self):
+        sql, member_ids = self.member_ids(check('is_challenge_completed', 6))
+        self.assertEqual(sql.count('EXISTS'), 1)
+        self.assertIn('challenge_id = 6', sql)
+        self.assertEqual(member_ids, {3, 4, 6})
+
+    def test_default_and_updated_configuration(self):
+        generator = JSON2SQLGenerator(dict(KNOWLEDGE_BASE, challenge_check={}))
+        rule = {'fields': [1], 'where_data': check('is_challenge_completed', 5)}
+        self.assertIn('FROM journeys_memberstagechallenge WHERE', generator.generate_sql(dict(rule), 'patients_member'))
+        generator.update_challenge_check(table='member_challenge')
+        self.assertIn('FROM member_challenge WHERE', generator.generate_sql(dict(rule), 'patients_member'))
+        with self.assertRaises(AssertionError):
+            generator.update_challenge_check(table='member_challenge; DROP TABLE x')
+
+
+if __name__ == '__main__':
+    unittest.main()
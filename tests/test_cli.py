@@ -0,0 +1,80 @@
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from json2sql import cli
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [(1, 'age', 'patients_member', 'integer')],
+    'paths': [],
+    'custom_methods': [],
+    'subqueries': [],
+    'variable_templates': [],
+}
+
+RULE = {'fields': [1], 'where_data': {'where': {'field': 1, 'operator': 'greater_than', 'value': '40'}}}
+
+
+class BatchCompilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.knowledge_base = os.path.join(self.directory, 'kb.json')
+        with open(self.knowledge_base, 'w') as knowledge_base_file:
+            json.dump(KNOWLEDGE_BASE, knowledge_base_file)
+        self.rules = os.path.join(self.directory, 'rules.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_cli(self, lines, *options):
+        with open(self.rules, 'w') as rules_file:
+            rules_file.write('\n'.join(lines) + '\n')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            status = cli.main([self.knowledge_base, self.rules, '--base-table', 'patients_member'] + list(options))
+        return status, [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_compiles_rules_in_order(self):
+        status, records = self.run_cli([
+            json.dumps(RULE),
+            json.dumps({'id': 'r2', 'rule': RULE, 'base_table': 'patients_member'}),
+        ], '--workers', '1')
+        self.assertEqual(status, 0)
+        self.assertEqual([record['id'] for record in records], [1, 'r2'])
+        self.assertIn('`patients_member`.`age` > 40', records[0]['sql'])
+        self.assertEqual(records[0]['sql'], records[1]['sql'])
+
+    def test_bad_line_fails_the_run(self):
+        status, records = self.run_cli([json.dumps(RULE), '{not json'], '--workers', '1')
+        self.assertEqual(status, 1)
+        self.assertIn('sql', records[0])
+        self.assertEqual(records[1]['id'], 2)
+        self.assertEqual(records[1]['error_type'], 'JSONDecodeError')
+
+    def test_validate_only(self):
+        status, records = self.run_cli([json.dumps(RULE)], '--workers', '1', '--validate-only')
+        self.assertEqual(status, 0)
+        self.assertTrue(records[0]['valid'])
+        self.assertNotIn('sql', records[0])
+
+    def test_spawned_workers(self):
+        start_method = multiprocessing.get_start_method()
+        multiprocessing.set_start_method('spawn', force=True)
+        try:
+            status, records = self.run_cli([json.dumps(RULE)] * 3 + ['{not json'], '--workers', '2')
+        finally:
+            multiprocessing.set_start_method(start_method, force=True)
+        self.assertEqual(status, 1)
+        self.assertEqual([record['id'] for record in records], [1, 2, 3, 4])
+        self.assertEqual(len({record['sql'] for record in records[:3]}), 1)
+        self.assertIn('error', records[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+from json2sql.codecs import PASSTHROUGH_CODEC, StringCodec, _CODECS, get_codec, register_codec
+
+
+class CodecTest(unittest.TestCase):
+
+    def assert_accepts(self, data_type, *cases):
+        codec = get_codec(data_type)
+        for value, sql in cases:
+            self.assertEqual(codec.to_sql(value), sql, value)
+
+    def assert_rejects(self, data_type, *values):
+        codec = get_codec(data_type)
+        for value in values:
+            with self.assertRaises(ValueError, msg=value):
+                codec.to_sql(value)
+
+    def test_integer(self):
+        self.assert_accepts('integer', ('42', '42'), (-7, '-7'), (' 3 ', ' 3 '))
+        self.assert_rejects('integer', 'abc', '1.5', '1 OR 1=1', [1])
+
+    def test_string(self):
+        self.assert_accepts(
+            'string', ('Oslo', "'Oslo'"), ("O'Hara", "'O\\'Hara'"), ('a\\b', "'a\\\\b'"), ('50%', "'50%%'")
+        )
+
+    def test_date(self):
+        self.assert_accepts('date', ('2020-01-05', "'2020-01-05'"), ('2020-1-5', "'2020-1-5'"))
+        self.assert_rejects('date', '2020-02-30', '2020-13-01', '05-01-2020', '2020-01-05T10:00:00', 20200105)
+
+    def test_datetime(self):
+        self.assert_accepts(
+            'datetime', ('2020-01-05T10:30:00', "'2020-01-05T10:30:00'"), ('2020-1-5T9:5:0', "'2020-1-5T9:5:0'"),
+            ('2020-01-05', "'2020-01-05'")
+        )
+        self.assert_rejects('datetime', '2020-01-05T24:00:00', '2020-01-05 10:30:00', '2020-01-05T10:30')
+
+    def test_boolean(self):
+        self.assert_accepts(
+            'boolean', ('TRUE', 'TRUE'), ('false', 'false'), ('1', '1'), ('0', '0'), ('-1', '-1'), (True, 'True')
+        )
+        self.assert_rejects('boolean', 'yes', '1.5', 'NULL', 'TRUE OR 1=1')
+
+    def test_nullboolean(self):
+        self.assert_accepts('nullboolean', ('NULL', 'NULL'), ('null', 'null'), ('TRUE', 'TRUE'), ('0', '0'))
+        self.assert_rejects('nullboolean', 'none', 'NOT NULL')
+
+    def test_choice(self):
+        for data_type in ('choice', 'multichoice'):
+            self.assert_accepts(
+                data_type, (3, '3'), ('3', '3'), ('gold', "'gold'"), ("it's", "'it\\'s'"), ('5%', "'5%%'")
+            )
+
+    def test_empty_values_are_not_validated(self):
+        self.assert_accepts('integer', ('', ''))
+        self.assert_accepts('date', ('', "''"))
+
+    def test_passthrough(self):
+        self.assertIs(get_codec('unknown'), PASSTHROUGH_CODEC)
+        self.assertEqual(PASSTHROUGH_CODEC.to_sql('`a` = 100%'), '`a` = 100%%')
+
+    def test_register_codec(self):
+        class ZipCodeCodec(StringCodec):
+            data_type = 'zipcode'
+
+            def clean(self, value):
+                if not value.isdigit():
+                    raise self.invalid(value)
+                return value
+
+        register_codec(ZipCodeCodec())
+        try:
+            self.assert_accepts('zipcode', ('01234', "'01234'"))
+            self.assert_rejects('zipcode', '0123a')
+        finally:
+            del _CODECS['zipcode']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import json
+import unittest
+
+from json2sql.engine import JSON2SQLGenerator
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [(1, 'age', 'patients_member', 'integer'), (2, 'active', 'patients_member', 'boolean')],
+    'paths': [],
+    'custom_methods': [
+        (1, '{field} IS {value}', json.dumps({'field': {'data_type': 'field'}, 'value': {'data_type': 'boolean'}})),
+    ],
+    'subqueries': [],
+    'variable_templates': [],
+}
+
+
+class BooleanParameterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+
+    def _compile(self, value):
+        rule = {
+            'fields': [2],
+            'where_data': {'custom_method': {'template_id': 1, 'parameters': {
+                'field': {'field': 2, 'value': 'active'}, 'value': {'value': value},
+            }}},
+        }
+        return self.generator.generate_sql(rule, 'patients_member')
+
+    def test_not_null(self):
+        self.assertIn('`patients_member`.`active` IS NOT NULL', self._compile('NOT NULL'))
+
+    def test_null(self):
+        self.assertIn('`patients_member`.`active` IS NULL', self._compile('null'))
+
+    def test_invalid_value(self):
+        with self.assertRaises(AssertionError):
+            self._compile('MAYBE')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.execution import (
+    count_members_sharded, get_id_bounds, iter_member_ids, iter_member_ids_sharded, split_id_range
+)
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [(1, 'age', 'patients_member', 'integer'), (2, 'name', 'patients_member', 'string')],
+    'paths': [],
+    'custom_methods': [],
+    'subqueries': [],
+    'variable_templates': [],
+}
+
+RULE = {'fields': [1], 'where_data': {'where': {'field': 1, 'operator': 'greater_than', 'value': '10'}}}
+
+MAX_ID = 200
+
+NAMES = ('Jo', '50% off', '100%(last_id)s')
+
+
+class ShardedExecutionTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        connection = self.connect()
+        connection.execute('CREATE TABLE patients_member (id INTEGER PRIMARY KEY, age INTEGER, name TEXT)')
+        connection.executemany('INSERT INTO patients_member VALUES (?, ?, ?)', [
+            (i, i % 90, NAMES[i % len(NAMES)]) for i in range(1, MAX_ID + 1)
+        ])
+        connection.commit()
+        connection.close()
+        self.generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def connect(self):
+        return sqlite3.connect(self.path)
+
+    def rule(self):
+        return json.loads(json.dumps(RULE))
+
+    def test_split_id_range(self):
+        self.assertEqual(split_id_range(1, 10, 3), [(1, 5), (5, 9), (9, 11)])
+        self.assertEqual(split_id_range(5, 5, 4), [(5, 6)])
+        self.assertEqual(split_id_range(None, None, 2), [])
+
+    def test_get_id_bounds(self):
+        connection = self.connect()
+        try:
+            self.assertEqual(get_id_bounds(connection, 'patients_member'), (1, MAX_ID))
+        finally:
+            connection.close()
+
+    def test_count_members_sharded(self):
+        expected = sum(1 for i in range(1, MAX_ID + 1) if i % 90 > 10)
+        for shards in (1, 3, 7, MAX_ID, MAX_ID * 2):
+            count = count_members_sharded([self.connect] * 2, self.generator, self.rule(), 'patients_member',
+                                          shards=shards)
+            self.assertEqual(count, expected, shards)
+
+    def test_iter_member_ids_sharded(self):
+        connection = self.connect()
+        try:
+            expected = list(iter_member_ids(connection, self.generator, self.rule(), 'patients_member',
+                                            page_size=7, cursor_class=None))
+        finally:
+            connection.close()
+        # The last shard includes the largest id
+        self.assertEqual(expected[-1], MAX_ID)
+        for shards in (1, 3, 7):
+            member_ids = list(iter_member_ids_sharded([self.connect] * 2, self.generator, self.rule(),
+                                                      'patients_member', shards=shards, page_size=7,
+                                                      cursor_class=None))
+            self.assertEqual(member_ids, expected, shards)
+
+    def test_iter_member_ids_sharded_with_ids_below_one(self):
+        connection = self.connect()
+        try:
+            connection.executemany('INSERT INTO patients_member VALUES (?, ?, ?)', [
+                (i, 50, NAMES[0]) for i in range(-5, 1)
+            ])
+            connection.commit()
+        finally:
+            connection.close()
+        expected = list(range(-5, 1)) + [i for i in range(1, MAX_ID + 1) if i % 90 > 10]
+        for shards in (1, 3):
+            member_ids = list(iter_member_ids_sharded([self.connect] * 2, self.generator, self.rule(),
+                                                      'patients_member', shards=shards, page_size=7,
+                                                      cursor_class=None))
+            self.assertEqual(member_ids, expected, shards)
+
+    def test_percent_in_values(self):
+        for name in NAMES[1:]:
+            rule = {'fields': [1], 'where_data': {'where': {'field': 2, 'operator': 'equals', 'value': name}}}
+            expected = [i for i in range(1, MAX_ID + 1) if NAMES[i % len(NAMES)] == name]
+            connection = self.connect()
+            try:
+                member_ids = list(iter_member_ids(connection, self.generator, rule, 'patients_member',
+                                                  page_size=7, cursor_class=None))
+            finally:
+                connection.close()
+            self.assertEqual(member_ids, expected, name)
+            count = count_members_sharded([self.connect], self.generator, dict(rule), 'patients_member', shards=3)
+            self.assertEqual(count, len(expected), name)
+
+    def test_closing_sharded_ids_stops_the_workers(self):
+        threads = threading.active_count()
+        member_ids = iter_member_ids_sharded([self.connect] * 3, self.generator, self.rule(), 'patients_member',
+                                             shards=6, page_size=2, cursor_class=None)
+        self.assertEqual(next(member_ids), 11)
+        member_ids.close()
+        self.assertEqual(threading.active_count(), threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
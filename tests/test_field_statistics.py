@@ -0,0 +1,51 @@
+import json
+import unittest
+
+from json2sql.engine import JSON2SQLGenerator
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [
+        (1, 'age', 'patients_member', 'integer'),
+        (2, 'name', 'patients_member', 'string'),
+        (3, 'zip', 'patients_member', 'string'),
+    ],
+    'paths': [],
+    'custom_methods': [],
+    'subqueries': [],
+    'variable_templates': [],
+}
+
+RULE = {'fields': [1], 'where_data': {'and': [
+    {'where': {'field': 2, 'operator': 'ends_with', 'value': 'son'}},
+    {'where': {'field': 1, 'operator': 'equals', 'value': '40'}},
+]}}
+
+
+class FieldStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+
+    def compile(self):
+        return self.generator.generate_sql(json.loads(json.dumps(RULE)), 'patients_member')
+
+    def test_statistics_of_other_fields_keep_the_order(self):
+        self.generator.update_field_statistics(3, distinct_count=1000)
+        sql = self.compile()
+        self.assertLess(sql.index('`name`'), sql.index('`age`'))
+
+    def test_statistics_of_used_fields_reorder_cached_rules(self):
+        sql = self.compile()
+        self.assertLess(sql.index('`name`'), sql.index('`age`'))
+
+        self.generator.update_field_statistics(1, distinct_count=90)
+        sql = self.compile()
+        self.assertLess(sql.index('`age`'), sql.index('`name`'))
+
+        self.generator.remove_field_statistics(1)
+        sql = self.compile()
+        self.assertLess(sql.index('`name`'), sql.index('`age`'))
+
+
+if __name__ == '__main__':
+    unittest.main()
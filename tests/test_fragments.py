@@ -0,0 +1,65 @@
+import unittest
+
+from unittest import mock
+
+from json2sql.engine import JSON2SQLGenerator
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [(1, 'age', 'patients_member', 'integer')],
+    'paths': [],
+    'custom_methods': [],
+    'subqueries': [],
+    'variable_templates': [],
+}
+
+
+ACTIVE_ADULT = {'and': [
+    {'where': {'field': 1, 'operator': 'greater_than', 'value': '17'}},
+    {'where': {'field': 1, 'operator': 'less_than', 'value': '90'}},
+]}
+
+
+def shared_subtree_rule(value):
+    return {'fields': [1], 'where_data': {'or': [
+        {'where': {'field': 1, 'operator': 'equals', 'value': value}},
+        {'and': [dict(ACTIVE_ADULT), {'where': {'field': 1, 'operator': 'not_equals', 'value': '50'}}]},
+    ]}}
+
+
+def equals_rule(value):
+    return {'fields': [1], 'where_data': {'and': [
+        {'where': {'field': 1, 'operator': 'equals', 'value': value}},
+        {'where': {'field': 1, 'operator': 'less_than', 'value': '90'}},
+    ]}}
+
+
+class FragmentCacheTest(unittest.TestCase):
+
+    def test_shared_subtrees_are_rendered_once(self):
+        generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+        with mock.patch.object(generator, '_generate_where_phrase', wraps=generator._generate_where_phrase) as leaf, \
+                mock.patch.object(generator, '_parse_and', wraps=generator._parse_and) as combination:
+            first = generator.generate_sql(shared_subtree_rule('1'), 'patients_member')
+            self.assertEqual(leaf.call_count, 4)
+
+            # Only the leaf the rules don't share is rendered, the combination is cached once seen twice
+            second = generator.generate_sql(shared_subtree_rule('2'), 'patients_member')
+            self.assertEqual(leaf.call_count, 5)
+            combination_calls = combination.call_count
+            generator.generate_sql(shared_subtree_rule('3'), 'patients_member')
+            self.assertEqual(leaf.call_count, 6)
+            self.assertEqual(combination.call_count, combination_calls)
+
+        self.assertEqual(first.replace('= 1', '= 2'), second)
+        self.assertEqual(generator.generate_sql(shared_subtree_rule('2'), 'patients_member'), second)
+
+    def test_equal_values_of_different_types_are_not_shared(self):
+        for values in ((1.0, 1, True), (True, 1, 1.0)):
+            generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+            rendered = [generator.generate_sql(equals_rule(value), 'patients_member') for value in values]
+            for value, sql in zip(values, rendered):
+                self.assertIn('`patients_member`.`age` = {value}'.format(value=value), sql)
+
+
+if __name__ == '__main__':
+    unittest.main()
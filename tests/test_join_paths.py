@@ -0,0 +1,76 @@
+import unittest
+
+from json2sql.engine import JSON2SQLGenerator
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [
+        (1, 'age', 'patients_member', 'integer'),
+        (2, 'code', 'patients_visit', 'string'),
+        (3, 'result', 'patients_lab', 'string'),
+    ],
+    'paths': [
+        # patients_visit can join the base table directly or through patients_encounter
+        ('patients_visit', 'member_id', 'patients_member', 'id', None, None, 10),
+        ('patients_visit', 'encounter_id', 'patients_encounter', 'id', None, None, 1),
+        ('patients_encounter', 'member_id', 'patients_member', 'id', None, None, 1),
+        ('patients_lab', 'encounter_id', 'patients_encounter', 'id', None, None, 1),
+        ('patients_lab', 'visit_id', 'patients_visit', 'id', None, None, 5),
+    ],
+    'custom_methods': [],
+    'subqueries': [],
+    'variable_templates': [],
+}
+
+
+class CheapestJoinTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+        self.generator.base_table = 'patients_member'
+
+    def paths(self, tables, path_hints=None):
+        path_subset = self.generator.extract_paths_subset(tables, path_hints or {})
+        return {parent_table: set(join_tables) for parent_table, join_tables in path_subset.items()}
+
+    def test_cheapest_path_of_a_table(self):
+        self.assertEqual(self.paths(['patients_visit']), {
+            'patients_member': {'patients_encounter'}, 'patients_encounter': {'patients_visit'},
+        })
+
+    def test_tables_share_the_tree(self):
+        self.assertEqual(self.paths(['patients_visit', 'patients_lab']), {
+            'patients_member': {'patients_encounter'}, 'patients_encounter': {'patients_visit', 'patients_lab'},
+        })
+
+    def test_hints_decide_the_parent(self):
+        self.assertEqual(self.paths(['patients_visit', 'patients_lab'], {'patients_lab': 'patients_visit'}), {
+            'patients_member': {'patients_encounter'}, 'patients_encounter': {'patients_visit'},
+            'patients_visit': {'patients_lab'},
+        })
+
+    def test_weight_updates_change_the_tree(self):
+        self.assertNotIn('patients_visit', self.paths(['patients_visit'])['patients_member'])
+        self.generator.update_path('patients_visit', 'member_id', 'patients_member', 'id', weight=1)
+        self.assertEqual(self.paths(['patients_visit']), {'patients_member': {'patients_visit'}})
+
+    def test_missing_weights_use_the_default(self):
+        self.generator.update_path('patients_visit', 'member_id', 'patients_member', 'id')
+        self.assertEqual(self.generator.DEFAULT_PATH_WEIGHT, 1)
+        self.assertEqual(self.paths(['patients_visit']), {'patients_member': {'patients_visit'}})
+
+    def test_generated_joins(self):
+        rule = {'fields': [2], 'where_data': {'where': {'field': 2, 'operator': 'equals', 'value': 'flu'}}}
+        sql = self.generator.generate_sql(rule, 'patients_member')
+        self.assertIn('LEFT JOIN patients_encounter ON patients_encounter.member_id = patients_member.id', sql)
+        self.assertIn('LEFT JOIN patients_visit ON patients_visit.encounter_id = patients_encounter.id', sql)
+        self.assertNotIn('patients_visit.member_id', sql)
+
+    def test_unreachable_table(self):
+        self.generator.remove_path('patients_encounter', 'patients_member')
+        self.generator.remove_path('patients_visit', 'patients_member')
+        with self.assertRaises(Exception):
+            self.paths(['patients_visit'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import json
+import unittest
+
+from unittest import mock
+
+from json2sql.engine import JSON2SQLGenerator
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [
+        (1, 'age', 'patients_member', 'integer'),
+        (2, 'city', 'patients_address', 'string'),
+        (3, 'active', 'patients_member', 'boolean'),
+    ],
+    'paths': [('patients_address', 'member_id', 'patients_member', 'id', None)],
+    'custom_methods': [
+        (1, '{field} IS {value}', json.dumps({'field': {'data_type': 'field'}, 'value': {'data_type': 'boolean'}})),
+    ],
+    'subqueries': [
+        (1, False, json.dumps({'fields': [1], 'where_data': {'where': {
+            'field': 1, 'operator': 'greater_than', 'value': '3',
+        }}}), json.dumps({'member_id': {
+            'field': 'id', 'category': 'patients_member', 'alias': 'member_id', 'is_member_id': True,
+        }}), '{}'),
+    ],
+    'variable_templates': [],
+}
+
+AGE_RULE = {'fields': [1], 'where_data': {'where': {'field': 1, 'operator': 'greater_than', 'value': '10'}}}
+CITY_RULE = {'fields': [2], 'where_data': {'where': {'field': 2, 'operator': 'equals', 'value': 'Oslo'}}}
+CUSTOM_METHOD_RULE = {'fields': [3], 'where_data': {'custom_method': {'template_id': 1, 'parameters': {
+    'field': {'field': 3, 'value': 'active'}, 'value': {'value': 'TRUE'},
+}}}}
+SUBQUERY_RULE = dict(AGE_RULE, sub_queries=[{'unique_id': 1, 'alias': 'sq'}])
+
+
+class KnowledgeBaseUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+
+    def compile(self, rule):
+        return self.generator.generate_sql(json.loads(json.dumps(rule)), 'patients_member')
+
+    def assert_cached(self, rule):
+        sql = self.compile(rule)
+        with mock.patch.object(self.generator, '_generate_sql') as generate_sql:
+            self.assertEqual(self.compile(rule), sql)
+        generate_sql.assert_not_called()
+
+    def test_update_field(self):
+        self.assertIn('`patients_member`.`age` > 10', self.compile(AGE_RULE))
+        self.compile(CITY_RULE)
+        self.generator.update_field(1, 'years', 'patients_member', 'integer')
+        self.assertIn('`patients_member`.`years` > 10', self.compile(AGE_RULE))
+        self.assert_cached(CITY_RULE)
+
+    def test_add_and_remove_field(self):
+        rule = {'fields': [4], 'where_data': {'where': {'field': 4, 'operator': 'equals', 'value': 'x'}}}
+        with self.assertRaises(Exception):
+            self.compile(rule)
+        self.generator.add_field(4, 'code', 'patients_member', 'string')
+        self.assertIn('`patients_member`.`code` = \'x\'', self.compile(rule))
+        self.compile(AGE_RULE)
+
+        self.generator.remove_field(4)
+        with self.assertRaises(Exception):
+            self.compile(rule)
+        self.assert_cached(AGE_RULE)
+
+    def test_update_and_remove_path(self):
+        self.assertIn('patients_address.member_id = patients_member.id', self.compile(CITY_RULE))
+        self.compile(AGE_RULE)
+        self.generator.update_path('patients_address', 'owner_id', 'patients_member', 'id')
+        self.assertIn('patients_address.owner_id = patients_member.id', self.compile(CITY_RULE))
+        self.assert_cached(AGE_RULE)
+
+        self.generator.remove_path('patients_address', 'patients_member')
+        with self.assertRaises(Exception):
+            self.compile(CITY_RULE)
+        self.generator.add_path('patients_address', 'member_id', 'patients_member', 'id')
+        self.assertIn('patients_address.member_id = patients_member.id', self.compile(CITY_RULE))
+
+    def test_update_and_remove_custom_method(self):
+        self.assertIn('`patients_member`.`active` IS TRUE', self.compile(CUSTOM_METHOD_RULE))
+        self.compile(AGE_RULE)
+        self.generator.update_custom_method(1, '{field} IS NOT {value}', KNOWLEDGE_BASE['custom_methods'][0][2])
+        self.assertIn('`patients_member`.`active` IS NOT TRUE', self.compile(CUSTOM_METHOD_RULE))
+        self.assert_cached(AGE_RULE)
+
+        self.generator.remove_custom_method(1)
+        with self.assertRaises(Exception):
+            self.compile(CUSTOM_METHOD_RULE)
+
+    def test_update_and_remove_subquery(self):
+        self.assertIn('`patients_member`.`age` > 3', self.compile(SUBQUERY_RULE))
+        self.compile(AGE_RULE)
+        subquery = list(KNOWLEDGE_BASE['subqueries'][0][1:])
+        subquery[1] = subquery[1].replace('"3"', '"5"')
+        self.generator.update_subquery(1, *subquery)
+        sql = self.compile(SUBQUERY_RULE)
+        self.assertIn('`patients_member`.`age` > 5', sql)
+        self.assertNotIn('`patients_member`.`age` > 3', sql)
+        self.assert_cached(AGE_RULE)
+
+        self.generator.remove_subquery(1)
+        with self.assertRaises(Exception):
+            self.compile(SUBQUERY_RULE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from unittest import mock
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.materialization import FRAGMENT_CUSTOM_METHOD, MaterializationManager
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [(1, 'age', 'patients_member', 'integer')],
+    'paths': [],
+    'custom_methods': [
+        (1, '{field} > {value}', json.dumps({'field': {'data_type': 'field'}, 'value': {'data_type': 'integer'}})),
+    ],
+    'subqueries': [
+        (1, False, json.dumps({'fields': [1], 'where_data': {'where': {
+            'field': 1, 'operator': 'greater_than', 'value': '3',
+        }}}), json.dumps({'member_id': {
+            'field': 'id', 'category': 'patients_member', 'alias': 'member_id', 'is_member_id': True,
+        }}), '{}'),
+    ],
+    'variable_templates': [],
+}
+
+CUSTOM_METHOD_RULE = {
+    'fields': [1],
+    'where_data': {'custom_method': {'template_id': 1, 'parameters': {
+        'field': {'field': 1, 'value': 'age'}, 'value': {'value': '40'},
+    }}},
+}
+
+
+class MaterializationTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        connection = self.connect()
+        connection.execute('CREATE TABLE patients_member (id INTEGER PRIMARY KEY, age INTEGER)')
+        connection.executemany('INSERT INTO patients_member VALUES (?, ?)', [(i, i % 90) for i in range(1, 201)])
+        connection.commit()
+        connection.close()
+
+        self.now = 1000.0
+        self.manager = MaterializationManager(self.connect, min_usage=2, ttl=60, clock=lambda: self.now)
+        self.generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+        self.generator.materializer = self.manager
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def connect(self):
+        return sqlite3.connect(self.path)
+
+    def tables(self):
+        connection = self.connect()
+        try:
+            return sorted(row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'json2sql_mat_%'"
+            ))
+        finally:
+            connection.close()
+
+    def compile(self, rule=CUSTOM_METHOD_RULE):
+        return self.generator.generate_sql(json.loads(json.dumps(rule)), 'patients_member')
+
+    def test_expired_table_is_kept_until_next_refresh(self):
+        self.compile()
+        self.compile()
+        self.manager.refresh()
+        first = self.tables()
+        self.assertEqual(len(first), 1)
+        self.assertIn(first[0], self.compile())
+
+        self.now += 120
+        # The table expires during this refresh and is rebuilt, SQL compiled before may still use it
+        self.manager.refresh()
+        self.assertIn(first[0], self.tables())
+        self.assertEqual(len(self.tables()), 2)
+
+        self.manager.refresh()
+        self.assertNotIn(first[0], self.tables())
+        self.assertEqual(len(self.tables()), 1)
+
+    def test_custom_method_below_not_is_not_replaced(self):
+        negated_rule = dict(CUSTOM_METHOD_RULE, where_data={'not': [CUSTOM_METHOD_RULE['where_data']]})
+        for _ in range(3):
+            self.compile()
+            self.compile(negated_rule)
+        self.manager.refresh()
+        table = self.tables()[0]
+
+        self.assertIn(table, self.compile())
+        negated_sql = self.compile(negated_rule)
+        self.assertNotIn(table, negated_sql)
+        self.assertIn('`patients_member`.`age` > 40', negated_sql)
+
+    def test_escaped_percent_is_unescaped_when_materializing(self):
+        key = self.manager.register(FRAGMENT_CUSTOM_METHOD, 'patients_member', "`patients_member`.`age` LIKE '1%%'")
+        table = self.manager.materialize(key)
+        self.assertIsNotNone(table)
+        connection = self.connect()
+        try:
+            count = connection.execute('SELECT COUNT(*) FROM {table}'.format(table=table)).fetchone()[0]
+        finally:
+            connection.close()
+        # Ages 1 and 10 to 19, 3 members each
+        self.assertEqual(count, 33)
+
+    def test_fragments_with_parameters_are_not_registered(self):
+        for sql in ('`patients_member`.`id` > %(last_id)s', "`patients_member`.`age` LIKE '1%'"):
+            self.assertIsNone(self.manager.register(FRAGMENT_CUSTOM_METHOD, 'patients_member', sql))
+        self.assertEqual(len(self.manager), 0)
+
+    def test_subquery_lookup_does_not_compile_the_subquery_again(self):
+        rule = {
+            'fields': [1], 'where_data': {'where': {'field': 1, 'operator': 'greater_than', 'value': '10'}},
+            'sub_queries': [{'unique_id': 1, 'alias': 'sq'}],
+        }
+        with mock.patch.object(self.generator, 'generate_sql', wraps=self.generator.generate_sql) as generate_sql:
+            for high in range(100, 103):
+                sql = self.generator.generate_sql(
+                    json.loads(json.dumps(rule)), 'patients_member',
+                    base_table_filters=['`patients_member`.`id` < {high}'.format(high=high)]
+                )
+                self.assertIn('`patients_member`.`id` < {high}'.format(high=high), sql.split('LEFT JOIN')[1])
+        subquery_compiles = [call for call in generate_sql.call_args_list if 'select_fields' in call.kwargs]
+        unfiltered = [call for call in subquery_compiles if 'base_table_filters' not in call.kwargs]
+        self.assertEqual(len(unfiltered), 1)
+        self.assertEqual(len(subquery_compiles), 4)
+        self.assertEqual(len(self.manager), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import json
+import sqlite3
+import unittest
+
+from unittest import mock
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.prepared import format_sql
+from json2sql.sampling import get_sample_filter
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [
+        (1, 'age', 'patients_member', 'integer'),
+        (2, 'code', 'patients_visit', 'string'),
+    ],
+    'paths': [('patients_visit', 'member_id', 'patients_member', 'id', None, 'one_to_many')],
+    'custom_methods': [],
+    'subqueries': [
+        (1, False, json.dumps({'fields': [1], 'where_data': {'where': {
+            'field': 1, 'operator': 'greater_than', 'value': '20',
+        }}}), json.dumps({'member_id': {
+            'field': 'id', 'category': 'patients_member', 'alias': 'member_id', 'is_member_id': True,
+        }}), '{}'),
+    ],
+    'variable_templates': [],
+}
+
+MAX_ID = 60
+
+
+def condition(field, operator, value):
+    return {'where': {'field': field, 'operator': operator, 'value': value}}
+
+
+RULES = [
+    ('older', {'fields': [1], 'where_data': condition(1, 'greater_than', '30')}),
+    ('younger', {'fields': [1], 'where_data': condition(1, 'less_than', '10')}),
+    ('flu', {'fields': [1, 2], 'where_data': condition(2, 'equals', 'flu')}),
+    ('in_subquery', {
+        'fields': [1], 'where_data': condition(1, 'less_than', '40'), 'sub_queries': [{'unique_id': 1, 'alias': 'sq'}],
+    }),
+]
+
+
+class MultiRuleSqlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.execute('CREATE TABLE patients_member (id INTEGER PRIMARY KEY, age INTEGER)')
+        self.connection.execute('CREATE TABLE patients_visit (id INTEGER PRIMARY KEY, member_id INTEGER, code TEXT)')
+        self.connection.executemany('INSERT INTO patients_member VALUES (?, ?)', [
+            (i, i % 50) for i in range(1, MAX_ID + 1)
+        ])
+        # Members have from zero to two visits, so the join fans out
+        self.connection.executemany('INSERT INTO patients_visit (member_id, code) VALUES (?, ?)', [
+            (i, code) for i in range(1, MAX_ID + 1) for code in ('flu', 'cold')[:i % 3]
+        ])
+        self.generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def rules(self):
+        return json.loads(json.dumps(RULES))
+
+    def run_sql(self, sql):
+        return self.connection.execute(format_sql(sql)).fetchall()
+
+    def test_counts_match_counts_of_every_rule(self):
+        sql = self.generator.generate_multi_rule_sql(self.rules(), 'patients_member')
+        self.assertIn('COUNT(DISTINCT CASE WHEN', sql)
+        expected = [
+            self.run_sql(self.generator.generate_sql(data, 'patients_member'))[0][0] for alias, data in self.rules()
+        ]
+        self.assertTrue(all(expected))
+        self.assertEqual(list(self.run_sql(sql)[0]), expected)
+        columns = self.connection.execute(format_sql(sql)).description
+        self.assertEqual([column[0] for column in columns], [alias for alias, data in RULES])
+
+    def test_distinct_is_dropped_without_fan_out(self):
+        rules = [(alias, data) for alias, data in self.rules() if alias in ('older', 'younger')]
+        sql = self.generator.generate_multi_rule_sql(rules, 'patients_member')
+        self.assertNotIn('DISTINCT', sql)
+        self.assertEqual(list(self.run_sql(sql)[0]), [
+            self.run_sql(self.generator.generate_sql(data, 'patients_member'))[0][0] for alias, data in rules
+        ])
+
+    def test_conflicting_subqueries(self):
+        rules = self.rules()
+        rules[0][1]['sub_queries'] = [{'unique_id': 1, 'alias': 'sq', 'parameters': {'x': 1}}]
+        with self.assertRaises(AssertionError):
+            self.generator.generate_multi_rule_sql(rules, 'patients_member')
+
+    def test_filters_sampling_and_tags(self):
+        filters = ['`patients_member`.`id` <= 40']
+        sql = self.generator.generate_multi_rule_sql(
+            self.rules(), 'patients_member', base_table_filters=filters, sample_rate=0.5, trace_tags={'rule_id': 7}
+        )
+        self.assertTrue(sql.startswith('/*'))
+        self.assertIn('rule_id', sql.split('JOIN (')[1])
+        self.assertIn(get_sample_filter('patients_member', 0.5), sql.split('LEFT JOIN')[1])
+
+        expected = []
+        for alias, data in self.rules():
+            rule_sql = self.generator.generate_sql(
+                data, 'patients_member', base_table_filters=filters, sample_rate=0.5
+            )
+            expected.append(self.run_sql(rule_sql)[0][0])
+        self.assertEqual(list(self.run_sql(sql)[0]), expected)
+
+    def test_cached(self):
+        sql = self.generator.generate_multi_rule_sql(self.rules(), 'patients_member', sample_rate=0.5)
+        with mock.patch.object(self.generator, '_generate_multi_rule_sql') as generate:
+            self.assertEqual(
+                self.generator.generate_multi_rule_sql(self.rules(), 'patients_member', sample_rate=0.5), sql
+            )
+        generate.assert_not_called()
+
+    def test_unsupported_arguments(self):
+        with self.assertRaises(AssertionError):
+            self.generator.generate_multi_rule_sql(
+                self.rules(), 'patients_member', select_mode=JSON2SQLGenerator.SELECT_MODE_MEMBER_IDS
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import json
+import unittest
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.prepared import PreparedRule, format_sql, slot
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [(1, 'name', 'patients_member', 'string')],
+    'paths': [],
+    'custom_methods': [],
+    'subqueries': [],
+    'variable_templates': [(1, 'member_name', 'string')],
+}
+
+RULE = {'fields': [1], 'where_data': {'and': [
+    {'where': {'field': 1, 'operator': 'starts_with', 'value': 'Jo'}},
+    {'where': {'field': 1, 'operator': 'not_equals', 'value': {
+        'type': 'VARIABLE_TEMPLATE', 'variable_template_id': '1',
+    }}},
+]}}
+
+
+class PreparedRuleTest(unittest.TestCase):
+
+    def test_slot_without_data_type_is_rejected(self):
+        sql = 'SELECT 1 WHERE `age` > {age} AND `name` = {name}'.format(age=slot('age'), name=slot('name'))
+        with self.assertRaises(ValueError):
+            PreparedRule(sql, {'age': 'integer'})
+
+    def test_data_type_without_codec_is_quoted_as_string(self):
+        rule = PreparedRule('SELECT 1 WHERE `zip` = {zip}'.format(zip=slot('zip')), {'zip': 'postal_code'})
+        self.assertEqual(rule.bind(zip="1' OR '1'='1"), "SELECT 1 WHERE `zip` = '1\\' OR \\'1\\'=\\'1'")
+
+
+class PreparedGenerateSqlTest(unittest.TestCase):
+
+    def setUp(self):
+        generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+        self.rule = generator.generate_sql(json.loads(json.dumps(RULE)), 'patients_member', prepared=True)
+
+    def test_bound_values_with_percent(self):
+        sql = format_sql(self.rule.bind(member_name='50% off'))
+        self.assertIn("LIKE 'Jo%'", sql)
+        self.assertIn("<> '50% off'", sql)
+
+    def test_bound_values_are_not_interpolated(self):
+        sql = format_sql(self.rule.bind(member_name='100%(last_id)s'), {'last_id': 5})
+        self.assertIn("<> '100%(last_id)s'", sql)
+
+
+if __name__ == '__main__':
+    unittest.main()
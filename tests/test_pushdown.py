@@ -0,0 +1,114 @@
+import json
+import unittest
+
+from json2sql.engine import JSON2SQLGenerator
+
+
+def member_id(field, category):
+    return {'field': field, 'category': category, 'alias': 'member_id', 'is_member_id': True}
+
+
+def json_subquery(subquery_id, rule, fields):
+    return subquery_id, False, json.dumps(rule), json.dumps(fields), '{}'
+
+
+AGE_OVER_3 = {'fields': [1], 'where_data': {'where': {'field': 1, 'operator': 'greater_than', 'value': '3'}}}
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [
+        (1, 'age', 'patients_member', 'integer'),
+        (2, 'code', 'patients_visit', 'string'),
+        (3, 'gender', 'patients_member', 'string'),
+    ],
+    'paths': [('patients_visit', 'member_id', 'patients_member', 'id', None)],
+    'custom_methods': [],
+    'subqueries': [
+        json_subquery(1, AGE_OVER_3, {'member_id': member_id('id', 'patients_member')}),
+        json_subquery(2, dict(AGE_OVER_3, group_by_fields=[{'field': 1}]),
+                      {'member_id': member_id('id', 'patients_member')}),
+        json_subquery(3, {'fields': [2], 'where_data': {'where': {'field': 2, 'operator': 'equals', 'value': 'flu'}}},
+                      {'member_id': member_id('member_id', 'patients_visit')}),
+        json_subquery(4, AGE_OVER_3, {
+            'member_id': member_id('id', 'patients_member'),
+            'max_age': {'field': 1, 'alias': 'max_age', 'aggregate_lhs': 'max'},
+        }),
+        (5, True, 'SELECT `member_id` FROM patients_flag', json.dumps({'member_id': member_id('member_id', 'x')}),
+         '{}'),
+    ],
+    'variable_templates': [],
+}
+
+AGE_FILTER = '`patients_member`.`age` > 30'
+GENDER_FILTER = "`patients_member`.`gender` = 'F'"
+VISIT_FILTER = "`patients_visit`.`code` = 'cold'"
+
+
+class PushdownTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+
+    def compile(self, where_data, *subquery_ids, **kwargs):
+        rule = {
+            'fields': [1, 2, 3], 'where_data': where_data,
+            'sub_queries': [{'unique_id': subquery_id, 'alias': 'sq{id}'.format(id=subquery_id)}
+                            for subquery_id in subquery_ids],
+        }
+        return self.generator.generate_sql(rule, 'patients_member', **kwargs)
+
+    def derived_table(self, sql, subquery_id):
+        """
+        SQL of the derived table of a subquery
+        """
+        start = sql.index('LEFT JOIN (')
+        for _ in range(subquery_id - 1):
+            start = sql.index('LEFT JOIN ', start + 1)
+        return sql[start:sql.index(' AS sq{id} ON'.format(id=subquery_id))]
+
+    def test_base_table_conditions_are_pushed_down(self):
+        sql = self.compile({'and': [
+            {'where': {'field': 1, 'operator': 'greater_than', 'value': '30'}},
+            {'where': {'field': 3, 'operator': 'equals', 'value': 'F'}},
+            {'where': {'field': 2, 'operator': 'equals', 'value': 'cold'}},
+            {'or': [
+                {'where': {'field': 1, 'operator': 'less_than', 'value': '50'}},
+                {'where': {'field': 1, 'operator': 'greater_than', 'value': '60'}},
+            ]},
+        ]}, 1)
+        derived_table = self.derived_table(sql, 1)
+        self.assertIn(AGE_FILTER, derived_table)
+        self.assertIn(GENDER_FILTER, derived_table)
+        self.assertNotIn(VISIT_FILTER, derived_table)
+        self.assertNotIn('< 50', derived_table)
+
+    def test_conditions_below_or_are_not_pushed_down(self):
+        sql = self.compile({'or': [
+            {'where': {'field': 1, 'operator': 'greater_than', 'value': '30'}},
+            {'where': {'field': 3, 'operator': 'equals', 'value': 'F'}},
+        ]}, 1)
+        self.assertNotIn(AGE_FILTER, self.derived_table(sql, 1))
+
+    def test_base_table_filters_are_pushed_down(self):
+        sql = self.compile({'where': {'field': 2, 'operator': 'equals', 'value': 'cold'}}, 1,
+                           base_table_filters=['`patients_member`.`id` < 100'])
+        self.assertIn('`patients_member`.`id` < 100', self.derived_table(sql, 1))
+
+    def test_ineligible_subqueries(self):
+        where_data = {'where': {'field': 1, 'operator': 'greater_than', 'value': '30'}}
+        for subquery_id in (2, 3, 4):
+            sql = self.compile(where_data, subquery_id, base_table_filters=['`patients_member`.`id` < 100'])
+            derived_table = self.derived_table(sql.replace('sq{id}'.format(id=subquery_id), 'sq1'), 1)
+            self.assertNotIn(AGE_FILTER, derived_table, subquery_id)
+            self.assertNotIn('`id` < 100', derived_table, subquery_id)
+
+        sql = self.compile(where_data, 5)
+        self.assertIn('LEFT JOIN ( SELECT `member_id` FROM patients_flag ) AS sq5', sql)
+
+    def test_eligible_and_ineligible_subqueries_in_one_rule(self):
+        sql = self.compile({'where': {'field': 1, 'operator': 'greater_than', 'value': '30'}}, 1, 2)
+        self.assertIn(AGE_FILTER, self.derived_table(sql, 1))
+        self.assertNotIn(AGE_FILTER, self.derived_table(sql, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
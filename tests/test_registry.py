@@ -0,0 +1,55 @@
+import unittest
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.records import FieldRecord
+from json2sql.registry import GeneratorRegistry
+
+
+def knowledge_base(*fields):
+    return {
+        'field_mapping': [(1, 'age', 'patients_member', 'integer')] + list(fields),
+        'paths': [],
+        'custom_methods': [],
+        'subqueries': [],
+        'variable_templates': [],
+    }
+
+
+KNOWLEDGE_BASES = {
+    'shared': knowledge_base(),
+    'acme': knowledge_base((2, 'acme_score', 'patients_member', 'integer')),
+    'globex': knowledge_base((2, 'globex_score', 'patients_member', 'integer')),
+}
+
+
+class GeneratorRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        # Room for a single generator
+        self.registry = GeneratorRegistry(KNOWLEDGE_BASES.__getitem__, memory_budget=1)
+
+    def test_generators_share_records(self):
+        acme = self.registry.get('acme')
+        other = JSON2SQLGenerator(KNOWLEDGE_BASES['globex'], record_pool=self.registry.record_pool)
+        self.assertIs(acme.field_mapping[1], other.field_mapping[1])
+
+    def test_evicting_a_tenant_releases_its_records(self):
+        acme_record = self.registry.get('acme').field_mapping[2]
+        self.assertIn(acme_record, self.registry.record_pool)
+
+        globex = self.registry.get('globex')
+        self.assertNotIn('acme', self.registry)
+        self.assertNotIn(acme_record, self.registry.record_pool)
+        self.assertIn(globex.field_mapping[1], self.registry.record_pool)
+        self.assertIn(globex.field_mapping[2], self.registry.record_pool)
+        self.assertEqual(len(self.registry.record_pool), 2)
+
+    def test_invalidating_a_tenant_releases_its_records(self):
+        self.registry.get('acme')
+        self.registry.invalidate('acme')
+        self.assertEqual(len(self.registry.record_pool), 0)
+        self.assertNotIn(FieldRecord('acme_score', 'patients_member', 'integer', False), self.registry.record_pool)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import json
+import math
+import operator
+import sqlite3
+import unittest
+import zlib
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.sampling import (
+    SAMPLING_HASH, SAMPLING_METHODS, SAMPLING_MODULO, count_members_approximate, estimate_count,
+    get_effective_sample_rate, get_sample_filter
+)
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [(1, 'age', 'patients_member', 'integer')],
+    'paths': [],
+    'custom_methods': [],
+    'subqueries': [
+        (1, False, json.dumps({'fields': [1], 'where_data': {'where': {
+            'field': 1, 'operator': 'greater_than', 'value': '3',
+        }}}), json.dumps({'member_id': {
+            'field': 'id', 'category': 'patients_member', 'alias': 'member_id', 'is_member_id': True,
+        }}), '{}'),
+    ],
+    'variable_templates': [],
+}
+
+RULE = {'fields': [1], 'where_data': {'where': {'field': 1, 'operator': 'less_than', 'value': '30'}}}
+
+MEMBERS = 20000
+
+
+class SampleFilterTest(unittest.TestCase):
+
+    def test_effective_sample_rate(self):
+        self.assertEqual(get_effective_sample_rate(0.3), 1 / 3.0)
+        self.assertEqual(get_effective_sample_rate(0.01, SAMPLING_HASH), 0.01)
+        # Rounded up to a single bucket
+        self.assertEqual(get_effective_sample_rate(0.000001, SAMPLING_HASH), 0.0001)
+        self.assertEqual(get_effective_sample_rate(1), 1)
+
+    def test_sample_filter(self):
+        self.assertEqual(get_sample_filter('patients_member', 0.01), 'MOD(`patients_member`.`id`, 100) = 0')
+        self.assertEqual(get_sample_filter('patients_member', 0.01, SAMPLING_HASH),
+                         'MOD(CRC32(`patients_member`.`id`), 10000) < 100')
+        self.assertIsNone(get_sample_filter('patients_member', 1))
+
+    def test_invalid_sample_rate(self):
+        for sample_rate, method in ((0, SAMPLING_MODULO), (1.5, SAMPLING_HASH), (0.1, 'random')):
+            with self.assertRaises(AssertionError):
+                get_sample_filter('patients_member', sample_rate, method)
+
+    def test_sample_filter_is_pushed_down(self):
+        rule = dict(RULE, sub_queries=[{'unique_id': 1, 'alias': 'sq'}])
+        sql = JSON2SQLGenerator(KNOWLEDGE_BASE).generate_sql(rule, 'patients_member', sample_rate=0.1)
+        self.assertEqual(sql.count(get_sample_filter('patients_member', 0.1)), 2)
+
+    def test_estimate_count(self):
+        estimate = estimate_count(50, 0.1)
+        self.assertEqual(estimate.count, 500)
+        self.assertEqual(estimate.error, int(math.ceil(1.96 * math.sqrt(50 * 0.9) / 0.1)))
+        self.assertEqual((estimate.sample_count, estimate.sample_rate), (50, 0.1))
+        # The effective rate is used, 0.3 samples every 3rd id
+        self.assertEqual(estimate_count(10, 0.3).count, 30)
+        # An empty sample still reports the members it could have missed
+        self.assertEqual(estimate_count(0, 0.5), (0, 3, 0, 0.5))
+        self.assertEqual(estimate_count(7, 1), (7, 0, 7, 1))
+
+
+class ApproximateCountTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.create_function('MOD', 2, operator.mod)
+        self.connection.create_function('CRC32', 1, lambda value: zlib.crc32(str(value).encode()))
+        self.connection.execute('CREATE TABLE patients_member (id INTEGER PRIMARY KEY, age INTEGER)')
+        self.connection.executemany('INSERT INTO patients_member VALUES (?, ?)', [
+            (i, zlib.crc32(str(i * 7).encode()) % 90) for i in range(1, MEMBERS + 1)
+        ])
+        self.generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+        self.expected = self.connection.execute('SELECT COUNT(*) FROM patients_member WHERE age < 30').fetchone()[0]
+
+    def tearDown(self):
+        self.connection.close()
+
+    def estimate(self, sample_rate, method):
+        return count_members_approximate(
+            self.connection, self.generator, json.loads(json.dumps(RULE)), 'patients_member', sample_rate, method
+        )
+
+    def test_estimate_is_within_the_error(self):
+        for method in SAMPLING_METHODS:
+            estimate = self.estimate(0.05, method)
+            self.assertLess(estimate.sample_count, self.expected / 10)
+            self.assertLessEqual(abs(estimate.count - self.expected), estimate.error, method)
+
+    def test_sample_is_deterministic(self):
+        for method in SAMPLING_METHODS:
+            self.assertEqual(self.estimate(0.05, method), self.estimate(0.05, method))
+
+    def test_full_sample_is_exact(self):
+        self.assertEqual(self.estimate(1, SAMPLING_MODULO), (self.expected, 0, self.expected, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.prepared import format_sql
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [
+        (1, 'name', 'patients_member', 'string'),
+        (2, 'notes', 'patients_member', 'string', True),
+    ],
+    'paths': [],
+    'custom_methods': [],
+    'subqueries': [],
+    'variable_templates': [],
+}
+
+
+class StringOperatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+
+    def compile(self, field, operator, value):
+        rule = {'fields': [field], 'where_data': {'where': {'field': field, 'operator': operator, 'value': value}}}
+        return format_sql(self.generator.generate_sql(rule, 'patients_member'))
+
+    def test_like_escapes_wildcards_and_backslash(self):
+        # Backslashes are doubled once as the LIKE escape character and once more for the string literal
+        self.assertIn(r"`patients_member`.`name` LIKE 'a\\_b\\%c\\\\d%'", self.compile(1, 'starts_with', 'a_b%c\\d'))
+        self.assertIn(r"`patients_member`.`name` LIKE '%\\_x'", self.compile(1, 'ends_with', '_x'))
+        self.assertIn(r"`patients_member`.`name` LIKE '%100\\%%'", self.compile(1, 'has_substring', '100%'))
+
+    def test_like_escapes_quotes(self):
+        self.assertIn(r"`patients_member`.`name` LIKE '%O\'Hara%'", self.compile(1, 'has_substring', "O'Hara"))
+
+    def test_fulltext_field_uses_match_against(self):
+        self.assertIn(
+            'MATCH(`patients_member`.`notes`) AGAINST(\'"heart failure"\' IN BOOLEAN MODE)',
+            self.compile(2, 'has_substring', '  heart   failure ')
+        )
+
+    def test_fulltext_term_is_escaped(self):
+        sql = self.compile(2, 'has_substring', 'say "hi" +100% O\'Hara')
+        self.assertIn('AGAINST(\'"say hi +100% O\\\'Hara"\' IN BOOLEAN MODE)', sql)
+
+    def test_fulltext_falls_back_to_like(self):
+        # Terms shorter than the fulltext token size are not indexed
+        self.assertIn("`patients_member`.`notes` LIKE '%ab%'", self.compile(2, 'has_substring', 'ab'))
+        self.assertIn("`patients_member`.`notes` LIKE 'heart%'", self.compile(2, 'starts_with', 'heart'))
+        self.assertIn("`patients_member`.`name` LIKE '%heart%'", self.compile(1, 'has_substring', 'heart'))
+
+    def test_fulltext_only_on_string_fields(self):
+        with self.assertRaises(AssertionError):
+            JSON2SQLGenerator(dict(KNOWLEDGE_BASE, field_mapping=[(1, 'age', 'patients_member', 'integer', True)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
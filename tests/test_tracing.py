@@ -0,0 +1,52 @@
+import unittest
+
+from json2sql.engine import JSON2SQLGenerator
+from json2sql.tracing import KB_VERSION_TAG, LatencyRecorder, fingerprint_sql, parse_tags, tag_sql
+
+KNOWLEDGE_BASE = {
+    'field_mapping': [(1, 'age', 'patients_member', 'integer')],
+    'paths': [],
+    'custom_methods': [],
+    'subqueries': [],
+    'variable_templates': [],
+}
+
+RULE = {'fields': [1], 'where_data': {'where': {'field': 1, 'operator': 'greater_than', 'value': '40'}}}
+
+
+class TraceTagsTest(unittest.TestCase):
+
+    def test_knowledge_base_version_change_is_not_served_from_cache(self):
+        generator = JSON2SQLGenerator(KNOWLEDGE_BASE)
+        for version in ('v1', 'v2'):
+            generator.knowledge_base_version = version
+            sql = generator.generate_sql(dict(RULE), 'patients_member', trace_tags={'rule_id': 7})
+            self.assertEqual(parse_tags(sql)[KB_VERSION_TAG], version)
+
+
+class LatencyRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.recorder = LatencyRecorder(clock=lambda: self.now)
+        self.sql = tag_sql('SELECT COUNT(*) FROM `patients_member` WHERE `age` > 40', [('rule_id', 7)])
+
+    def test_failed_query_is_recorded(self):
+        with self.recorder.track(self.sql, compiled_at=99.0):
+            self.now += 1
+        with self.assertRaises(RuntimeError):
+            with self.recorder.track(self.sql, compiled_at=99.0):
+                self.now += 2
+                raise RuntimeError('Lock wait timeout exceeded')
+
+        stats, = self.recorder.worst()
+        self.assertEqual(stats.fingerprint, fingerprint_sql(self.sql))
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.errors, 1)
+        self.assertEqual(stats.total, 6.0)
+        self.assertEqual(stats.max, 4.0)
+        self.assertEqual(stats.tags, {'rule_id': '7'})
+
+
+if __name__ == '__main__':
+    unittest.main()